@@ -27,3 +27,24 @@ def update_account_schema(account):
   Account.modified.auto_now = False
 
   yield op.db.Put(account)
+
+
+def recalculate_issue_updates(issue):
+  """Recalculate updates_for, reviewer_approval and n_messages_sent of Issues.
+
+  Issue.calculate_updates_for() only applies new messages to these values,
+  this repairs them from the complete list of messages.
+  """
+  Issue.modified.auto_now = False
+  modified = issue.modified
+  issue.recalculate_updates_for()
+  issue.modified = modified
+  yield op.db.Put(issue)
+
+
+def update_message_approval_flags(message):
+  """Precompute the approval flags of Messages written before they existed."""
+  if message.says_lgtm is not None:
+    return
+  message.calculate_approval_flags()
+  yield op.db.Put(message)
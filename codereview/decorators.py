@@ -250,8 +250,8 @@ def require_methods(*methods):
   return decorator
 
 
-def task_queue_required(name):
-  """Returns a function decorator for a task queue named |name|."""
+def task_queue_required(*names):
+  """Returns a function decorator for a task queue named in |names|."""
 
   def decorate_task_queue(func):
 
@@ -262,8 +262,9 @@ def task_queue_required(name):
         return ('http_' + head).replace('-', '_').upper()
 
       actual = request.META.get(format_header('X-AppEngine-QueueName'))
-      if actual != name:
-        logging.error('Task queue name doesn\'t match; %s != %s', actual, name)
+      if actual not in names:
+        logging.error(
+            'Task queue name doesn\'t match; %s not in %s', actual, names)
         return HttpTextResponse('Can only be run as a task queue.', status=403)
       return func(request, *args, **kwargs)
 
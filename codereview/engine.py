@@ -95,9 +95,30 @@ def ParsePatchSet(patchset):
   return patches
 
 
+def FetchComments(patches):
+  """Starts the comment queries for one or more patches.
+
+  The queries run asynchronously, so callers should start them before
+  loading the file contents and pass the result to the Render*TableRows()
+  functions, which only block when they read the comments.
+
+  Args:
+    patches: List of models.Patch instances, None entries are ignored.
+
+  Returns:
+    A dictionary mapping patch keys to iterators over their comments.
+  """
+  comments = {}
+  for patch in patches:
+    if patch is not None and patch.key() not in comments:
+      comments[patch.key()] = models.Comment.all().filter(
+          'patch =', patch).order('date').run(batch_size=1000)
+  return comments
+
+
 def RenderDiffTableRows(request, old_lines, chunks, patch,
                         colwidth=settings.DEFAULT_COLUMN_WIDTH, debug=False,
-                        context=settings.DEFAULT_CONTEXT):
+                        context=settings.DEFAULT_CONTEXT, comments=None):
   """Render the HTML table rows for a side-by-side diff for a patch.
 
   Args:
@@ -108,6 +129,7 @@ def RenderDiffTableRows(request, old_lines, chunks, patch,
     colwidth: Optional column width (default 80).
     debug: Optional debugging flag (default False).
     context: Maximum number of rows surrounding a change (default CONTEXT).
+    comments: Optional result of FetchComments() for the patch.
 
   Yields:
     Strings, each of which represents the text rendering one complete
@@ -115,13 +137,13 @@ def RenderDiffTableRows(request, old_lines, chunks, patch,
     Each yielded string may consist of several <tr> elements.
   """
   rows = _RenderDiffTableRows(request, old_lines, chunks, patch,
-                              colwidth, debug)
+                              colwidth, debug, comments)
   return _CleanupTableRowsGenerator(rows, context)
 
 
 def RenderDiff2TableRows(request, old_lines, old_patch, new_lines, new_patch,
                          colwidth=settings.DEFAULT_COLUMN_WIDTH, debug=False,
-                         context=settings.DEFAULT_CONTEXT):
+                         context=settings.DEFAULT_CONTEXT, comments=None):
   """Render the HTML table rows for a side-by-side diff between two patches.
 
   Args:
@@ -134,6 +156,7 @@ def RenderDiff2TableRows(request, old_lines, old_patch, new_lines, new_patch,
     debug: Optional debugging flag (default False).
     context: Maximum number of visible context lines (default
       settings.DEFAULT_CONTEXT).
+    comments: Optional result of FetchComments() for both patches.
 
   Yields:
     Strings, each of which represents the text rendering one complete
@@ -141,7 +164,8 @@ def RenderDiff2TableRows(request, old_lines, old_patch, new_lines, new_patch,
     Each yielded string may consist of several <tr> elements.
   """
   rows = _RenderDiff2TableRows(request, old_lines, old_patch,
-                               new_lines, new_patch, colwidth, debug)
+                               new_lines, new_patch, colwidth, debug,
+                               comments)
   return _CleanupTableRowsGenerator(rows, context)
 
 
@@ -230,7 +254,8 @@ def _ShortenBuffer(buf, context):
 
 
 def _RenderDiff2TableRows(request, old_lines, old_patch, new_lines, new_patch,
-                          colwidth=settings.DEFAULT_COLUMN_WIDTH, debug=False):
+                          colwidth=settings.DEFAULT_COLUMN_WIDTH, debug=False,
+                          comments=None):
   """Internal version of RenderDiff2TableRows().
 
   Args:
@@ -239,17 +264,15 @@ def _RenderDiff2TableRows(request, old_lines, old_patch, new_lines, new_patch,
   Yields:
     Tuples (tag, row) where tag is an indication of the row type.
   """
+  if comments is None:
+    comments = FetchComments([old_patch, new_patch])
   old_dict = {}
   new_dict = {}
-  for patch, dct in [(old_patch, old_dict), (new_patch, new_dict)]:
-    # XXX GQL doesn't support OR yet...  Otherwise we'd be using that.
-    for comment in models.Comment.gql(
-        'WHERE patch = :1 AND left = FALSE ORDER BY date', patch):
-      if comment.draft and comment.author != request.user:
-        continue  # Only show your own drafts
-      comment.complete()
-      lst = dct.setdefault(comment.lineno, [])
-      lst.append(comment)
+  # Only the comments on the new side of each patch are shown.
+  if old_patch is not None:
+    _, old_dict = _GetComments(request, old_patch, comments)
+  if new_patch is not None:
+    _, new_dict = _GetComments(request, new_patch, comments)
   return _TableRowGenerator(old_patch, old_dict, len(old_lines)+1, 'new',
                             new_patch, new_dict, len(new_lines)+1, 'new',
                             _GenerateTriples(old_lines, new_lines),
@@ -273,11 +296,13 @@ def _GenerateTriples(old_lines, new_lines):
     yield tag, old_lines[i1:i2], new_lines[j1:j2]
 
 
-def _GetComments(request):
+def _GetComments(request, patch=None, comments=None):
   """Helper that returns comments for a patch.
 
   Args:
     request: Django Request object.
+    patch: The models.Patch instance, defaults to request.patch.
+    comments: Optional result of FetchComments() including the patch.
 
   Returns:
     A 2-tuple of (old, new) where old/new are dictionaries that holds comments
@@ -285,11 +310,19 @@ def _GetComments(request):
   """
   old_dict = {}
   new_dict = {}
+  if patch is None:
+    patch = request.patch
+  # The query results can only be read once, so they are taken out of
+  # 'comments'; a second lookup for the same patch starts a new query.
+  query = None
+  if comments is not None:
+    query = comments.pop(patch.key(), None)
+  if query is None:
+    query = FetchComments([patch])[patch.key()]
   # XXX GQL doesn't support OR yet...  Otherwise we'd be using
   # .gql('WHERE patch = :1 AND (draft = FALSE OR author = :2) ORDER BY data',
   #      patch, request.user)
-  for comment in models.Comment.gql('WHERE patch = :1 ORDER BY date',
-                                    request.patch):
+  for comment in query:
     if comment.draft and comment.author != request.user:
       continue  # Only show your own drafts
     comment.complete()
@@ -302,7 +335,8 @@ def _GetComments(request):
 
 
 def _RenderDiffTableRows(request, old_lines, chunks, patch,
-                         colwidth=settings.DEFAULT_COLUMN_WIDTH, debug=False):
+                         colwidth=settings.DEFAULT_COLUMN_WIDTH, debug=False,
+                         comments=None):
   """Internal version of RenderDiffTableRows().
 
   Args:
@@ -314,7 +348,7 @@ def _RenderDiffTableRows(request, old_lines, chunks, patch,
   old_dict = {}
   new_dict = {}
   if patch:
-    old_dict, new_dict = _GetComments(request)
+    old_dict, new_dict = _GetComments(request, patch, comments)
   old_max, new_max = _ComputeLineCounts(old_lines, chunks)
   return _TableRowGenerator(patch, old_dict, old_max, 'old',
                             patch, new_dict, new_max, 'new',
@@ -604,18 +638,19 @@ def _RenderInlineComments(line_valid, lineno, data, user,
   return ''.join(comments)
 
 
-def RenderUnifiedTableRows(request, parsed_lines):
+def RenderUnifiedTableRows(request, parsed_lines, comments=None):
   """Render the HTML table rows for a unified diff for a patch.
 
   Args:
     request: Django Request object.
     parsed_lines: List of tuples for each line that contain the line number,
       if they exist, for the old and new file.
+    comments: Optional result of FetchComments() for request.patch.
 
   Returns:
     A list of html table rows.
   """
-  old_dict, new_dict = _GetComments(request)
+  old_dict, new_dict = _GetComments(request, comments=comments)
 
   rows = []
   for old_line_no, new_line_no, line_text in parsed_lines:
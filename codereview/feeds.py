@@ -54,14 +54,26 @@ class BaseFeed(Feed):
   def item_title(self, item):
     return 'the title'
 
-  def item_author_name(self, item):
+  def _item_author(self, item):
     if isinstance(item, models.Issue):
-      return library.get_nickname(item.owner, True)
+      return item.owner
     if isinstance(item, models.PatchSet):
-      return library.get_nickname(item.issue.owner, True)
+      return item.issue.owner
     if isinstance(item, models.Message):
-      return library.get_nickname(item.sender, True)
-    return 'Rietveld'
+      return item.sender
+    return None
+
+  def _prefetch_authors(self, items):
+    """Resolves the nicknames of all item authors at once."""
+    authors = [self._item_author(item) for item in items]
+    library.prefetch_nicknames([a for a in authors if a], self.request)
+    return items
+
+  def item_author_name(self, item):
+    author = self._item_author(item)
+    if author is None:
+      return 'Rietveld'
+    return library.get_nickname(author, True, self.request)
 
   def item_pubdate(self, item):
     if isinstance(item, models.Issue):
@@ -98,22 +110,25 @@ class ReviewsFeed(BaseUserFeed):
   title = 'Code Review - All issues I have to review'
 
   def items(self, obj):
-    return _rss_helper(obj.email, 'closed = FALSE AND reviewers = :1',
-                       use_email=True)
+    return self._prefetch_authors(
+        _rss_helper(obj.email, 'closed = FALSE AND reviewers = :1',
+                    use_email=True))
 
 
 class ClosedFeed(BaseUserFeed):
   title = "Code Review - Reviews closed by me"
 
   def items(self, obj):
-    return _rss_helper(obj.email, 'closed = TRUE AND owner = :1')
+    return self._prefetch_authors(
+        _rss_helper(obj.email, 'closed = TRUE AND owner = :1'))
 
 
 class MineFeed(BaseUserFeed):
   title = 'Code Review - My issues'
 
   def items(self, obj):
-    return _rss_helper(obj.email, 'closed = FALSE AND owner = :1')
+    return self._prefetch_authors(
+        _rss_helper(obj.email, 'closed = FALSE AND owner = :1'))
 
 
 class AllFeed(BaseFeed):
@@ -122,7 +137,7 @@ class AllFeed(BaseFeed):
   def items(self):
     query = models.Issue.gql('WHERE closed = FALSE AND private = FALSE '
                              'ORDER BY modified DESC')
-    return query.fetch(RSS_LIMIT)
+    return self._prefetch_authors(query.fetch(RSS_LIMIT))
 
 
 class OneIssueFeed(BaseFeed):
@@ -143,7 +158,7 @@ class OneIssueFeed(BaseFeed):
   def items(self, obj):
     items = list(obj.patchsets) + list(obj.messages)
     items.sort(key=self.item_pubdate)
-    return items
+    return self._prefetch_authors(items)
 
 
 ### RSS feeds ###
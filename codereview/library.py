@@ -17,7 +17,6 @@
 import cgi
 import math
 
-from google.appengine.api import memcache
 from google.appengine.api import users
 
 import django.template
@@ -29,52 +28,34 @@ from codereview import models
 
 register = django.template.Library()
 
-user_cache = {}
+# The request being rendered by responses.respond(). The filters rendering
+# user links use it to cache the nicknames, see prefetch_nicknames().
+current_request = None
 
 
-def get_links_for_users(user_emails):
-  """Return a dictionary of email->link to user page and fill caches."""
-  link_dict = {}
-  remaining_emails = set(user_emails)
-
-  # initialize with email usernames
-  for email in remaining_emails:
-    nick = email.split('@', 1)[0]
-    link_dict[email] = cgi.escape(nick)
-
-  # look in the local cache
-  for email in remaining_emails:
-    if email in user_cache:
-      link_dict[email] = user_cache[email]
-  remaining_emails = remaining_emails - set(user_cache)
-
-  if not remaining_emails:
-    return link_dict
-
-  # then look in memcache
-  memcache_results = memcache.get_multi(remaining_emails,
-                                        key_prefix="show_user:")
-  for email in memcache_results:
-    link_dict[email] = memcache_results[email]
-    user_cache[email] = memcache_results[email]
-  remaining_emails = remaining_emails - set(memcache_results)
-
-  if not remaining_emails:
-    return link_dict
-
-  # and finally hit the datastore
-  accounts = models.Account.get_accounts_for_emails(remaining_emails)
-  for account in accounts:
-    if account and account.user_has_selected_nickname:
-      ret = ('<a href="%s" onMouseOver="M_showUserInfoPopup(this)">%s</a>' %
-             (reverse('codereview.views.show_user', args=[account.nickname]),
-              cgi.escape(account.nickname)))
-      link_dict[account.email] = ret
-
-  datastore_results = dict((e, link_dict[e]) for e in remaining_emails)
-  memcache.set_multi(datastore_results, 300, key_prefix='show_user:')
-  user_cache.update(datastore_results)
+def get_links_for_users(user_emails, request=None):
+  """Return a dictionary of email->link to user page.
 
+  The nicknames are read from the per-request cache of get_nickname(), filled
+  for all the emails in one go. 'request' defaults to current_request.
+  """
+  request = request or current_request
+  if request is None:
+    details = models.Account.get_nickname_details_for_emails(user_emails)
+  else:
+    prefetch_nicknames(user_emails, request)
+    details = _get_nickname_cache(request)
+
+  link_dict = {}
+  for email in user_emails:
+    nickname, has_account = details[email]
+    if has_account:
+      link_dict[email] = (
+          '<a href="%s" onMouseOver="M_showUserInfoPopup(this)">%s</a>' %
+          (reverse('codereview.views.show_user', args=[nickname]),
+           cgi.escape(nickname)))
+    else:
+      link_dict[email] = cgi.escape(email.split('@', 1)[0])
   return link_dict
 
 
@@ -220,17 +201,45 @@ def get_nickname(email, never_me=False, request=None):
   if request is None:
     return models.Account.get_nickname_for_email(email)
 
-  # _nicknames is injected into request as a cache.
-  # TODO(maruel): Use memcache instead.
+  nicknames = _get_nickname_cache(request)
+  if email not in nicknames:
+    prefetch_nicknames([email], request)
+  return nicknames[email][0]
+
+
+def _get_nickname_cache(request):
+  """Returns the nickname cache dict injected into request.
+
+  It maps each email to a tuple (nickname, has_account), see
+  models.Account.get_nickname_details_for_emails().
+  """
   # Access to a protected member _nicknames of a client class
   # pylint: disable=W0212
   if getattr(request, '_nicknames', None) is None:
     request._nicknames = {}
-  if email in request._nicknames:
-    return request._nicknames[email]
-  result = models.Account.get_nickname_for_email(email)
-  request._nicknames[email] = result
-  return result
+  return request._nicknames
+
+
+def prefetch_nicknames(emails, request):
+  """Resolve the nicknames for a list of emails in one go.
+
+  The nicknames are stored in the per-request cache used by get_nickname(),
+  so a template or JSON response rendering many users afterwards does not
+  look up accounts one by one.
+
+  Args:
+    emails: iterable of email addresses or User instances.
+    request: a HttpRequest, used as the cache holder.
+  """
+  nicknames = _get_nickname_cache(request)
+  missing = set()
+  for email in emails:
+    if isinstance(email, users.User):
+      email = email.email()
+    if email not in nicknames:
+      missing.add(email)
+  if missing:
+    nicknames.update(models.Account.get_nickname_details_for_emails(missing))
 
 
 class NicknameNode(django.template.Node):
@@ -44,11 +44,8 @@ class AddUserToRequestMiddleware(object):
     request.user = auth_utils.get_current_user()
     request.user_is_admin = auth_utils.is_current_user_admin()
 
-    # Update the cached value of the current user's Account
-    account = None
-    if request.user is not None:
-      account = models.Account.get_account_for_user(request.user)
-    models.Account.current_user_account = account
+    # The current user's Account is only loaded when first needed.
+    models.Account.set_current_user(request.user)
 
 
 class PropagateExceptionMiddleware(object):
@@ -19,6 +19,7 @@ import datetime
 import itertools
 import json
 import logging
+import math
 import md5
 import os
 import re
@@ -104,6 +105,10 @@ class Issue(db.Model):
   # JSON: {reviewer_email -> int}
   draft_count_by_user = db.TextProperty()
 
+  # Whether the owner has sent a message on this issue yet. None on older
+  # issues, see views._get_mail_template().
+  owner_mailed = db.BooleanProperty(indexed=False)
+
   _is_starred = None
   _has_updates_for_current_user = None
 
@@ -220,6 +225,30 @@ class Issue(db.Model):
       self._num_drafts[comment.author.email()] = cur + 1
     self.draft_count_by_user = json.dumps(self._num_drafts)
 
+  def update_draft_count(self, user, delta):
+    """Adds delta to the number of drafts of user, and saves the issue.
+
+    The count is updated in a transaction, so concurrent draft saves on the
+    issue don't lose updates and no draft needs to be read.
+
+    Returns:
+      The new number of drafts of user on this issue.
+    """
+    email = user.email()
+    def txn():
+      issue = Issue.get(self.key())
+      if issue.draft_count_by_user is None:
+        issue.calculate_draft_count_by_user()
+      else:
+        counts = json.loads(issue.draft_count_by_user)
+        counts[email] = max(0, counts.get(email, 0) + delta)
+        issue.draft_count_by_user = json.dumps(counts)
+      issue.put()
+      return issue.draft_count_by_user
+    self.draft_count_by_user = db.run_in_transaction(txn)
+    self._num_drafts = json.loads(self.draft_count_by_user)
+    return self._num_drafts.get(email, 0)
+
   @staticmethod
   def _collaborator_emails_from_description(description):
     """Parses a description, returning collaborator email addresses.
@@ -284,17 +313,44 @@ class Issue(db.Model):
     return self._has_updates_for_current_user
 
   def calculate_updates_for(self, *msgs):
-    """Recalculates updates_for, reviewer_approval, and draft_count_by_user,
-    factoring in msgs which haven't been sent.
+    """Updates updates_for, reviewer_approval and n_messages_sent for msgs,
+    which are messages that haven't been sent yet.
+
+    Only msgs are applied to the stored values, so the cost doesn't grow with
+    the number of messages on the issue. Issues that don't have the values yet
+    are recalculated from scratch with recalculate_updates_for(). The stored
+    values don't track reviewers, cc or collaborators added since, so call
+    recalculate_updates_for() instead when these change.
 
     This only updates this Issue object. You'll still need to put() it to
     the data store for it to take effect.
     """
-    updates_for_set = set(self.updates_for)
+    if self.n_messages_sent is None or self.reviewer_approval is None:
+      self.recalculate_updates_for(*msgs)
+      return
     approval_dict = {r: None for r in self.reviewers}
+    for email, approval in json.loads(self.reviewer_approval).iteritems():
+      if approval is not None:
+        approval_dict[email] = approval
+    self._apply_messages(msgs, set(self.updates_for), approval_dict)
+
+  def recalculate_updates_for(self, *msgs):
+    """Recalculates updates_for, reviewer_approval, and n_messages_sent from
+    all the sent messages of this issue, factoring in msgs which haven't been
+    sent.
+
+    This reads every message of the issue, use calculate_updates_for() unless
+    the stored values need to be repaired.
+    """
     self.num_messages = 0
     old_messages = self.message_set.filter('draft =', False).run()
-    for msg in itertools.chain(old_messages, msgs):
+    self._apply_messages(itertools.chain(old_messages, msgs),
+                         set(self.updates_for),
+                         {r: None for r in self.reviewers})
+
+  def _apply_messages(self, msgs, updates_for_set, approval_dict):
+    """Folds msgs into updates_for, reviewer_approval and n_messages_sent."""
+    for msg in msgs:
       self.num_messages += 1
       if msg.sender == self.owner.email():
         updates_for_set.update(self.reviewers, self.cc,
@@ -515,11 +571,32 @@ class PatchSet(db.Model):
   created = db.DateTimeProperty(auto_now_add=True)
   modified = db.DateTimeProperty(auto_now=True)
   n_comments = db.IntegerProperty(default=0)
+  # Summary of the patches for mails, stored by update_file_summary() once
+  # the upload is complete. total_added is None for older patch sets.
+  files = db.StringListProperty(indexed=False)
+  total_added = db.IntegerProperty(indexed=False)
+  total_removed = db.IntegerProperty(indexed=False)
 
   @property
   def patches(self):
     return self.patch_set.order('filename')
 
+  def update_file_summary(self, patches=None):
+    """Stores the file list and line counts of the patches.
+
+    You'll still need to put() this PatchSet for it to take effect.
+
+    Args:
+      patches: the patches of this patch set, fetched when not given.
+    """
+    if patches is None:
+      patches = self.patches
+    patches = sorted(patches, key=lambda p: p.filename)
+    self.files = [(p.status and p.status + ' ' or '') + p.filename
+                  for p in patches]
+    self.total_added = sum(p.num_added for p in patches)
+    self.total_removed = sum(p.num_removed for p in patches)
+
   def update_comment_count(self, n):
     """Increment the n_comments property by n."""
     self.n_comments = self.num_comments + n
@@ -591,18 +668,69 @@ class Message(db.Model):
   draft = db.BooleanProperty(default=False)
   in_reply_to = db.SelfReferenceProperty()
   issue_was_closed = db.BooleanProperty(default=False)
+  # Precomputed by calculate_approval_flags() when the message is written, so
+  # that find() doesn't need to parse the text nor to fetch the issue. None on
+  # older messages.
+  sender_is_owner = db.BooleanProperty(indexed=False)
+  says_lgtm = db.BooleanProperty(indexed=False)
+  says_not_lgtm = db.BooleanProperty(indexed=False)
+  says_no_lgtm = db.BooleanProperty(indexed=False)
+
+  # Texts looked up by find() which have a precomputed property.
+  _FLAGS = {
+    'lgtm': 'says_lgtm',
+    'not lgtm': 'says_not_lgtm',
+    'no lgtm': 'says_no_lgtm',
+  }
 
   _approval = None
   _disapproval = None
 
+  def calculate_approval_flags(self, issue=None):
+    """Computes sender_is_owner and the says_* properties.
+
+    Must be called whenever text or sender changes, before put().
+
+    Args:
+      issue: the Issue of this message if already loaded, to save a fetch.
+    """
+    issue = issue or self.issue
+    self.sender_is_owner = issue.owner.email() == self.sender
+    lines = [line for line in (self.text or '').lower().splitlines()
+             if not line.strip().startswith('>')]
+    for text, prop in self._FLAGS.iteritems():
+      setattr(self, prop, any(text in line for line in lines))
+    self._approval = None
+    self._disapproval = None
+
+  def record_activity(self):
+    """Adds the issue to the DayActivity index of the day of this message.
+
+    Must be called when a non-draft message is written. A failure is logged
+    and doesn't fail the message, the daily statistics then miss the issue
+    for the day.
+    """
+    try:
+      DayActivity.record(self.parent_key().id(), self.date)
+    except db.Error:
+      logging.exception(
+          'Failed to record the activity of issue %d', self.parent_key().id())
+
   def find(self, text, owner_allowed=False):
     """Returns True when the message says |text|.
 
     - Must not be written by the issue owner.
     - Must contain |text| in a line that doesn't start with '>'.
     """
-    if not owner_allowed and self.issue.owner.email() == self.sender:
-      return False
+    if not owner_allowed:
+      sender_is_owner = self.sender_is_owner
+      if sender_is_owner is None:
+        sender_is_owner = self.issue.owner.email() == self.sender
+      if sender_is_owner:
+        return False
+    prop = self._FLAGS.get(text)
+    if prop is not None and getattr(self, prop) is not None:
+      return getattr(self, prop)
     return any(
         True for line in self.text.lower().splitlines()
         if not line.strip().startswith('>') and text in line)
@@ -913,45 +1041,55 @@ class Comment(db.Model):
   text = db.TextProperty()
   left = db.BooleanProperty()
   draft = db.BooleanProperty(required=True, default=True)
+  # The text split in buckets, computed by calculate_buckets() when the
+  # comment is saved. Each item is the index of the line following a bucket,
+  # times two, plus one if the bucket is quoted. Empty for older comments.
+  bucket_ends = db.ListProperty(int, indexed=False)
 
   buckets = None
   shorttext = None
 
-  def complete(self):
-    """Set the shorttext and buckets attributes."""
-    # TODO(guido): Turn these into caching proprties instead.
-
-    # The strategy for buckets is that we want groups of lines that
-    # start with > to be quoted (and not displayed by
-    # default). Whitespace-only lines are not considered either quoted
-    # or not quoted. Same goes for lines that go like "On ... user
-    # wrote:".
-    cur_bucket = []
-    quoted = None
-    self.buckets = []
+  def calculate_buckets(self):
+    """Set bucket_ends from the text.
 
-    def _Append():
-      if cur_bucket:
-        self.buckets.append(Bucket(text="\n".join(cur_bucket),
-                                   quoted=bool(quoted)))
-
-    lines = self.text.splitlines()
-    for line in lines:
+    The strategy for buckets is that we want groups of lines that start
+    with > to be quoted (and not displayed by default). Whitespace-only
+    lines are not considered either quoted or not quoted. Same goes for
+    lines that go like "On ... user wrote:".
+    """
+    self.bucket_ends = []
+    quoted = None
+    start = 0
+    for i, line in enumerate((self.text or '').splitlines()):
       if line.startswith("On ") and line.endswith(":"):
         pass
       elif line.startswith(">"):
         if quoted is False:
-          _Append()
-          cur_bucket = []
+          if i > start:
+            self.bucket_ends.append(i * 2)
+          start = i
         quoted = True
       elif line.strip():
         if quoted is True:
-          _Append()
-          cur_bucket = []
+          if i > start:
+            self.bucket_ends.append(i * 2 + 1)
+          start = i
         quoted = False
-      cur_bucket.append(line)
+    lines = len((self.text or '').splitlines())
+    if lines > start:
+      self.bucket_ends.append(lines * 2 + bool(quoted))
 
-    _Append()
+  def complete(self):
+    """Set the shorttext and buckets attributes."""
+    if not self.bucket_ends:
+      self.calculate_buckets()
+    lines = self.text.splitlines()
+    self.buckets = []
+    start = 0
+    for end in self.bucket_ends:
+      self.buckets.append(Bucket("\n".join(lines[start:end // 2]),
+                                 bool(end % 2)))
+      start = end // 2
 
     self.shorttext = self.text.lstrip()[:50].rstrip()
     # Grab the first 50 chars from the first non-quoted bucket
@@ -961,18 +1099,16 @@ class Comment(db.Model):
         break
 
 
-class Bucket(db.Model):
+class Bucket(object):
   """A 'Bucket' of text.
 
   A comment may consist of multiple text buckets, some of which may be
   collapsed by default (when they represent quoted text).
-
-  NOTE: This entity is never written to the database.  See Comment.complete().
   """
-  # TODO(guido): Flesh this out.
 
-  text = db.TextProperty()
-  quoted = db.BooleanProperty()
+  def __init__(self, text, quoted):
+    self.text = text
+    self.quoted = quoted
 
 
 ### Repositories and Branches ###
@@ -1007,6 +1143,53 @@ class Branch(db.Model):
 ### Accounts ###
 
 
+class _CurrentUserAccount(object):
+  """Class attribute loading the current user's Account on first access.
+
+  The middleware only records the current user; the Account entity is
+  fetched the first time Account.current_user_account is read, so requests
+  that never look at it (API, downloads, images) don't pay for the lookup.
+  """
+
+  def __get__(self, _instance, owner):
+    if owner._current_user_account is _NOT_LOADED:
+      account = None
+      if owner._current_user is not None:
+        account = owner.get_account_for_user(owner._current_user)
+      owner._current_user_account = account
+    return owner._current_user_account
+
+
+_NOT_LOADED = object()
+
+
+# Number of suffixes Account.create_nickname_for_user() tries before falling
+# back to the email address. Each probe is a transaction and a query, so keep
+# it small for the first login to stay fast. Every probe advances the counter,
+# so the following accounts skip past old suffixed nicknames.
+MAX_NICKNAME_PROBES = 10
+
+
+class NicknameCounter(db.Model):
+  """Last numeric nickname suffix reserved for a name.
+
+  The key name is the lowercased name.
+  """
+  last = db.IntegerProperty(default=0, indexed=False)
+
+  @classmethod
+  def reserve(cls, name):
+    """Returns the next suffix of name, never handed out before."""
+    def txn():
+      counter = cls.get_by_key_name(name.lower())
+      if counter is None:
+        counter = cls(key_name=name.lower())
+      counter.last += 1
+      counter.put()
+      return counter.last
+    return db.run_in_transaction(txn)
+
+
 class Account(db.Model):
   """Maps a user or email address to a user-selected nickname, and more.
 
@@ -1042,18 +1225,64 @@ class Account(db.Model):
   # Spammer; only blocks sending messages, not uploading issues.
   blocked = db.BooleanProperty(default=False)
 
-  # Current user's Account.  Updated by middleware.AddUserToRequestMiddleware.
-  current_user_account = None
+  # Current user's Account.  Lazily loaded for the user set by
+  # middleware.AddUserToRequestMiddleware through set_current_user().
+  current_user_account = _CurrentUserAccount()
+  _current_user = None
+  _current_user_account = None
 
   lower_email = db.StringProperty()
   lower_nickname = db.StringProperty()
   xsrf_secret = db.BlobProperty()
+  # Ids of the issues with drafts by this user. Only meaningful once
+  # draft_issues_indexed is set, see drafts.
+  draft_issues = db.ListProperty(int, indexed=False)
+  draft_issues_indexed = db.BooleanProperty(default=False, indexed=False)
 
-  # Note that this doesn't get called when doing multi-entity puts.
+  # Note that this doesn't get called when doing multi-entity puts, call
+  # invalidate_cache() after them.
   def put(self):
     self.lower_email = str(self.email).lower()
     self.lower_nickname = self.nickname.lower()
     super(Account, self).put()
+    memcache.delete('user_nickname:' + self.email)
+    # Write-through so that get_account_for_user() never sees stale data.
+    memcache.set('account:' + self.email,
+                 db.model_to_protobuf(self).Encode(), 3600)
+
+  def delete(self):
+    super(Account, self).delete()
+    self.invalidate_cache([self.email])
+
+  @classmethod
+  def invalidate_cache(cls, emails):
+    """Drops the cached Account and nickname of each email address.
+
+    Must be called after a multi-entity put of Account instances, as it
+    bypasses put() and its write-through.
+    """
+    emails = list(emails)
+    memcache.delete_multi(emails, key_prefix='account:')
+    memcache.delete_multi(emails, key_prefix='user_nickname:')
+
+  @classmethod
+  def set_current_user(cls, user):
+    """Sets the user whose Account is returned by current_user_account.
+
+    The Account itself is only fetched when current_user_account is accessed.
+    """
+    cls._current_user = user
+    if user is None:
+      cls._current_user_account = None
+    else:
+      cls._current_user_account = _NOT_LOADED
+
+  @classmethod
+  def _loaded_current_user_account(cls):
+    """Returns the current user's Account if it was already loaded."""
+    if cls._current_user_account is _NOT_LOADED:
+      return None
+    return cls._current_user_account
 
   @classmethod
   def get_id_for_email(cls, email):
@@ -1064,11 +1293,24 @@ class Account(db.Model):
     """Get the Account for a user, creating a default one if needed."""
     email = user.email()
     assert email
+    account = cls._loaded_current_user_account()
+    if account is not None and account.email == email:
+      return account
+    # Most accounts are read far more often than written, serve them from
+    # memcache. Account.put() keeps the cached copy up to date.
+    data = memcache.get('account:' + email)
+    if data is not None:
+      try:
+        return db.model_from_protobuf(data)
+      except Exception, err:
+        logging.warning('Invalid cached account for %s: %s', email, err)
     key = cls.get_id_for_email(email)
     # Since usually the account already exists, first try getting it
     # without the transaction implied by get_or_insert().
     account = cls.get_by_key_name(key)
     if account is not None:
+      memcache.add('account:' + email,
+                   db.model_to_protobuf(account).Encode(), 3600)
       return account
     nickname = cls.create_nickname_for_user(user)
     return cls.get_or_insert(key, user=user, email=email, nickname=nickname,
@@ -1076,18 +1318,31 @@ class Account(db.Model):
 
   @classmethod
   def create_nickname_for_user(cls, user):
-    """Returns a unique nickname for a user."""
-    name = nickname = user.email().split('@', 1)[0]
-    next_char = chr(ord(nickname[0].lower())+1)
-    existing_nicks = [account.lower_nickname
-                      for account in cls.gql(('WHERE lower_nickname >= :1 AND '
-                                              'lower_nickname < :2'),
-                                             nickname.lower(), next_char)]
-    suffix = 0
-    while nickname.lower() in existing_nicks:
-      suffix += 1
+    """Returns a unique nickname for a user.
+
+    The plain email user name is used when free. Otherwise numeric suffixes
+    are reserved from the NicknameCounter of the name, so allocating one
+    doesn't require loading the accounts with similar nicknames. Each
+    candidate is verified with an exact keys-only query, since accounts
+    created before the counter existed may already use the next suffixes.
+    """
+    email = user.email()
+    name = email.split('@', 1)[0]
+    if not cls._is_nickname_taken(name):
+      return name
+    for _ in xrange(MAX_NICKNAME_PROBES):
+      suffix = NicknameCounter.reserve(name)
       nickname = '%s%d' % (name, suffix)
-    return nickname
+      if not cls._is_nickname_taken(nickname):
+        return nickname
+    logging.error('No free nickname suffix found for %s', email)
+    return email.replace('@', '_')
+
+  @classmethod
+  def _is_nickname_taken(cls, nickname):
+    """Returns True if an Account already uses nickname, ignoring case."""
+    query = cls.all(keys_only=True).filter('lower_nickname =', nickname.lower())
+    return query.get() is not None
 
   @classmethod
   def get_nickname_for_user(cls, user):
@@ -1109,9 +1364,10 @@ class Account(db.Model):
   @classmethod
   def get_by_key_name(cls, key, **kwds):
     """Override db.Model.get_by_key_name() to use cached value if possible."""
-    if not kwds and cls.current_user_account is not None:
-      if key == cls.current_user_account.key().name():
-        return cls.current_user_account
+    account = cls._loaded_current_user_account()
+    if not kwds and account is not None:
+      if key == account.key().name():
+        return account
     return super(Account, cls).get_by_key_name(key, **kwds)
 
   @classmethod
@@ -1119,9 +1375,10 @@ class Account(db.Model):
     """Get multiple accounts.  Returns a dict by email."""
     results = {}
     keys = []
+    current = cls._loaded_current_user_account()
     for email in emails:
-      if cls.current_user_account and email == cls.current_user_account.email:
-        results[email] = cls.current_user_account
+      if current and email == current.email:
+        results[email] = current
       else:
         keys.append('<%s>' % email)
     if keys:
@@ -1151,6 +1408,56 @@ class Account(db.Model):
       return default
     return email.replace('@', '_')
 
+  @classmethod
+  def get_nicknames_for_emails(cls, emails):
+    """Get the nicknames for many email addresses at once.
+
+    Args:
+      emails: iterable of email addresses.
+    Returns:
+      Dict mapping each email to its nickname, using the same fallback as
+      get_nickname_for_email() for emails without an Account. Empty emails
+      map to ''.
+    """
+    return dict(
+        (email, nickname)
+        for email, (nickname, _) in
+            cls.get_nickname_details_for_emails(emails).iteritems())
+
+  @classmethod
+  def get_nickname_details_for_emails(cls, emails):
+    """Get the nicknames for many email addresses at once, and whether each
+    one has an Account.
+
+    Nicknames are looked up in memcache first and the remaining ones are
+    fetched from the datastore with a single multi-get.
+
+    Args:
+      emails: iterable of email addresses.
+    Returns:
+      Dict mapping each email to a tuple (nickname, has_account). Emails
+      without an Account use the same nickname fallback as
+      get_nickname_for_email(). Empty emails map to ('', False).
+    """
+    emails = set(emails)
+    details = dict((email, ('', False)) for email in emails if not email)
+    emails = [email for email in emails if email]
+    if not emails:
+      return details
+    details.update(memcache.get_multi(emails, key_prefix='user_nickname:'))
+    missing = [email for email in emails if email not in details]
+    if missing:
+      found = {}
+      accounts = cls.get_accounts_for_emails(missing)
+      for email, account in zip(missing, accounts):
+        if account is not None and account.nickname:
+          found[email] = (account.nickname, True)
+        else:
+          found[email] = (email.replace('@', '_'), False)
+      memcache.set_multi(found, 300, key_prefix='user_nickname:')
+      details.update(found)
+    return details
+
   @classmethod
   def get_account_for_nickname(cls, nickname):
     """Get the list of Accounts that have this nickname."""
@@ -1192,7 +1499,7 @@ class Account(db.Model):
   def drafts(self):
     """A list of issue ids that have drafts by this user.
 
-    This is cached in memcache.
+    This is stored in draft_issues and cached in memcache.
     """
     if self._drafts is None:
       if self._initialize_drafts():
@@ -1240,6 +1547,10 @@ class Account(db.Model):
       self._drafts = drafts
       ##logging.info('HIT: %s -> %s', self.email, self._drafts)
       return False
+    if self.draft_issues_indexed:
+      self._drafts = list(self.draft_issues)
+      return True
+    # Accounts created before draft_issues existed need a full scan, once.
     # We're looking for the Issue key id.  The ancestry of comments goes:
     # Issue -> PatchSet -> Patch -> Comment.
     issue_ids = set(comment.key().parent().parent().parent().id()
@@ -1251,8 +1562,13 @@ class Account(db.Model):
     return True
 
   def _save_drafts(self):
-    """Save self._drafts to memcache."""
+    """Save self._drafts to the datastore if it changed, and to memcache."""
     ##logging.info('SAVING: %s -> %s', self.email, self._drafts)
+    if (not self.draft_issues_indexed or
+        sorted(self.draft_issues) != sorted(self._drafts)):
+      self.draft_issues = list(self._drafts)
+      self.draft_issues_indexed = True
+      self.put()
     memcache.set('user_drafts:' + self.email, self._drafts, 3600)
 
   def get_xsrf_token(self, offset=0):
@@ -1260,14 +1576,17 @@ class Account(db.Model):
     # This code assumes that
     # self.user.email() == auth_utils.get_current_user().email()
     current_user = auth_utils.get_current_user()
+    dirty = False
     if self.user.user_id() != current_user.user_id():
       # Mainly for Google Account plus conversion.
       logging.info('Updating user_id for %s from %s to %s' % (
         self.user.email(), self.user.user_id(), current_user.user_id()))
       self.user = current_user
-      self.put()
+      dirty = True
     if not self.xsrf_secret:
       self.xsrf_secret = os.urandom(8)
+      dirty = True
+    if dirty:
       self.put()
     m = md5.new(self.xsrf_secret)
     email_str = self.lower_email
@@ -1282,6 +1601,32 @@ class Account(db.Model):
 ### Statistics ###
 
 
+# Ratio between the bounds of two consecutive buckets of the latency histograms
+# stored in AccountStatsBase. Percentiles read from the histograms are within
+# about 5% of the exact value.
+LATENCY_HISTOGRAM_BASE = 1.1
+
+
+def latency_to_bucket(latency):
+  """Returns the latency histogram bucket of a latency >= 0 in seconds.
+
+  Bucket 0 holds latencies under a second, bucket n > 0 the latencies in
+  [LATENCY_HISTOGRAM_BASE**(n-1), LATENCY_HISTOGRAM_BASE**n).
+  """
+  if latency < 1:
+    return 0
+  return 1 + int(math.log(latency, LATENCY_HISTOGRAM_BASE))
+
+
+def bucket_to_latency(bucket):
+  """Returns the latency representing a bucket, the geometric middle of its
+  bounds.
+  """
+  if not bucket:
+    return 0
+  return int(round(LATENCY_HISTOGRAM_BASE ** (bucket - 0.5)))
+
+
 def compute_score(stats):
   """Calculates the score used for the leaderboard.
 
@@ -1307,11 +1652,13 @@ class AccountStatsBase(ndb.Model):
 
   Parent is always the corresponding Account.
 
-  There's 3 types of entity types:
+  There's 4 types of entity types:
   1. Single day summary. AccountStatsDay. Key name is 'YYYY-MM-DD'.
   2. Single month summary. AccountStatsMulti. Key name is 'YYYY-MM'.
   3. 'XX last days' rolling summary. AccountStatsMulti. Key name is the string
      'XX'.
+  4. Quarter and year rollups of the monthly summaries. AccountStatsMulti. Key
+     name is 'YYYY-qX' or 'YYYY'.
 
   The statistics encompass all the reviews WHERE THE INITIAL EMAIL WAS SENT IN
   THE DAY. This is important, it's not 'when the issue was created' neither when
@@ -1386,38 +1733,83 @@ class AccountStatsBase(ndb.Model):
   # again or not.
   score = ndb.FloatProperty(default=NULL_SCORE)
 
+  # Histogram of the latencies >= 0, as bucket numbers (see
+  # latency_to_bucket()) and their counts. Histograms are merged by adding the
+  # counts, so summaries get percentiles without sorting all their latencies.
+  latency_buckets = ndb.IntegerProperty(repeated=True, indexed=False)
+  latency_counts = ndb.IntegerProperty(repeated=True, indexed=False)
+
+  # Aggregates computed by _get_aggregates(), reset when the lists change.
+  _aggregates = None
+
+  def _get_aggregates(self):
+    """Computes all the derived values in a single pass over the lists.
+
+    The result is cached on the instance. reset_aggregates() must be called
+    when the lists are modified in place.
+    """
+    if self._aggregates is None:
+      out = dict.fromkeys(
+          ('nb_reviewed', 'nb_ignored', 'nb_lgtmed', 'nb_drive_by',
+           'nb_not_requested', 'nb_outgoing', 'self_love'), 0)
+      latencies = []
+      for latency, lgtms, review_type in itertools.izip(
+          self.latencies, self.lgtms, self.review_types):
+        if latency >= 0:
+          latencies.append(latency)
+        if review_type == self.OUTGOING:
+          out['nb_outgoing'] += 1
+          if lgtms > 0:
+            out['self_love'] += 1
+          continue
+        if latency >= 0:
+          out['nb_reviewed'] += 1
+        if lgtms > 0:
+          out['nb_lgtmed'] += 1
+        if review_type == self.IGNORED:
+          out['nb_ignored'] += 1
+        elif review_type == self.DRIVE_BY:
+          out['nb_drive_by'] += 1
+        elif review_type == self.NOT_REQUESTED:
+          out['nb_not_requested'] += 1
+      out['nb_issues'] = len(self.review_types) - out['nb_outgoing']
+      latencies.sort()
+      out['latencies'] = latencies
+      self._aggregates = out
+    return self._aggregates
+
+  def reset_aggregates(self):
+    """Discards the cached aggregates after the lists were modified."""
+    self._aggregates = None
+
   @property
   def nb_reviewed(self):
     """Total reviews requests where the user replied where a latency can be
     calculated.
     """
-    return sum(
-        self.review_types[i] != self.OUTGOING and self.latencies[i] >= 0
-        for i in xrange(len(self.issues)))
+    return self._get_aggregates()['nb_reviewed']
 
   @property
   def nb_ignored(self):
     """Number of issues the user didn't review yet but should."""
-    return sum(r == self.IGNORED for r in self.review_types)
+    return self._get_aggregates()['nb_ignored']
 
   @property
   def nb_issues(self):
     """Number of issues either reviewed or ignored excluding outgoing issues."""
-    return sum(r != self.OUTGOING for r in self.review_types)
+    return self._get_aggregates()['nb_issues']
 
   @property
   def nb_lgtmed(self):
     """Number of issues LGTMed."""
-    return sum(
-        self.review_types[i] != self.OUTGOING and self.lgtms[i] > 0
-        for i in xrange(len(self.issues)))
+    return self._get_aggregates()['nb_lgtmed']
 
   @property
   def nb_drive_by(self):
     """Number of issues that got a drive by by this user, e.g. the user never
     got a formal issue review request.
     """
-    return sum(r == self.DRIVE_BY for r in self.review_types)
+    return self._get_aggregates()['nb_drive_by']
 
   @property
   def nb_not_requested(self):
@@ -1425,21 +1817,19 @@ class AccountStatsBase(ndb.Model):
     even asking for a review. This can happen if the author asked for a review
     out of band, like by IM.
     """
-    return sum(r == self.NOT_REQUESTED for r in self.review_types)
+    return self._get_aggregates()['nb_not_requested']
 
   @property
   def nb_outgoing(self):
     """Number of issues the user sent."""
-    return sum(r == self.OUTGOING for r in self.review_types)
+    return self._get_aggregates()['nb_outgoing']
 
   @property
   def self_love(self):
     """How much the user likes to auto-congratulate himself on his own reviews.
     """
     # self.self_love + self.nb_lgtmed == sum(l > 0 for l in self.lgtms[i])
-    return sum(
-        self.review_types[i] == self.OUTGOING and self.lgtms[i] > 0
-        for i in xrange(len(self.issues)))
+    return self._get_aggregates()['self_love']
 
   @property
   def latencies_sorted(self):
@@ -1448,7 +1838,7 @@ class AccountStatsBase(ndb.Model):
   @property
   def median_latency(self):
     """Calculates the median latency to store in the datastore."""
-    latencies = sorted(l for l in self.latencies if l >= 0)
+    latencies = self._get_aggregates()['latencies']
     if not latencies:
       return None
     length = len(latencies)
@@ -1464,11 +1854,50 @@ class AccountStatsBase(ndb.Model):
     The average is much less useful than the median, since the distribution is
     more Poisson-like than a bell curve.
     """
-    latencies = [l for l in self.latencies if l >= 0]
+    latencies = self._get_aggregates()['latencies']
     if not latencies:
       return None
     return sum(latencies) / float(len(latencies))
 
+  def get_latency_histogram(self):
+    """Returns the latency histogram as a dict(bucket -> count).
+
+    Falls back to the latencies for entities stored before the histogram was.
+    """
+    if self.latency_buckets:
+      return dict(zip(self.latency_buckets, self.latency_counts))
+    histogram = {}
+    for latency in self.latencies:
+      if latency >= 0:
+        bucket = latency_to_bucket(latency)
+        histogram[bucket] = histogram.get(bucket, 0) + 1
+    return histogram
+
+  def set_latency_histogram(self, histogram):
+    """Stores a dict(bucket -> count) as the latency histogram."""
+    self.latency_buckets = sorted(histogram)
+    self.latency_counts = [histogram[b] for b in self.latency_buckets]
+
+  def latency_percentile(self, percent):
+    """Returns the approximate latency under which |percent| % of the reviews
+    were done, from the histogram.
+    """
+    histogram = self.get_latency_histogram()
+    total = sum(histogram.itervalues())
+    if not total:
+      return None
+    rank = max(1, int(math.ceil(total * percent / 100.)))
+    seen = 0
+    for bucket in sorted(histogram):
+      seen += histogram[bucket]
+      if seen >= rank:
+        return bucket_to_latency(bucket)
+
+  @property
+  def p90_latency(self):
+    """The approximate 90th percentile of the review latency."""
+    return self.latency_percentile(90)
+
   @property
   def percent_reviewed(self):
     """Percentage of issues reviewed out of total incoming issues."""
@@ -1515,11 +1944,15 @@ class AccountStatsBase(ndb.Model):
         assert r in (self.IGNORED, self.OUTGOING), str(self)
 
     # Always recalculate the score.
+    self.reset_aggregates()
     self.score = compute_score(self)
 
   def to_dict(self):
     out = super(AccountStatsBase, self).to_dict()
     del out['modified']
+    del out['latency_buckets']
+    del out['latency_counts']
+    out.pop('first_day', None)
     return out
 
 
@@ -1530,8 +1963,18 @@ class AccountStatsDay(AccountStatsBase):
   """
   days = 1
 
+  def _pre_put_hook(self):
+    """Updates the latency histogram, as the lists are modified in place."""
+    self.latency_buckets = []
+    self.set_latency_histogram(self.get_latency_histogram())
+    super(AccountStatsDay, self)._pre_put_hook()
+
 
 class AccountStatsMulti(AccountStatsBase):
+  # Rolling summaries only: oldest AccountStatsDay summed in, 'YYYY-MM-DD'.
+  # Used to find the summaries still holding days that left the window.
+  first_day = ndb.StringProperty()
+
   # Cache the number of days covered by this entity.
   _days = None
 
@@ -1542,7 +1985,10 @@ class AccountStatsMulti(AccountStatsBase):
     Guaranteed to be >=1.
     """
     if not self._days:
-      if self.name.isdigit():
+      if self.name.isdigit() and len(self.name) == 4:
+        # It is a yearly rollup.
+        self._days = 366 if calendar.isleap(int(self.name)) else 365
+      elif self.name.isdigit():
         # It is a rolling summary.
         self._days = int(self.name)
       else:
@@ -1553,7 +1999,7 @@ class AccountStatsMulti(AccountStatsBase):
           self._days = calendar.monthrange(int(year), int(month))[1]
         else:
           self._days = sum(
-              calendar.monthrange(map(int, i.split('-')))[1] for i in quarter)
+              calendar.monthrange(*map(int, i.split('-')))[1] for i in quarter)
     return self._days
 
   @property
@@ -1570,6 +2016,114 @@ class AccountStatsMulti(AccountStatsBase):
     return float(self.nb_reviewed) / self.days
 
 
+class StatsBackfill(ndb.Model):
+  """A parallel statistics backfill.
+
+  The days are split in ranges, each processed by its own chain of tasks and
+  checkpointed in its own StatsBackfillShard, see views.start_stats_backfill().
+  The task completing the last shard triggers the followup tasks.
+  """
+  created = ndb.DateTimeProperty(auto_now_add=True)
+  # Number of StatsBackfillShard.
+  shards = ndb.IntegerProperty(default=0, indexed=False)
+  # Tasks for views.task_update_stats() to run once all the days are done.
+  followup = ndb.StringProperty(repeated=True, indexed=False)
+  # Set when the followup tasks were triggered.
+  finished = ndb.BooleanProperty(default=False, indexed=False)
+
+
+class StatsBackfillShard(ndb.Model):
+  """Progress of a StatsBackfill over a range of days.
+
+  The key name is '<backfill id>-<shard index>'. Each shard is its own entity
+  group so the shards save their progress without contending with each other.
+  Each completed day is removed from pending so a retried task doesn't
+  process it again.
+  """
+  # Days 'YYYY-MM-DD' not processed yet.
+  pending = ndb.StringProperty(repeated=True, indexed=False)
+
+  @classmethod
+  def get_key(cls, backfill_id, index):
+    return ndb.Key(cls, '%d-%d' % (backfill_id, index))
+
+
+class StatsRollups(ndb.Model):
+  """Marks that every monthly summary has its quarter and year rollups.
+
+  The single entity 'complete' is written once views.update_all_stats_rollups()
+  went through all the monthly summaries. Until then, the rollups only exist
+  for the accounts updated since they were introduced, so the quarter and year
+  leaderboards are merged from their months.
+  """
+  completed = ndb.DateTimeProperty(auto_now_add=True, indexed=False)
+
+  @classmethod
+  def is_complete(cls):
+    return bool(cls.get_by_id('complete'))
+
+
+class DayActivity(ndb.Model):
+  """Ids of the issues that received a Message on a day.
+
+  The key name is 'YYYY-MM-DD/N' where N is the issue id modulo SHARDS, so
+  concurrent messages on different issues seldom update the same entity. It is
+  written by record() when a Message is sent and read by
+  views.yield_issues_for_day() instead of scanning all the Message of the day.
+
+  The index is only complete for the days after the first recorded one, see
+  DayActivityStart.
+  """
+  issues = ndb.IntegerProperty(repeated=True, indexed=False)
+
+  SHARDS = 16
+
+  @classmethod
+  def get_keys(cls, day):
+    """Returns the keys of all the shards of a day 'YYYY-MM-DD'."""
+    return [ndb.Key(cls, '%s/%d' % (day, i)) for i in xrange(cls.SHARDS)]
+
+  @classmethod
+  def record(cls, issue_id, date):
+    """Adds issue_id to the index of the day of date."""
+    day = str(date.date())
+    cache_key = 'day_activity:%s:%d' % (day, issue_id)
+    if memcache.get(cache_key):
+      return
+    if not memcache.get('day_activity_start'):
+      DayActivityStart.get_or_insert('start', day=day)
+      memcache.set('day_activity_start', True)
+    key = ndb.Key(cls, '%s/%d' % (day, issue_id % cls.SHARDS))
+    _add_day_activity(key, issue_id)
+    memcache.set(cache_key, True, 2 * 24 * 60 * 60)
+
+  @classmethod
+  def is_complete(cls, day):
+    """Returns True if every issue with a Message on the day 'YYYY-MM-DD' was
+    recorded.
+    """
+    start = DayActivityStart.get_by_id('start')
+    return bool(start) and day > start.day
+
+
+@ndb.transactional
+def _add_day_activity(key, issue_id):
+  activity = key.get() or DayActivity(key=key)
+  if issue_id not in activity.issues:
+    activity.issues.append(issue_id)
+    activity.put()
+
+
+class DayActivityStart(ndb.Model):
+  """The first day recorded in the DayActivity index.
+
+  The single entity 'start' is written by the first DayActivity.record(). The
+  messages sent on that day before the index was deployed were not recorded,
+  so that day and the older ones are still read by scanning their Message.
+  """
+  day = ndb.StringProperty(indexed=False)
+
+
 def quarter_to_months(when):
   """Manually handles the form 'YYYY-QX'."""
   quarter = re.match(r'^(\d\d\d\d-)[qQ]([1-4])$', when)
@@ -1577,7 +2131,7 @@ def quarter_to_months(when):
     return None
   prefix = quarter.group(1)
   # Convert the quarter into 3 months group.
-  base = (int(quarter.group(2)) - 1) * 4 + 1
+  base = (int(quarter.group(2)) - 1) * 3 + 1
   return ['%s%02d' % (prefix, i) for i in range(base, base+3)]
 
 
@@ -1618,14 +2172,26 @@ def sum_account_statistics(out, items):
   prev_latencies = out.latencies
   prev_lgtms = out.lgtms
   prev_review_types = out.review_types
-
-  out.issues = sum((i.issues for i in items), [])
-  out.latencies = sum((i.latencies for i in items), [])
-  out.lgtms = sum((i.lgtms for i in items), [])
-  out.review_types = sum((i.review_types for i in items), [])
+  prev_latency_buckets = out.latency_buckets
+  prev_latency_counts = out.latency_counts
+
+  out.issues = list(itertools.chain.from_iterable(i.issues for i in items))
+  out.latencies = list(
+      itertools.chain.from_iterable(i.latencies for i in items))
+  out.lgtms = list(itertools.chain.from_iterable(i.lgtms for i in items))
+  out.review_types = list(
+      itertools.chain.from_iterable(i.review_types for i in items))
+  histogram = {}
+  for item in items:
+    for bucket, count in item.get_latency_histogram().iteritems():
+      histogram[bucket] = histogram.get(bucket, 0) + count
+  out.set_latency_histogram(histogram)
+  out.reset_aggregates()
   out.score = compute_score(out)
   return (
       prev_issues != out.issues or
       prev_latencies != out.latencies or
       prev_lgtms != out.lgtms or
-      prev_review_types != out.review_types)
+      prev_review_types != out.review_types or
+      prev_latency_buckets != out.latency_buckets or
+      prev_latency_counts != out.latency_counts)
@@ -81,8 +81,9 @@ def respond(request, template, params=None):
       params['xsrf_token'] = account.get_xsrf_token()
   params['must_choose_nickname'] = must_choose_nickname
   params['rietveld_revision'] = django_settings.RIETVELD_REVISION
+  library.current_request = request
   try:
     return render_to_response(template, params,
                               context_instance=RequestContext(request))
   finally:
-    library.user_cache.clear() # don't want this sticking around
+    library.current_request = None
@@ -99,10 +99,12 @@ urlpatterns = patterns(
     (r'^restricted/tasks/refresh_all_stats_score$',
         'task_refresh_all_stats_score'),
     (r'^restricted/tasks/update_stats$', 'task_update_stats'),
+    (r'^restricted/tasks/backfill_stats$', 'task_backfill_stats'),
     (r'^restricted/update_stats$', 'update_stats'),
     (r'^restricted/set-client-id-and-secret$', 'set_client_id_and_secret'),
     (r'^restricted/tasks/calculate_delta$', 'task_calculate_delta'),
     (r'^restricted/tasks/migrate_entities$', 'task_migrate_entities'),
+    (r'^restricted/tasks/send_mail$', 'task_send_mail'),
     (r'^restricted/user/([^/]+)/block$', 'block_user'),
     (r'^_ah/mail/(.*)', 'incoming_mail'),
     )
@@ -14,8 +14,12 @@
 
 """Views for Rietveld."""
 
+import array
+import base64
 import binascii
 import calendar
+import collections
+import contextlib
 import datetime
 import email  # see incoming_mail()
 import email.utils
@@ -33,6 +37,7 @@ import urllib
 from cStringIO import StringIO
 from xml.etree import ElementTree
 
+from google.appengine.api import apiproxy_stub_map
 from google.appengine.api import mail
 from google.appengine.api import memcache
 from google.appengine.api import taskqueue
@@ -42,7 +47,6 @@ from google.appengine.datastore import datastore_query
 from google.appengine.ext import db
 from google.appengine.ext import ndb
 from google.appengine.runtime import DeadlineExceededError
-from google.appengine.runtime import apiproxy_errors
 
 from django import forms
 # Import settings as django_settings to avoid name conflict with settings().
@@ -101,6 +105,10 @@ MAX_CC = 2000
 MAX_MESSAGE = 10000
 MAX_FILENAME = 255
 MAX_DB_KEY_LENGTH = 1000
+# Account autocomplete: number of matches kept per prefix and maximum number
+# of accounts scanned per datastore query.
+MAX_ACCOUNT_MATCHES = 100
+MAX_ACCOUNT_SCAN = 500
 
 
 ### Form classes ###
@@ -538,6 +546,11 @@ class InvalidIncomingEmailError(Exception):
 ### Helper functions ###
 
 
+def format_header(head):
+  """Returns the request.META key of the HTTP header |head|."""
+  return ('http_' + head).replace('-', '_').upper()
+
+
 def _random_bytes(n):
   """Helper returning a string of random bytes of given length."""
   return ''.join(map(chr, (random.randrange(256) for i in xrange(n))))
@@ -622,7 +635,7 @@ def _inner_paginate(request, issues, template, extra_template_params):
   """
   visible_issues = [i for i in issues if i.view_allowed]
   _optimize_draft_counts(visible_issues)
-  _load_users_for_issues(visible_issues)
+  _load_users_for_issues(request, visible_issues)
   params = {
     'issues': visible_issues,
     'limit': None,
@@ -804,19 +817,16 @@ def starred(request):
   else:
     issues = [issue for issue in models.Issue.get_by_id(stars)
                     if issue is not None and issue.view_allowed]
-    _load_users_for_issues(issues)
+    _load_users_for_issues(request, issues)
     _optimize_draft_counts(issues)
   return respond(request, 'starred.html', {'issues': issues})
 
-def _load_users_for_issues(issues):
+def _load_users_for_issues(request, issues):
   """Load all user links for a list of issues in one go."""
-  user_dict = {}
+  emails = set()
   for i in issues:
-    for e in i.reviewers + i.cc + [i.owner.email()]:
-      # keeping a count lets you track total vs. distinct if you want
-      user_dict[e] = user_dict.setdefault(e, 0) + 1
-
-  library.get_links_for_users(user_dict.keys())
+    emails.update(i.reviewers + i.cc + [i.owner.email()])
+  library.prefetch_nicknames(emails, request)
 
 @deco.user_key_required
 def show_user(request):
@@ -889,7 +899,7 @@ def _show_user(request):
   # that was sent out.
   outgoing_issues = [issue for issue in my_issues if issue.num_messages]
   unsent_issues = [issue for issue in my_issues if not issue.num_messages]
-  _load_users_for_issues(all_issues)
+  _load_users_for_issues(request, all_issues)
   _optimize_draft_counts(all_issues)
   account = models.Account.get_account_for_user(request.user_to_show)
   return respond(request, 'user.html',
@@ -926,7 +936,7 @@ def block_user(request):
         query = models.Issue.all().filter('reviewers =', email)
         for issue in query:
           issue.reviewers.remove(email)
-          issue.calculate_updates_for()
+          issue.recalculate_updates_for()
           tbd[issue.key()] = issue
         # look for issues where blocked user is in cc only
         query = models.Issue.all().filter('cc =', email)
@@ -1194,6 +1204,9 @@ def upload_complete(request, patchset_id=None):
     query = query.filter('status =', None)  # all uploaded file have a status
     if query.count() > 0:
       errors.append('Base files missing.')
+    # Statuses are only known once the base files are uploaded.
+    patchset.update_file_summary()
+    patchset.put()
   # Create (and send) a message if needed.
   if request.POST.get('send_mail') == 'yes' or request.POST.get('message'):
     msg = _make_message(request, request.issue, request.POST.get('message', ''),
@@ -1284,6 +1297,8 @@ def _make_new(request, form):
       return (None, None)
 
     db.put(patches)
+    patchset.update_file_summary(patches)
+    patchset.put()
 
   if form.cleaned_data.get('send_mail'):
     msg = _make_message(request, issue, '', '', True)
@@ -1377,7 +1392,10 @@ def _add_patchset_from_form(request, issue, form, message_key='message',
       form.errors[errkey] = ['Patch set contains no recognizable patches']
       return None
     db.put(patches)
+    patchset.update_file_summary(patches)
+    patchset.put()
 
+  old_recipients = _get_issue_recipients(issue)
   if emails_add_only:
     emails = _get_emails(form, 'reviewers')
     if not form.is_valid():
@@ -1391,7 +1409,8 @@ def _add_patchset_from_form(request, issue, form, message_key='message',
   else:
     issue.reviewers = _get_emails(form, 'reviewers')
     issue.cc = _get_emails(form, 'cc')
-  issue.calculate_updates_for()
+  if _get_issue_recipients(issue) != old_recipients:
+    issue.recalculate_updates_for()
   issue.put()
 
   if form.cleaned_data.get('send_mail'):
@@ -1499,6 +1518,9 @@ def show(request):
     elif msg.draft and request.user and msg.sender == request.user.email():
       has_draft_message = True
   num_patchsets = len(patchsets)
+  library.prefetch_nicknames(
+      [msg.sender for msg in messages] + [issue.owner] +
+      issue.reviewers + issue.cc, request)
   return respond(request, 'issue.html', {
     'first_patch': first_patch,
     'has_draft_message': has_draft_message,
@@ -1532,37 +1554,104 @@ def patchset(request):
 @deco.login_required
 def account(request):
   """/account/?q=blah&limit=10&timestamp=blah - Used for autocomplete."""
-  def searchAccounts(prop, domain, added, response):
-    query = request.GET.get('q').lower()
-    limit = _clean_int(request.GET.get('limit'), 10, 10, 100)
-
-    accounts = models.Account.all()
-    accounts.filter("lower_%s >= " % prop, query)
-    accounts.filter("lower_%s < " % prop, query + u"\ufffd")
-    accounts.filter("blocked =", False)
-    accounts.order("lower_%s" % prop)
-    for account in accounts:
-      if account.key() in added:
-        continue
-      if domain and not account.email.endswith(domain):
-        continue
-      if len(added) >= limit:
-        break
-      added.add(account.key())
-      response += '%s (%s)\n' % (account.email, account.nickname)
-    return added, response
-
-  added = set()
-  response = ''
+  query = request.GET.get('q', '').lower()
+  limit = _clean_int(request.GET.get('limit'), 10, 10, 100)
   domain = os.environ['AUTH_DOMAIN']
-  if domain != 'gmail.com':
+  if domain == 'gmail.com':
     # 'gmail.com' is the value AUTH_DOMAIN is set to if the app is running
     # on appspot.com and shouldn't prioritize the custom domain.
-    added, response = searchAccounts("email", domain, added, response)
-    added, response = searchAccounts("nickname", domain, added, response)
-  added, response = searchAccounts("nickname", "", added, response)
-  added, response = searchAccounts("email", "", added, response)
-  return HttpTextResponse(response)
+    domain = ''
+  matches = _get_account_matches(query, domain)[:limit]
+  return HttpTextResponse(''.join('%s (%s)\n' % m for m in matches))
+
+
+def _account_matches_key(query, domain):
+  """Returns the memcache key holding the autocomplete matches for query."""
+  digest = md5.new(('%s:%s' % (domain, query)).encode('utf-8')).hexdigest()
+  return 'account_matches:' + digest
+
+
+def _rank_account_matches(domain, candidates_for):
+  """Orders the accounts matching an autocomplete query.
+
+  Accounts of the given domain come first, then accounts matching by
+  nickname and finally the ones matching by email.
+
+  Args:
+    domain: domain to prioritize, or an empty string.
+    candidates_for: function taking 'email' or 'nickname' and returning the
+      (email, nickname) tuples whose property starts with the query, sorted
+      by that property.
+
+  Returns:
+    A list of at most MAX_ACCOUNT_MATCHES (email, nickname) tuples.
+  """
+  searches = [('nickname', ''), ('email', '')]
+  if domain:
+    searches = [('email', domain), ('nickname', domain)] + searches
+  added = set()
+  matches = []
+  for prop, search_domain in searches:
+    for email, nickname in candidates_for(prop):
+      if email in added:
+        continue
+      if search_domain and not email.endswith(search_domain):
+        continue
+      if len(matches) >= MAX_ACCOUNT_MATCHES:
+        return matches
+      added.add(email)
+      matches.append((email, nickname))
+  return matches
+
+
+def _get_account_matches(query, domain):
+  """Returns the (email, nickname) tuples of accounts matching query.
+
+  Matches are cached per prefix. When a shorter prefix of query is cached
+  with its complete list of matches, the result is computed from it without
+  touching the datastore, which is the common case while the user types.
+  """
+  prefixes = [query[:i] for i in xrange(len(query), 0, -1)]
+  keys = [_account_matches_key(prefix, domain) for prefix in prefixes]
+  cached = memcache.get_multi(keys)
+  if keys and keys[0] in cached:
+    return cached[keys[0]][1]
+
+  candidates = None
+  for key in keys[1:]:
+    if key in cached and cached[key][0]:
+      candidates = cached[key][1]
+      break
+
+  results = {}
+  truncated = [False]
+  if candidates is not None:
+    def candidates_for(prop):
+      index = 0 if prop == 'email' else 1
+      found = [c for c in candidates if c[index].lower().startswith(query)]
+      found.sort(key=lambda c: c[index].lower())
+      return found
+  else:
+    def candidates_for(prop):
+      if prop not in results:
+        accounts = models.Account.all()
+        accounts.filter('lower_%s >= ' % prop, query)
+        accounts.filter('lower_%s < ' % prop, query + u'\ufffd')
+        accounts.filter('blocked =', False)
+        accounts.order('lower_%s' % prop)
+        found = accounts.fetch(MAX_ACCOUNT_SCAN)
+        if len(found) >= MAX_ACCOUNT_SCAN:
+          truncated[0] = True
+        results[prop] = [(a.email, a.nickname) for a in found]
+      return results[prop]
+
+  matches = _rank_account_matches(domain, candidates_for)
+  # A complete list holds every account matching query, so it can answer
+  # any longer query as well.
+  complete = not truncated[0] and len(matches) < MAX_ACCOUNT_MATCHES
+  if keys:
+    memcache.set(keys[0], (complete, matches), 300)
+  return matches
 
 
 @deco.issue_editor_required
@@ -1601,6 +1690,7 @@ def edit(request):
   cleaned_data = form.cleaned_data
 
   was_closed = issue.closed
+  old_recipients = _get_issue_recipients(issue)
   issue.subject = cleaned_data['subject']
   issue.description = cleaned_data['description']
   issue.closed = cleaned_data['closed']
@@ -1613,7 +1703,8 @@ def edit(request):
     for patchset in issue.patchsets:
       db.run_in_transaction(_delete_cached_contents,
                             list(patchset.patches))
-  issue.calculate_updates_for()
+  if _get_issue_recipients(issue) != old_recipients:
+    issue.recalculate_updates_for()
   issue.put()
 
   return HttpResponseRedirect(reverse(show, args=[issue.key().id()]))
@@ -1832,7 +1923,7 @@ def fields(request):
     issue.description = fields['description']
   if 'reviewers' in fields:
     issue.reviewers = _get_emails_from_raw(fields['reviewers'])
-    issue.calculate_updates_for()
+    issue.recalculate_updates_for()
   if 'subject' in fields:
     issue.subject = fields['subject']
   issue.put()
@@ -1859,12 +1950,13 @@ def patch_helper(request, nav_type='patch'):
   Returns:
     Whatever respond() returns.
   """
+  comments = engine.FetchComments([request.patch])
   _add_next_prev(request.patchset, request.patch)
   request.patch.nav_type = nav_type
   parsed_lines = patching.ParsePatchToLines(request.patch.lines)
   if parsed_lines is None:
     return HttpTextResponse('Can\'t parse the patch to lines', status=404)
-  rows = engine.RenderUnifiedTableRows(request, parsed_lines)
+  rows = engine.RenderUnifiedTableRows(request, parsed_lines, comments)
   return respond(request, 'patch.html',
                  {'patch': request.patch,
                   'patchset': request.patchset,
@@ -1942,6 +2034,19 @@ def _patchset_as_dict(patchset, comments, request=None):
     'num_comments': patchset.num_comments,
     'files': {},
   }
+  comments_by_patch = {}
+  if comments:
+    # Fetch all published comments of the patch set with a single query and
+    # resolve their authors' nicknames in one batch.
+    all_comments = models.Comment.gql('WHERE ANCESTOR IS :1 AND draft = FALSE',
+                                      patchset).fetch(None)
+    all_comments.sort(key=lambda c: c.date)
+    for c in all_comments:
+      patch_key = models.Comment.patch.get_value_for_datastore(c)
+      comments_by_patch.setdefault(patch_key, []).append(c)
+    if request is not None:
+      library.prefetch_nicknames(
+          [c.author for c in all_comments] + [patchset.issue.owner], request)
   for patch in models.Patch.gql("WHERE patchset = :1", patchset):
     # num_comments and num_drafts are left out for performance reason:
     # they cause a datastore query on first access. They could be added
@@ -1967,8 +2072,7 @@ def _patchset_as_dict(patchset, comments, request=None):
           'left': c.left,
           'draft': c.draft,
         }
-        for c in models.Comment.gql('WHERE patch = :patch and draft = FALSE '
-                                    'ORDER BY date', patch=patch)]
+        for c in comments_by_patch.get(patch.key(), [])]
   return values
 
 
@@ -2076,13 +2180,16 @@ def _get_diff_table_rows(request, patch, context, column_width):
   if chunks is None:
     raise FetchError('Can\'t parse the patch to chunks')
 
+  # Start the comment query so it runs while the base file is loaded.
+  comments = engine.FetchComments([patch])
   # Possible FetchErrors are handled in diff() and diff_skipped_lines().
   content = request.patch.get_content()
 
   rows = list(engine.RenderDiffTableRows(request, content.lines,
                                          chunks, patch,
                                          context=context,
-                                         colwidth=column_width))
+                                         colwidth=column_width,
+                                         comments=comments))
   if rows and rows[-1] is None:
     del rows[-1]
     # Get rid of content, which may be bad
@@ -2206,6 +2313,9 @@ def _get_diff2_data(request, ps_left_id, ps_right_id, patch_id, context,
   # Now find the corresponding patch in ps_left
   patch_left = models.Patch.gql('WHERE patchset = :1 AND filename = :2',
                                 ps_left, patch_filename).get()
+  # Start the comment queries for both sides so they run while the
+  # contents are loaded.
+  comments = engine.FetchComments([patch_left, patch_right])
 
   if patch_left:
     try:
@@ -2233,7 +2343,8 @@ def _get_diff2_data(request, ps_left_id, ps_right_id, patch_id, context,
                                      lines_left, patch_left,
                                      lines_right, patch_right,
                                      context=context,
-                                     colwidth=column_width)
+                                     colwidth=column_width,
+                                     comments=comments)
   rows = list(rows)
   if rows and rows[-1] is None:
     del rows[-1]
@@ -2438,17 +2549,21 @@ def _add_or_update_comment(user, issue, patch, lineno, left, text, message_id):
       assert comment.draft and comment.author == user
       comment.delete()  # Deletion
       comment = None
-      # Re-query the comment count.
-      models.Account.current_user_account.update_drafts(issue)
+      remaining = issue.update_draft_count(user, -1)
+      models.Account.current_user_account.update_drafts(issue, remaining > 0)
   else:
-    if comment is None:
+    created = comment is None
+    if created:
       comment = models.Comment(key_name=message_id, parent=patch)
     comment.patch = patch
     comment.lineno = lineno
     comment.left = left
     comment.text = db.Text(text)
     comment.message_id = message_id
+    comment.calculate_buckets()
     comment.put()
+    if created:
+      issue.update_draft_count(user, 1)
     # The actual count doesn't matter, just that there's at least one.
     models.Account.current_user_account.update_drafts(issue, 1)
   return comment
@@ -2473,28 +2588,93 @@ def api_draft_comments(request):
   because it is not unusual to come back after hours; the XSRF tokens
   time out after 1 or 2 hours.  The final submit of the drafts for
   others to view *is* XSRF-protected.
+
+  The request body is a JSON list of drafts, each a dict with the keys
+  patch_id, lineno, left, text and optionally message_id to update an
+  existing draft. A draft with an empty text is deleted. The response is a
+  list with a {'message_id': <id>} dict per draft, the id being None for
+  deleted drafts. A message_id can only be listed once per request.
   """
+  user = request.user
+  issue = request.issue
   try:
-    def sanitize(comment):
-      patch = models.Patch.get_by_id(int(comment.patch_id),
-                                     parent=request.patchset)
-      assert not patch is None
-      message_id = str(comment.message_id) if message_id in comment else None,
-      return {
-        user: request.user,
-        issue: request.issue,
-        patch: patch,
-        lineno: int(comment.lineno),
-        left: bool(comment.left),
-        text: str(comment.text),
-        message_id: message_id,
-      }
-    return [
-      {message_id: _add_or_update_comment(**comment).message_id}
-      for comment in map(sanitize, json.load(request.data))
-    ]
-  except Exception, err:
-    return HttpTextResponse('An error occurred.', status=500)
+    drafts = json.loads(request.raw_post_data)
+    if not isinstance(drafts, list):
+      raise ValueError('Expected a list')
+    for draft in drafts:
+      draft['patch_id'] = int(draft['patch_id'])
+      draft['lineno'] = int(draft['lineno'])
+      draft['left'] = bool(draft.get('left'))
+      draft['text'] = unicode(draft.get('text') or '')
+      if draft.get('message_id'):
+        draft['message_id'] = str(draft['message_id'])
+      else:
+        draft['message_id'] = None
+  except (ValueError, TypeError, KeyError, AttributeError), err:
+    return HttpTextResponse('Invalid request: %s' % err, status=400)
+
+  # Validate all the patches and fetch the comments to update at once.
+  patch_ids = list(set(draft['patch_id'] for draft in drafts))
+  patches = dict(zip(patch_ids, db.get([
+      db.Key.from_path('Patch', patch_id, parent=request.patchset.key())
+      for patch_id in patch_ids])))
+  missing = [patch_id for patch_id, patch in patches.iteritems() if not patch]
+  if missing:
+    return HttpTextResponse('Unknown patches: %s' % missing, status=400)
+  comment_keys = [
+      db.Key.from_path('Comment', draft['message_id'],
+                       parent=patches[draft['patch_id']].key())
+      for draft in drafts if draft['message_id']]
+  if len(set(comment_keys)) != len(comment_keys):
+    # Each entry would update the same comment and the draft count.
+    duplicates = sorted(set(
+        k.name() for k in comment_keys if comment_keys.count(k) > 1))
+    return HttpTextResponse(
+        'Duplicate message_id: %s' % ', '.join(duplicates), status=400)
+  existing = dict(
+      (c.key(), c) for c in db.get(comment_keys)
+      if c is not None and c.draft and c.author == user)
+
+  results = []
+  tbp = []
+  tbd = []
+  delta = 0
+  for draft in drafts:
+    patch = patches[draft['patch_id']]
+    comment = None
+    if draft['message_id']:
+      comment = existing.get(db.Key.from_path(
+          'Comment', draft['message_id'], parent=patch.key()))
+    if not draft['text'].rstrip():
+      if comment is not None:
+        tbd.append(comment)
+        delta -= 1
+      results.append({'message_id': None})
+      continue
+    if comment is None:
+      # Prefix with 'z' to avoid key names starting with digits.
+      message_id = 'z' + binascii.hexlify(_random_bytes(16))
+      comment = models.Comment(key_name=message_id, parent=patch)
+      comment.message_id = message_id
+      delta += 1
+    comment.patch = patch
+    comment.lineno = draft['lineno']
+    comment.left = draft['left']
+    comment.text = db.Text(draft['text'])
+    comment.calculate_buckets()
+    tbp.append(comment)
+    results.append({'message_id': comment.message_id})
+
+  if tbp:
+    db.put(tbp)
+  if tbd:
+    db.delete(tbd)
+  if delta:
+    remaining = issue.update_draft_count(user, delta)
+    models.Account.current_user_account.update_drafts(issue, remaining > 0)
+  elif tbp:
+    models.Account.current_user_account.update_drafts(issue, True)
+  return results
 
 
 @deco.require_methods('POST')
@@ -2550,18 +2730,16 @@ def _inline_draft(request):
   comment = _add_or_update_comment(user=request.user, issue=issue, patch=patch,
                                    lineno=lineno, left=left,
                                    text=text, message_id=message_id)
-  issue.calculate_draft_count_by_user()
-  issue_fut = db.put_async(issue)
-
+  # The draft count was updated by _add_or_update_comment(). An ancestor
+  # query sees the comment that was just written.
   query = models.Comment.gql(
-      'WHERE patch = :patch AND lineno = :lineno AND left = :left '
-      'ORDER BY date',
+      'WHERE ANCESTOR IS :patch AND lineno = :lineno AND left = :left',
       patch=patch, lineno=lineno, left=left)
-  comments = list(c for c in query if not c.draft or c.author == request.user)
+  comments = [c for c in query if not c.draft or c.author == request.user]
+  comments.sort(key=lambda c: c.date)
   if comment is not None and comment.author is None:
     # Show anonymous draft even though we don't save it
     comments.append(comment)
-  issue_fut.get_result()
   if not comments:
     return HttpTextResponse(' ')
   for c in comments:
@@ -2579,6 +2757,22 @@ def _inline_draft(request):
                             context_instance=RequestContext(request))
 
 
+def _get_last_patchset(issue):
+  """Returns the most recent PatchSet of an issue, or None."""
+  return issue.patchset_set.order('-created').get()
+
+
+def _get_file_summary(patchset):
+  """Returns the file list and line counts of a patch set.
+
+  Older patch sets don't have them stored, they are computed and saved.
+  """
+  if patchset.total_added is None:
+    patchset.update_file_summary()
+    patchset.put()
+  return patchset.files, patchset.total_added, patchset.total_removed
+
+
 def _get_affected_files(issue, full_diff=False):
   """Helper to return a list of affected files from the latest patchset.
 
@@ -2591,22 +2785,12 @@ def _get_affected_files(issue, full_diff=False):
     is less than 100 lines (otherwise the second item is an empty string).
   """
   files = []
-  modified_count = 0
   diff = ''
-  patchsets = list(issue.patchsets)
-  if len(patchsets):
-    patchset = patchsets[-1]
-    for patch in patchset.patches:
-      file_str = ''
-      if patch.status:
-        file_str += patch.status + ' '
-      file_str += patch.filename
-      files.append(file_str)
-      # No point in loading patches if the patchset is too large for email.
-      if full_diff or modified_count < 100:
-        modified_count += patch.num_added + patch.num_removed
-
-    if full_diff or modified_count < 100:
+  patchset = _get_last_patchset(issue)
+  if patchset is not None:
+    files, added, removed = _get_file_summary(patchset)
+    files = list(files)
+    if full_diff or added + removed < 100:
       diff = patchset.data
 
   return files, diff
@@ -2621,8 +2805,12 @@ def _get_mail_template(request, issue, full_diff=False):
   context = {}
   template = 'mails/comment.txt'
   if request.user == issue.owner:
-    if db.GqlQuery('SELECT * FROM Message WHERE ANCESTOR IS :1 AND sender = :2',
-                   issue, db.Email(request.user.email())).count(1) == 0:
+    if issue.owner_mailed is None:
+      # Issues created before owner_mailed existed.
+      issue.owner_mailed = db.GqlQuery(
+          'SELECT __key__ FROM Message WHERE ANCESTOR IS :1 AND sender = :2',
+          issue, db.Email(request.user.email())).count(1) > 0
+    if not issue.owner_mailed:
       template = 'mails/review.txt'
       files, patch = _get_affected_files(issue, full_diff)
       context.update({'files': files, 'patch': patch, 'base': issue.base})
@@ -2749,6 +2937,7 @@ def delete_drafts(request):
   db.delete(query)
   request.issue.calculate_draft_count_by_user()
   request.issue.put()
+  models.Account.current_user_account.update_drafts(request.issue, False)
   return HttpResponseRedirect(
     reverse(publish, args=[request.issue.key().id()]))
 
@@ -2776,31 +2965,44 @@ def _get_draft_comments(request, issue, preview=False):
   """
   comments = []
   tbd = []
-  # XXX Should request all drafts for this issue once, now we can.
-  for patchset in issue.patchsets:
-    ps_comments = list(models.Comment.gql(
-        'WHERE ANCESTOR IS :1 AND author = :2 AND draft = TRUE',
-        patchset, request.user))
-    if ps_comments:
-      patches = dict((p.key(), p) for p in patchset.patches)
-      for p in patches.itervalues():
-        p.patchset = patchset
-      for c in ps_comments:
-        c.draft = False
-        # Get the patch key value without loading the patch entity.
-        # NOTE: Unlike the old version of this code, this is the
-        # recommended and documented way to do this!
-        pkey = models.Comment.patch.get_value_for_datastore(c)
-        if pkey in patches:
-          patch = patches[pkey]
-          c.patch = patch
-      if not preview:
-        tbd.append(ps_comments)
-        patchset.update_comment_count(len(ps_comments))
-        tbd.append(patchset)
-      ps_comments.sort(key=lambda c: (c.patch.filename, not c.left,
-                                      c.lineno, c.date))
-      comments += ps_comments
+  drafts = models.Comment.gql(
+      'WHERE ANCESTOR IS :1 AND author = :2 AND draft = TRUE',
+      issue, request.user).fetch(None)
+  if not drafts:
+    return tbd, comments
+  # Get the patch key values without loading the patch entities, then load
+  # only the patches and patch sets having drafts in a single db.get().
+  # NOTE: Unlike the old version of this code, this is the
+  # recommended and documented way to do this!
+  patch_keys = list(set(
+      models.Comment.patch.get_value_for_datastore(c) for c in drafts))
+  patchset_keys = list(set(c.key().parent().parent() for c in drafts))
+  entities = db.get(patch_keys + patchset_keys)
+  patches = dict(
+      (p.key(), p) for p in entities[:len(patch_keys)] if p is not None)
+  patchsets = dict(
+      (ps.key(), ps) for ps in entities[len(patch_keys):] if ps is not None)
+  for p in patches.itervalues():
+    if p.key().parent() in patchsets:
+      p.patchset = patchsets[p.key().parent()]
+  drafts_by_patchset = {}
+  for c in drafts:
+    drafts_by_patchset.setdefault(c.key().parent().parent(), []).append(c)
+
+  for patchset in sorted(patchsets.itervalues(), key=lambda ps: ps.created):
+    ps_comments = drafts_by_patchset[patchset.key()]
+    for c in ps_comments:
+      c.draft = False
+      pkey = models.Comment.patch.get_value_for_datastore(c)
+      if pkey in patches:
+        c.patch = patches[pkey]
+    if not preview:
+      tbd.append(ps_comments)
+      patchset.update_comment_count(len(ps_comments))
+      tbd.append(patchset)
+    ps_comments.sort(key=lambda c: (c.patch.filename, not c.left,
+                                    c.lineno, c.date))
+    comments += ps_comments
   return tbd, comments
 
 
@@ -2818,13 +3020,81 @@ def _patchlines2cache(patchlines, left):
   return dict(it)
 
 
+def _get_line_offsets(content):
+  """Returns the offsets of the lines of a Content's text.
+
+  The returned array holds the offset of the start of each line followed by
+  the length of the text, so line n is text[offsets[n - 1]:offsets[n]]. It is
+  cached in memcache by the checksum of the content.
+  """
+  key = None
+  if content.checksum:
+    key = 'line_offsets:' + content.checksum
+    data = memcache.get(key)
+    if data is not None:
+      offsets = array.array('I')
+      offsets.fromstring(data)
+      return offsets
+  offsets = array.array('I', [0])
+  total = 0
+  for line in (content.text or '').splitlines(True):
+    total += len(line)
+    offsets.append(total)
+  if key:
+    memcache.set(key, offsets.tostring(), 3600)
+  return offsets
+
+
+def _get_patch_lines(patch, left, linenos):
+  """Returns a dict mapping line numbers of one side of a patch to lines.
+
+  Lines shown in the diff are taken from the patch itself. The other ones are
+  sliced out of the base file; lines of the new file are mapped back to the
+  base file through the diff chunks, so the patched content is never
+  generated here.
+
+  Args:
+    patch: a Patch instance.
+    left: True for the base file, False for the patched file.
+    linenos: set of line numbers to look up.
+
+  Raises:
+    FetchError: If the base file is needed but can't be fetched.
+  """
+  lines = {}
+  for old, new, line in patching.ParsePatchToLines(patch.lines) or []:
+    lineno = old if left else new
+    if lineno in linenos:
+      lines[lineno] = line[1:]
+  missing = [n for n in linenos if n not in lines]
+  if not missing or patch.no_base_file:
+    return lines
+
+  base_linenos = dict((n, n) for n in missing)
+  if not left:
+    chunks = patching.ParsePatchToChunks(patch.lines, patch.filename) or []
+    for n in missing:
+      for (_, old_j), (_, new_j), _, _ in chunks:
+        if new_j < n:
+          base_linenos[n] = n - new_j + old_j
+  content = patch.get_content()
+  offsets = _get_line_offsets(content)
+  for n, base in base_linenos.iteritems():
+    if 0 < base < len(offsets):
+      lines[n] = content.text[offsets[base - 1]:offsets[base]]
+  return lines
+
+
 def _get_draft_details(request, comments):
   """Helper to display comments with context in the email message."""
+  # Maps (c.patch.key(), c.left) to the line numbers to quote.
+  wanted = {}
+  for c in comments:
+    wanted.setdefault((c.patch.key(), c.left), set()).add(c.lineno)
+
   last_key = None
   output = []
   linecache = {}  # Maps (c.patch.key(), c.left) to mapping (lineno, line)
-  modified_patches = []
-  fetch_base_failed = False
 
   for c in comments:
     if (c.patch.key(), c.left) != last_key:
@@ -2835,22 +3105,12 @@ def _get_draft_details(request, comments):
       output.append('\n%s\nFile %s (%s):' % (url, c.patch.filename,
                                              c.left and "left" or "right"))
       last_key = (c.patch.key(), c.left)
-      patch = c.patch
-      if patch.no_base_file:
+      try:
+        linecache[last_key] = _get_patch_lines(c.patch, c.left,
+                                               wanted[last_key])
+      except FetchError:
         linecache[last_key] = _patchlines2cache(
-          patching.ParsePatchToLines(patch.lines), c.left)
-      else:
-        try:
-          if c.left:
-            old_lines = patch.get_content().text.splitlines(True)
-            linecache[last_key] = dict(enumerate(old_lines, 1))
-          else:
-            new_lines = patch.get_patched_content().text.splitlines(True)
-            linecache[last_key] = dict(enumerate(new_lines, 1))
-        except FetchError:
-          linecache[last_key] = _patchlines2cache(
-            patching.ParsePatchToLines(patch.lines), c.left)
-          fetch_base_failed = True
+          patching.ParsePatchToLines(c.patch.lines), c.left)
     context = linecache[last_key].get(c.lineno, '').strip()
     url = request.build_absolute_uri(
       '%s#%scode%d' % (reverse(diff, args=[request.issue.key().id(),
@@ -2860,24 +3120,26 @@ def _get_draft_details(request, comments):
                        c.lineno))
     output.append('\n%s\n%s:%d: %s\n%s' % (url, c.patch.filename, c.lineno,
                                            context, c.text.rstrip()))
-  if modified_patches:
-    db.put(modified_patches)
   return '\n'.join(output)
 
 
 def _get_modified_counts(issue):
   """Helper to determine the modified line counts of the latest patch set."""
-  modified_added_count = 0
-  modified_removed_count = 0
+  patchset = _get_last_patchset(issue)
+  if patchset is None:
+    return 0, 0
+  _, added, removed = _get_file_summary(patchset)
+  return added, removed
 
-  # Count the modified lines in the patchset.
-  patchsets = list(issue.patchsets)
-  if patchsets:
-    for patch in patchsets[-1].patches:
-      modified_added_count += patch.num_added
-      modified_removed_count += patch.num_removed
 
-  return modified_added_count, modified_removed_count
+def _get_issue_recipients(issue):
+  """Returns the addresses Issue.updates_for is derived from.
+
+  When they change, Issue.recalculate_updates_for() must be called, since
+  Issue.calculate_updates_for() only applies new messages.
+  """
+  return (set(issue.reviewers), set(issue.cc),
+          set(issue.collaborator_emails()))
 
 
 def _make_message(request, issue, message, comments=None, send_mail=False,
@@ -2885,6 +3147,8 @@ def _make_message(request, issue, message, comments=None, send_mail=False,
   """Helper to create a Message instance and optionally send an email."""
   attach_patch = request.POST.get("attach_patch") == "yes"
   template, context = _get_mail_template(request, issue, full_diff=attach_patch)
+  if request.user == issue.owner:
+    issue.owner_mailed = True
   # Decide who should receive mail
   my_email = db.Email(request.user.email())
   to = ([db.Email(issue.owner.email())] +
@@ -2930,7 +3194,10 @@ def _make_message(request, issue, message, comments=None, send_mail=False,
     msg.draft = False
     msg.date = datetime.datetime.now()
     msg.issue_was_closed = issue.closed
+  msg.calculate_approval_flags(issue)
   issue.calculate_updates_for(msg)
+  # The callers put the message right away.
+  msg.record_activity()
 
   if in_reply_to:
     try:
@@ -2950,6 +3217,7 @@ def _make_message(request, issue, message, comments=None, send_mail=False,
       del context['files'][200:]
       context['files'].append('[[ %d additional files ]]' % num_trimmed)
     url = request.build_absolute_uri(reverse(show, args=[issue.key().id()]))
+    library.prefetch_nicknames(issue.reviewers + cc + [request.user], request)
     reviewer_nicknames = ', '.join(library.get_nickname(rev_temp, True,
                                                         request)
                                    for rev_temp in issue.reviewers)
@@ -2990,33 +3258,74 @@ def _make_message(request, issue, message, comments=None, send_mail=False,
       send_args['attachments'] = [('issue_%s_patch.diff' % issue.key().id(),
                                    patch)]
 
-    attempts = 0
-    while True:
-      try:
-        mail.send_mail(**send_args)
-        break
-      except mail.InvalidSenderError:
-        if django_settings.RIETVELD_INCOMING_MAIL_ADDRESS:
-          previous_sender = send_args['sender']
-          if previous_sender not in send_args['to']:
-            send_args['to'].append(previous_sender)
-          send_args['sender'] = django_settings.RIETVELD_INCOMING_MAIL_ADDRESS
-        else:
-          raise
-      except apiproxy_errors.DeadlineExceededError:
-        # apiproxy_errors.DeadlineExceededError is raised when the
-        # deadline of an API call is reached (e.g. for mail it's
-        # something about 5 seconds). It's not the same as the lethal
-        # runtime.DeadlineExeededError.
-        attempts += 1
-        if attempts >= 3:
-          raise
-    if attempts:
-      logging.warning("Retried sending email %s times", attempts)
+    _queue_mail(send_args)
 
   return msg
 
 
+def _queue_mail(send_args):
+  """Queues a mail to be sent by task_send_mail().
+
+  Sending mail is slow, so it is done outside of the user's request. The
+  send-mail queue retries failed deliveries with exponential backoff. Mails
+  that don't fit in a task are sent right away.
+
+  Args:
+    send_args: keyword arguments for mail.send_mail().
+  """
+  payload = dict(send_args)
+  if 'attachments' in payload:
+    payload['attachments'] = [(name, base64.b64encode(_encode_safely(data)))
+                              for name, data in payload['attachments']]
+  try:
+    taskqueue.add(url=reverse(task_send_mail), payload=json.dumps(payload),
+                  queue_name='send-mail')
+  except (UnicodeDecodeError, taskqueue.TaskTooLargeError), err:
+    logging.warning('Sending mail synchronously: %s', err)
+    _send_mail(send_args)
+
+
+def _send_mail(send_args):
+  """Sends a mail, retrying from the incoming mail address if needed."""
+  while True:
+    try:
+      mail.send_mail(**send_args)
+      return
+    except mail.InvalidSenderError:
+      if django_settings.RIETVELD_INCOMING_MAIL_ADDRESS:
+        previous_sender = send_args['sender']
+        if previous_sender not in send_args['to']:
+          send_args['to'].append(previous_sender)
+        send_args['sender'] = django_settings.RIETVELD_INCOMING_MAIL_ADDRESS
+      else:
+        raise
+
+
+@deco.task_queue_required('send-mail')
+def task_send_mail(request):
+  """/restricted/tasks/send_mail - Sends a mail queued by _queue_mail().
+
+  Transient errors, like apiproxy_errors.DeadlineExceededError when the mail
+  API is slow or mail.InternalTransientError, are propagated so the task is
+  retried. The other mail.Error are raised for invalid mails, which would
+  fail again, so they are only logged.
+  """
+  send_args = dict((str(k), v)
+                   for k, v in json.loads(request.raw_post_data).iteritems())
+  if 'attachments' in send_args:
+    send_args['attachments'] = [(name, base64.b64decode(data))
+                                for name, data in send_args['attachments']]
+  logging.info('Mail: to=%s', ', '.join(send_args['to']))
+  try:
+    _send_mail(send_args)
+  except mail.InternalTransientError:
+    raise
+  except mail.Error:
+    logging.exception(
+        'Dropping undeliverable mail: %s', send_args.get('subject'))
+  return HttpResponse()
+
+
 @deco.require_methods('POST')
 @deco.login_required
 @deco.xsrf_required
@@ -3618,6 +3927,9 @@ def _process_incoming_mail(raw_message, recipients):
                        date=datetime.datetime.now(),
                        text=db.Text(body),
                        draft=False)
+  msg.calculate_approval_flags(issue)
+  if msg.sender_is_owner:
+    issue.owner_mailed = True
 
   # Add sender to reviewers if needed.
   all_emails = [str(x).lower()
@@ -3636,6 +3948,7 @@ def _process_incoming_mail(raw_message, recipients):
   issue.calculate_updates_for(msg)
   issue.put()
   msg.put()
+  msg.record_activity()
 
 
 @deco.login_required
@@ -3871,6 +4184,117 @@ def set_client_id_and_secret(request):
 
 DATE_FORMAT = '%Y-%m-%d'
 
+# Number of issues fetched concurrently when updating the daily stats.
+STATS_ISSUES_IN_FLIGHT = 20
+
+# Number of parallel tasks used by a parallel statistics backfill, the
+# max_concurrent_requests of the update-stats-backfill queue.
+STATS_BACKFILL_SHARDS = 10
+
+# Account key names splitting a parallel score refresh in ranges. The key names
+# are '<email>'.
+STATS_REFRESH_BOUNDARIES = ['<d', '<h', '<l', '<p', '<t']
+
+# How long figure_out_real_accounts() remembers an email address in memcache.
+# An account that created an issue stays real, while a role account is looked
+# up again every day in case it starts creating issues.
+REAL_ACCOUNT_CACHE_TIME = 7 * 24 * 60 * 60
+FAKE_ACCOUNT_CACHE_TIME = 24 * 60 * 60
+
+# Phases of update_daily_stats() reported by StatsProfile. 'message scan'
+# includes the queries of the Message of each issue, 'stats merge' is the
+# update of the AccountStatsDay entities in memory and 'puts' includes fetching
+# them.
+STATS_PHASES = (
+  'message scan',
+  'issue fetch',
+  'account classification',
+  'latency computation',
+  'stats merge',
+  'puts',
+  'other',
+)
+
+
+class StatsProfile(object):
+  """Wall time and datastore RPC count per phase of a statistics task.
+
+  Used as a context manager around the task. Only one profile is active at a
+  time and the code reports its phases with stats_phase(). Phases can nest;
+  the time and RPCs of the inner phase are not accounted to the outer one.
+  Everything outside any phase is accounted to 'other'.
+  """
+  active = None
+
+  def __init__(self):
+    self.seconds = dict.fromkeys(STATS_PHASES, 0.)
+    self.rpcs = dict.fromkeys(STATS_PHASES, 0)
+    self._stack = ['other']
+    self._last = None
+
+  def __enter__(self):
+    # testbed replaces the apiproxy, so register the hook every time. Append()
+    # ignores a hook already registered.
+    apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(
+        'stats_profile', _count_stats_rpc, 'datastore_v3')
+    StatsProfile.active = self
+    self._last = time.time()
+    return self
+
+  def __exit__(self, *_):
+    self._flush()
+    StatsProfile.active = None
+
+  def _flush(self):
+    now = time.time()
+    self.seconds[self._stack[-1]] += now - self._last
+    self._last = now
+
+  def push(self, phase):
+    self._flush()
+    self._stack.append(phase)
+
+  def pop(self):
+    self._flush()
+    self._stack.pop()
+
+  def count_rpc(self):
+    self.rpcs[self._stack[-1]] += 1
+
+  def to_dict(self):
+    return dict(
+        (phase, {'seconds': round(self.seconds[phase], 3),
+                 'rpcs': self.rpcs[phase]})
+        for phase in STATS_PHASES)
+
+  def to_text(self):
+    return ''.join(
+        '%s: %.3fs, %d RPCs\n' % (phase, self.seconds[phase], self.rpcs[phase])
+        for phase in STATS_PHASES)
+
+
+def _count_stats_rpc(_service, _call, _request, _response):
+  """apiproxy hook counting the datastore RPCs of the active StatsProfile."""
+  if StatsProfile.active:
+    StatsProfile.active.count_rpc()
+
+
+@contextlib.contextmanager
+def stats_phase(phase):
+  """Accounts the enclosed code to |phase| of the active StatsProfile, if any.
+
+  Must not enclose a yield, the consumer's code would be accounted to |phase|.
+  """
+  profile = StatsProfile.active
+  if profile is None:
+    yield
+    return
+  profile.push(phase)
+  try:
+    yield
+  finally:
+    profile.pop()
+
 
 def update_stats(request):
   """Endpoint that will trigger a taskqueue to update the score of all
@@ -3907,21 +4331,31 @@ def update_stats(request):
   tasks_to_trigger = filter(None, (t.strip().lower() for t in tasks_to_trigger))
   today = datetime.datetime.utcnow().date()
 
+  # 'parallel' as the first item fans out the work over parallel tasks.
+  parallel = bool(tasks_to_trigger) and tasks_to_trigger[0] == 'parallel'
+  if parallel:
+    tasks_to_trigger = tasks_to_trigger[1:]
+
   tasks = []
   if not tasks_to_trigger:
     msg = 'No task to trigger.'
   # Special case 'refresh'.
   elif (len(tasks_to_trigger) == 1 and
         tasks_to_trigger[0] in ('destroy', 'refresh')):
-    taskqueue.add(
-        url=reverse(task_refresh_all_stats_score),
-        params={'destroy': str(int(tasks_to_trigger[0] == 'destroy'))},
-        queue_name='refresh-all-stats-score')
-    msg = 'Triggered %s.' % tasks_to_trigger[0]
+    destroy = tasks_to_trigger[0] == 'destroy'
+    if parallel:
+      count = start_stats_score_refresh(destroy)
+      msg = 'Triggered %s in %d parallel tasks.' % (tasks_to_trigger[0], count)
+    else:
+      taskqueue.add(
+          url=reverse(task_refresh_all_stats_score),
+          params={'destroy': str(int(destroy))},
+          queue_name='refresh-all-stats-score')
+      msg = 'Triggered %s.' % tasks_to_trigger[0]
   else:
     tasks = []
     for task in tasks_to_trigger:
-      if task in ('monthly', '30'):
+      if task in ('monthly', '30', 'rollups'):
         tasks.append(task)
       elif models.verify_account_statistics_name(task):
         if task.count('-') == 2:
@@ -3938,8 +4372,14 @@ def update_stats(request):
         msg = 'Invalid item.'
         break
     else:
+      days = [t for t in tasks if t.count('-') == 2]
       if len(set(tasks)) != len(tasks):
         msg = 'Duplicate items found.'
+      elif parallel and days:
+        followup = [t for t in tasks if t.count('-') != 2]
+        backfill = start_stats_backfill(days, followup, today)
+        msg = 'Triggered backfill %d of %d days, then: %s.' % (
+            backfill.key.id(), len(days), ', '.join(backfill.followup))
       else:
         taskqueue.add(
             url=reverse(task_update_stats),
@@ -3959,6 +4399,8 @@ def cron_update_yesterday_stats(_request):
   - Triggers a task to update daily summaries.
   - This task will then trigger a task to update rolling summaries.
   - This task will then trigger a task to update monthly summaries.
+  - Until it completed once, the monthly task then triggers the 'rollups'
+    task to create the quarter and year rollups of the older months.
 
   Using 3 separate tasks to space out datastore contention and reduces the
   scope of each task so the complete under 10 minutes, making retries softer
@@ -3968,6 +4410,9 @@ def cron_update_yesterday_stats(_request):
   today = datetime.datetime.utcnow().date()
   day = str(today - datetime.timedelta(days=1))
   tasks = [day, '30', 'monthly']
+  if not models.StatsRollups.is_complete():
+    # Create the rollups of the months summarized before they existed.
+    tasks.append('rollups')
   taskqueue.add(
       url=reverse(task_update_stats),
       params={'tasks': json.dumps(tasks), 'date': str(today)},
@@ -3984,6 +4429,9 @@ def figure_out_real_accounts(people_involved, people_caches):
   lists never create an issue, so assume that a reviewer that never created an
   issue is a nobody.
 
+  The classification is also kept in memcache, so that only the email
+  addresses not seen in the last stats runs are looked up in the datastore.
+
   Arguments:
     people_involved: set or list of email addresses to scan.
     people_caches: a lookup cache of already resolved email addresses.
@@ -4000,20 +4448,40 @@ def figure_out_real_accounts(people_involved, people_caches):
   people_involved -= people_caches['fake']
 
   # People we are still unsure about that need to be looked up.
-  people_to_look_for = list(people_involved - people_caches['real'])
+  people_to_look_for = people_involved - people_caches['real']
+  if not people_to_look_for:
+    return people_involved
+
+  cached = memcache.get_multi(people_to_look_for, key_prefix='real_account:')
+  for account_email, is_real in cached.iteritems():
+    if is_real:
+      people_caches['real'].add(account_email)
+    else:
+      people_caches['fake'].add(account_email)
+      people_involved.remove(account_email)
+  people_to_look_for = list(people_to_look_for - set(cached))
 
   futures = [
     models.Issue.all(keys_only=True).filter('owner =', users.User(r)).run(
         limit=1)
     for r in people_to_look_for
   ]
+  found = {True: {}, False: {}}
   for i, future in enumerate(futures):
     account_email = people_to_look_for[i]
     if not list(future):
       people_caches['fake'].add(account_email)
       people_involved.remove(account_email)
+      found[False][account_email] = False
     else:
       people_caches['real'].add(account_email)
+      found[True][account_email] = True
+  if found[True]:
+    memcache.set_multi(
+        found[True], REAL_ACCOUNT_CACHE_TIME, key_prefix='real_account:')
+  if found[False]:
+    memcache.set_multi(
+        found[False], FAKE_ACCOUNT_CACHE_TIME, key_prefix='real_account:')
   return people_involved
 
 
@@ -4142,6 +4610,152 @@ def process_issue(
   return -1, lgtms, models.AccountStatsBase.IGNORED
 
 
+def yield_issues_for_day(day_to_process, issues, messages_looked_up):
+  """Yields every Issue with a Message sent on day_to_process.
+
+  The issues are read from the models.DayActivity index of the day. Days up to
+  the deploy of the index are not completely recorded, see
+  models.DayActivityStart. Their Message keys, like the ones of a day without
+  any DayActivity entity, are walked in date order instead.
+
+  The data for the next STATS_ISSUES_IN_FLIGHT issues is fetched concurrently,
+  so the caller works on one issue while the following ones are being loaded.
+
+  Arguments:
+  - issues: set() of all the Issue touched, updated as issues are yielded.
+  - messages_looked_up: list of one int to count the number of Message looked
+    up.
+
+  Yields:
+   - tuple issue, messages where messages are the issue's Message sorted by
+     date, up to day_to_process.
+  """
+  day_end = day_to_process + datetime.timedelta(days=1)
+  day = str(day_to_process.date())
+  activities = None
+  with stats_phase('message scan'):
+    if models.DayActivity.is_complete(day):
+      activities = filter(
+          None, ndb.get_multi(models.DayActivity.get_keys(day)))
+  if activities:
+    issue_ids = sorted(
+        set(itertools.chain.from_iterable(a.issues for a in activities)))
+    return _yield_indexed_issues(
+        day_to_process, day_end, issue_ids, issues, messages_looked_up)
+  return _yield_scanned_issues(
+      day_to_process, day_end, issues, messages_looked_up)
+
+
+def _get_messages_until_async(issue_key, day_end):
+  """Starts fetching the Message of an issue sent before day_end."""
+  return models.Message.all().ancestor(issue_key).filter(
+      'date <', day_end).run(batch_size=1000)
+
+
+def _yield_indexed_issues(
+    day_to_process, day_end, issue_ids, issues, messages_looked_up):
+  """Yields the issues listed in the DayActivity index of day_to_process."""
+  issue_ids = collections.deque(issue_ids)
+  # Each item is a tuple (issue_id, issue_future, messages_future).
+  pending = collections.deque()
+  while issue_ids or pending:
+    with stats_phase('issue fetch'):
+      while issue_ids and len(pending) < STATS_ISSUES_IN_FLIGHT:
+        issue_id = issue_ids.popleft()
+        if issue_id in issues:
+          continue
+        issue_key = db.Key.from_path('Issue', issue_id)
+        with stats_phase('message scan'):
+          messages_future = _get_messages_until_async(issue_key, day_end)
+        pending.append((issue_id, db.get_async(issue_key), messages_future))
+      if not pending:
+        break
+      issue_id, issue_future, messages_future = pending.popleft()
+      with stats_phase('message scan'):
+        messages = sorted(messages_future, key=lambda x: x.date)
+      on_day = sum(1 for m in messages if m.date >= day_to_process)
+      issue = issue_future.get_result()
+    if not issue or not on_day:
+      # The issue was deleted or the Message failed to be saved.
+      continue
+    messages_looked_up[0] += on_day
+    issues.add(issue_id)
+    yield issue, messages
+
+
+def _yield_scanned_issues(day_to_process, day_end, issues, messages_looked_up):
+  """Yields the issues found by walking the Message of day_to_process."""
+  day_to_process_date = day_to_process.date()
+  # Issues being fetched, in order. Each item is a tuple
+  # (messages_looked_up, issue_id, message_future, issue_future,
+  # messages_future) where messages_looked_up is the count when the issue was
+  # queued.
+  pending = collections.deque()
+  queued = set()
+  message_keys = collections.deque()
+  cursor = None
+  more = True
+  while True:
+    with stats_phase('issue fetch'):
+      while more and len(pending) < STATS_ISSUES_IN_FLIGHT:
+        if not message_keys:
+          query = models.Message.all(keys_only=True).filter(
+              'date >=', day_to_process).order('date')
+          # Someone sane would ask: why the hell do this? I don't know
+          # either but that's the only way to not have it throw an exception
+          # after 60 seconds.
+          if cursor:
+            query.with_cursor(start_cursor=cursor)
+          with stats_phase('message scan'):
+            message_keys.extend(query.fetch(100))
+          if not message_keys:
+            # We're done, no more cursor.
+            more = False
+            break
+          cursor = query.cursor()
+        message_key = message_keys.popleft()
+        # messages_looked_up may be overcounted, as the messages on the next
+        # day on issues already processed will be accepted as valid, until a
+        # new issue is found.
+        messages_looked_up[0] += 1
+        issue_key = message_key.parent()
+        issue_id = issue_key.id()
+        if issue_id in issues or issue_id in queued:
+          # This issue was already processed.
+          continue
+        queued.add(issue_id)
+        # Aggressively fetch data concurrently.
+        with stats_phase('message scan'):
+          message_future = db.get_async(message_key)
+          messages_future = _get_messages_until_async(issue_key, day_end)
+        pending.append((
+            messages_looked_up[0],
+            issue_id,
+            message_future,
+            db.get_async(issue_key),
+            messages_future))
+
+      if not pending:
+        break
+      looked_up, issue_id, message_future, issue_future, messages_future = (
+          pending.popleft())
+      with stats_phase('message scan'):
+        message = message_future.get_result()
+      if message.date.date() > day_to_process_date:
+        # Now on the next day. It is important to stop, especially when
+        # looking at very old CLs. The issues queued after this one are
+        # discarded.
+        messages_looked_up[0] = looked_up - 1
+        break
+
+      # Make sure to not process this issue a second time.
+      issues.add(issue_id)
+      with stats_phase('message scan'):
+        messages = sorted(messages_future, key=lambda x: x.date)
+      issue = issue_future.get_result()
+    yield issue, messages
+
+
 def yield_people_issue_to_update(day_to_process, issues, messages_looked_up):
   """Yields all the combinations of user-day-issue that needs to be updated.
 
@@ -4163,111 +4777,74 @@ def yield_people_issue_to_update(day_to_process, issues, messages_looked_up):
   # dict((user, day) -> set(issue_id)) mapping of
   # the AccountStatsDay that will need to be recalculated.
   need_to_update = {}
-  # TODO(maruel): Use asynchronous programming to start moving on to the next
-  # issue right away. This means creating our own Future instances.
-
-  cursor = None
-  while True:
-    query = models.Message.all(keys_only=True).filter(
-        'date >=', day_to_process).order('date')
-    # Someone sane would ask: why the hell do this? I don't know either but
-    # that's the only way to not have it throw an exception after 60 seconds.
-    if cursor:
-      query.with_cursor(start_cursor=cursor)
-    message_keys = query.fetch(100)
-    if not message_keys:
-      # We're done, no more cursor.
-      break
-    cursor = query.cursor()
-    for message_key in message_keys:
-      # messages_looked_up may be overcounted, as the messages on the next day
-      # on issues already processed will be accepted as valid, until a new issue
-      # is found.
-      messages_looked_up[0] += 1
-      issue_key = message_key.parent()
-      issue_id = issue_key.id()
-      if issue_id in issues:
-        # This issue was already processed.
-        continue
 
-      # Aggressively fetch data concurrently.
-      message_future = db.get_async(message_key)
-      issue_future = db.get_async(issue_key)
-      messages_futures = models.Message.all().ancestor(issue_key).run(
-          batch_size=1000)
-      if message_future.get_result().date.date() > day_to_process_date:
-        # Now on the next day. It is important to stop, especially when looking
-        # at very old CLs.
-        messages_looked_up[0] -= 1
-        cursor = None
-        break
-
-      # Make sure to not process this issue a second time.
-      issues.add(issue_id)
-      issue = issue_future.get_result()
-      # Sort manually instead of using .order('date') to save one index. Strips
-      # off any Message after day_to_process.
-      messages = sorted(
-          (m for m in messages_futures if m.date.date() <= day_to_process_date),
-          key=lambda x: x.date)
-
-      # Updates the dict of the people-day pairs that will need to be updated.
-      issue_owner = issue.owner.email()
-      # Ignore issue.reviewers since it can change over time. Sadly m.recipients
-      # also contains people cc'ed so take care of these manually.
-      people_to_consider = set(m.sender for m in messages)
-      people_to_consider.add(issue_owner)
-      for m in messages:
-        for r in m.recipients:
-          if (any(n.sender == r for n in messages) or
-              r in issue.reviewers or
-              r not in issue.cc):
-            people_to_consider.add(r)
-
-      # 'issue_owner' is by definition a real account. Save one datastore
-      # lookup.
-      people_caches['real'].add(issue_owner)
-
-      for user in figure_out_real_accounts(people_to_consider, people_caches):
+  for issue, messages in yield_issues_for_day(
+      day_to_process, issues, messages_looked_up):
+    issue_id = issue.key().id()
+    # Updates the dict of the people-day pairs that will need to be updated.
+    issue_owner = issue.owner.email()
+    # Ignore issue.reviewers since it can change over time. Sadly m.recipients
+    # also contains people cc'ed so take care of these manually.
+    people_to_consider = set(m.sender for m in messages)
+    people_to_consider.add(issue_owner)
+    for m in messages:
+      for r in m.recipients:
+        if (any(n.sender == r for n in messages) or
+            r in issue.reviewers or
+            r not in issue.cc):
+          people_to_consider.add(r)
+
+    # 'issue_owner' is by definition a real account. Save one datastore
+    # lookup.
+    people_caches['real'].add(issue_owner)
+
+    with stats_phase('account classification'):
+      users_to_process = figure_out_real_accounts(
+          people_to_consider, people_caches)
+    for user in users_to_process:
+      with stats_phase('account classification'):
         message_index, drive_by = search_relevant_first_email_for_user(
             issue_owner, messages, user, people_caches)
-        if (message_index == None or
-            ( drive_by and
-              messages[message_index].sender == user and
-              not any(m.sender == issue_owner
-                      for m in messages[:message_index]))):
-          # There's no important message, calculate differently by using the
-          # issue creation date.
-          start = issue.created
-        else:
-          start = messages[message_index].date
-
-        # Note that start != day_to_process_date
-        start_str = str(start.date())
-        user_issue_set = need_to_update.setdefault((user, start_str), set())
-        if not issue_id in user_issue_set:
-          user_issue_set.add(issue_id)
+      if (message_index == None or
+          ( drive_by and
+            messages[message_index].sender == user and
+            not any(m.sender == issue_owner
+                    for m in messages[:message_index]))):
+        # There's no important message, calculate differently by using the
+        # issue creation date.
+        start = issue.created
+      else:
+        start = messages[message_index].date
+
+      # Note that start != day_to_process_date
+      start_str = str(start.date())
+      user_issue_set = need_to_update.setdefault((user, start_str), set())
+      if not issue_id in user_issue_set:
+        user_issue_set.add(issue_id)
+        with stats_phase('latency computation'):
           latency, lgtms, review_type = process_issue(
-              start, day_to_process_date, message_index, drive_by, issue_owner,
-              messages, user)
-          if review_type is None:
-            # process_issue() determined there is nothing to update.
-            continue
-          yield user, start_str, issue_id, latency, lgtms, review_type
-    if not cursor:
-      break
+              start, day_to_process_date, message_index, drive_by,
+              issue_owner, messages, user)
+        if review_type is None:
+          # process_issue() determined there is nothing to update.
+          continue
+        yield user, start_str, issue_id, latency, lgtms, review_type
 
 
 @deco.task_queue_required('update-stats')
 def task_update_stats(request):
   """Dispatches the relevant task to execute.
 
-  Can dispatch either update_daily_stats, update_monthly_stats or
-  update_rolling_stats.
+  Can dispatch either update_daily_stats, update_monthly_stats,
+  update_rolling_stats or update_all_stats_rollups.
+
+  With a non-empty 'dry_run' parameter, the daily statistics are computed
+  without being saved and the other tasks are skipped.
   """
   tasks = json.loads(request.POST.get('tasks'))
   date_str = request.POST.get('date')
   cursor = request.POST.get('cursor')
+  dry_run = bool(request.POST.get('dry_run'))
   countdown = 15
   if not tasks:
     msg = 'Nothing to execute!?'
@@ -4279,7 +4856,12 @@ def task_update_stats(request):
     logging.info('Running %s.', task)
     if task.count('-') == 2:
       out, cursor = update_daily_stats(
-          cursor, datetime.datetime.strptime(task, DATE_FORMAT))
+          cursor, datetime.datetime.strptime(task, DATE_FORMAT), dry_run)
+    elif dry_run:
+      msg = 'Dry run of %s is not supported, ignoring.' % task
+      cursor = ''
+      logging.warning(msg)
+      out = HttpTextResponse(msg)
     elif task == 'monthly':
       # The only reason day is used is in case a task queue spills over the next
       # day.
@@ -4290,6 +4872,8 @@ def task_update_stats(request):
           datetime.datetime.strptime(date_str, DATE_FORMAT)
           - datetime.timedelta(days=1)).date()
       out, cursor = update_rolling_stats(cursor, yesterday)
+    elif task == 'rollups':
+      out, cursor = update_all_stats_rollups(cursor)
     else:
       msg = 'Unknown task %s, ignoring.' % task
       cursor = ''
@@ -4301,21 +4885,305 @@ def task_update_stats(request):
       tasks.insert(0, task)
       countdown = 0
 
+  if out.status_code == 200 and not dry_run:
+    invalidate_leaderboard_cache()
   if out.status_code == 200 and tasks:
     logging.info('%d tasks to go!\n%s', len(tasks), ', '.join(tasks))
     # Space out the task queue execution by 15s to reduce the risk of
     # datastore inconsistency to get in the way, since no transaction is used.
     # This means to process a full month, it'll include 31*15s = 7:45 minutes
     # delay. 15s is not a lot but we are in an hurry!
+    params = {'tasks': json.dumps(tasks), 'date': date_str, 'cursor': cursor}
+    if dry_run:
+      params['dry_run'] = '1'
     taskqueue.add(
         url=reverse(task_update_stats),
-        params={'tasks': json.dumps(tasks), 'date': date_str, 'cursor': cursor},
+        params=params,
         queue_name='update-stats',
         countdown=countdown)
   return out
 
 
-def update_daily_stats(cursor, day_to_process):
+def start_stats_backfill(days, followup, today):
+  """Processes the daily statistics of |days| in parallel tasks.
+
+  The days are split in STATS_BACKFILL_SHARDS ranges of consecutive days, each
+  processed in order by a chain of tasks on the update-stats-backfill queue.
+  The progress of each range is checkpointed in its StatsBackfillShard. Once
+  every shard is done, the |followup| tasks are run through
+  task_update_stats().
+
+  Daily statistics of a review are stored on the day the review was requested,
+  so two shards can update the same AccountStatsDay. The backfill tasks merge
+  their results in transactions, see merge_day_stats().
+
+  Returns the StatsBackfill instance.
+  """
+  days = sorted(days)
+  shard_size = max(1, -(-len(days) // STATS_BACKFILL_SHARDS))
+  shards = [days[i:i+shard_size] for i in xrange(0, len(days), shard_size)]
+  backfill = models.StatsBackfill(shards=len(shards), followup=list(followup))
+  backfill.put()
+  ndb.put_multi([
+    models.StatsBackfillShard(
+        key=models.StatsBackfillShard.get_key(backfill.key.id(), index),
+        pending=shard)
+    for index, shard in enumerate(shards)
+  ])
+  for index, shard in enumerate(shards):
+    queue_stats_backfill_day(backfill.key.id(), index, shard, today)
+  return backfill
+
+
+def queue_stats_backfill_day(backfill_id, index, days, today):
+  """Adds the task processing the first of |days| for a StatsBackfillShard.
+
+  The task is named after the shard and the day, so a retried task cannot
+  queue the same day twice.
+  """
+  try:
+    taskqueue.add(
+        name='backfill-%d-%d-%s' % (backfill_id, index, days[0]),
+        url=reverse(task_backfill_stats),
+        params={
+          'backfill': str(backfill_id),
+          'shard': str(index),
+          'days': json.dumps(days),
+          'date': str(today),
+        },
+        queue_name='update-stats-backfill')
+  except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+    logging.warning(
+        'Backfill %d-%d of %s already queued.', backfill_id, index, days[0])
+
+
+@ndb.transactional
+def complete_stats_backfill_day(shard_key, day):
+  """Marks |day| as done in a StatsBackfillShard.
+
+  Returns True if the shard has no day left to process.
+  """
+  shard = shard_key.get()
+  if day in shard.pending:
+    shard.pending.remove(day)
+    shard.put()
+  return not shard.pending
+
+
+def finish_stats_backfill(backfill_key, date_str):
+  """Triggers the followup tasks of a StatsBackfill if all its shards are done.
+
+  Each shard calls it once its own progress is saved, so the last shard to
+  finish always sees all of them done.
+
+  Returns True if the followup tasks were triggered by this call.
+  """
+  backfill = backfill_key.get(use_cache=False, use_memcache=False)
+  shard_keys = [
+    models.StatsBackfillShard.get_key(backfill_key.id(), index)
+    for index in xrange(backfill.shards)
+  ]
+  shards = ndb.get_multi(shard_keys, use_cache=False, use_memcache=False)
+  if any(shard.pending for shard in shards):
+    return False
+  return trigger_stats_backfill_followup(backfill_key, date_str)
+
+
+@ndb.transactional
+def trigger_stats_backfill_followup(backfill_key, date_str):
+  """Triggers the followup tasks of a StatsBackfill once.
+
+  Returns True if the followup tasks were triggered by this call.
+  """
+  backfill = backfill_key.get()
+  if backfill.finished:
+    return False
+  backfill.finished = True
+  backfill.put()
+  if backfill.followup:
+    taskqueue.add(
+        url=reverse(task_update_stats),
+        params={'tasks': json.dumps(backfill.followup), 'date': date_str},
+        queue_name='update-stats',
+        transactional=True)
+  return True
+
+
+@deco.task_queue_required('update-stats-backfill')
+def task_backfill_stats(request):
+  """Processes the next day of a shard of a StatsBackfill.
+
+  See start_stats_backfill().
+  """
+  backfill_id = int(request.POST.get('backfill'))
+  index = int(request.POST.get('shard'))
+  days = json.loads(request.POST.get('days'))
+  date_str = request.POST.get('date')
+  shard_key = models.StatsBackfillShard.get_key(backfill_id, index)
+  shard = shard_key.get()
+  if not shard:
+    msg = 'Backfill %s not found, ignoring.' % shard_key.id()
+    logging.error(msg)
+    return HttpTextResponse(msg)
+
+  day = days.pop(0)
+  if day in shard.pending:
+    out, _ = update_daily_stats(
+        None, datetime.datetime.strptime(day, DATE_FORMAT), transactional=True)
+    if out.status_code != 200:
+      # Let the task queue retry it.
+      return out
+    invalidate_leaderboard_cache()
+  else:
+    out = HttpTextResponse('%s was already processed.' % day)
+  if (complete_stats_backfill_day(shard_key, day) and
+      finish_stats_backfill(
+          ndb.Key(models.StatsBackfill, backfill_id), date_str)):
+    logging.info('Backfill %d done.', backfill_id)
+  if days:
+    queue_stats_backfill_day(backfill_id, index, days, date_str)
+  return out
+
+
+def start_stats_score_refresh(destroy):
+  """Refreshes or destroys all the stats entities in parallel tasks.
+
+  Each task handles the accounts in one of the key name ranges delimited by
+  STATS_REFRESH_BOUNDARIES.
+
+  Returns the number of tasks started.
+  """
+  bounds = [None] + STATS_REFRESH_BOUNDARIES + [None]
+  for range_start, range_end in zip(bounds[:-1], bounds[1:]):
+    params = {'destroy': str(int(destroy))}
+    if range_start:
+      params['start'] = range_start
+    if range_end:
+      params['end'] = range_end
+    taskqueue.add(
+        url=reverse(task_refresh_all_stats_score),
+        params=params,
+        queue_name='update-stats-backfill')
+  return len(bounds) - 1
+
+
+def update_day_stats_item(item, index, issue_id, latency, lgtms, review_type):
+  """Updates an AccountStatsDay with a result of yield_people_issue_to_update().
+
+  Arguments:
+  - item: the AccountStatsDay to update.
+  - index: dict(issue_id -> position in item.issues), kept up to date.
+
+  Returns True if the item was modified and needs to be saved.
+  """
+  item.reset_aggregates()
+  i = index.get(issue_id)
+  if i is None:
+    # TODO(maruel): Sort?
+    index[issue_id] = len(item.issues)
+    item.issues.append(issue_id)
+    item.latencies.append(latency)
+    item.lgtms.append(lgtms)
+    item.review_types.append(review_type)
+    return True
+
+  # It was already there, update.
+  if (item.latencies[i] == latency and
+      item.lgtms[i] == lgtms and
+      item.review_types[i] == review_type):
+    # Was already calculated, skip.
+    return False
+
+  # Make sure to not "downgrade" the object.
+  if item.lgtms[i] > lgtms:
+    # Never lower the number of lgtms.
+    return False
+
+  if item.latencies[i] >= 0 and latency == -1:
+    # Unchanged or "lower priority", no need to store again.
+    return False
+
+  if (item.latencies[i] >= 0 and latency >= 0 and
+      item.latencies[i] != latency):
+    # That's rare, the new calculated latency doesn't match the previously
+    # calculated latency. File an error but let it go.
+    logging.error(
+        'New calculated latency doesn\'t match previously calculated '
+        'value.\n%s != %s\nItem %d in:\n%s',
+        item.latencies[i], latency, i, item)
+
+  item.latencies[i] = latency
+  item.lgtms[i] = lgtms
+  item.review_types[i] = review_type
+  return True
+
+
+def put_day_stats_entries(entries, keys, futures):
+  """Saves the AccountStatsDay entries for keys asynchronously.
+
+  An entry still being saved from a previous call is waited for first, so
+  the writes of one entity are never reordered. The new futures are appended
+  to futures.
+
+  Returns the number of entities saved.
+  """
+  for key in keys:
+    previous = entries[key]['future']
+    if previous is not None:
+      previous.wait()
+  new_futures = ndb.put_multi_async(
+      [entries[key]['item'] for key in keys], use_cache=False)
+  for key, future in zip(keys, new_futures):
+    entries[key]['future'] = future
+  futures.extend(new_futures)
+  return len(keys)
+
+
+def merge_day_stats(packets):
+  """Merges the results of yield_people_issue_to_update() in the
+  AccountStatsDay entities, one transaction per entity.
+
+  update_day_stats_item() is keyed by issue id, so the merge is the same
+  whatever the order the days are processed in. The transactions make it safe
+  when several tasks update the same entity at once.
+
+  Returns the number of entities saved.
+  """
+  # dict(AccountStatsDay key -> list of results).
+  results = {}
+  for packet in packets:
+    with stats_phase('stats merge'):
+      key = ndb.Key(
+          'Account', models.Account.get_id_for_email(packet[0]),
+          'AccountStatsDay', packet[1])
+      results.setdefault(key, []).append(packet[2:])
+
+  @ndb.tasklet
+  def merge(key):
+    item = yield key.get_async(use_cache=False)
+    item = item or models.AccountStatsDay(key=key)
+    index = dict((issue_id, i) for i, issue_id in enumerate(item.issues))
+    modified = False
+    for result in results[key]:
+      modified = update_day_stats_item(item, index, *result) or modified
+    if modified:
+      yield item.put_async(use_cache=False)
+    raise ndb.Return(modified)
+
+  total = 0
+  keys = sorted(results)
+  with stats_phase('puts'):
+    for i in xrange(0, len(keys), 100):
+      futures = [
+        ndb.transaction_async(lambda key=key: merge(key))
+        for key in keys[i:i+100]
+      ]
+      total += sum(1 for f in futures if f.get_result())
+  return total
+
+
+def update_daily_stats(
+    cursor, day_to_process, dry_run=False, transactional=False):
   """Updates the statistics about every reviewer for the day.
 
   Note that joe@google != joe@chromium, so make sure to always review with the
@@ -4326,97 +5194,97 @@ def update_daily_stats(cursor, day_to_process):
   - for each of them, update their statistics for the past day.
 
   There can be thousands of CLs modified in a single day so throughput
-  efficiency is important here, as it has only 10 minutes to complete.
+  efficiency is important here, as it has only 10 minutes to complete. The
+  time and datastore RPCs spent in each phase are logged and appended to the
+  response, see StatsProfile.
+
+  With dry_run, everything is computed but no AccountStatsDay is saved.
+
+  With transactional, the results are merged in each AccountStatsDay in a
+  transaction, so concurrent runs of other days don't lose updates, see
+  merge_day_stats().
   """
   assert not cursor, cursor
   start = time.time()
+  profile = StatsProfile()
   # Look at all messages sent in the day. The issues associated to these
   # messages are the issues we care about.
   issues = set()
   # Use a list so it can be modified inside the generator.
   messages_looked_up = [0]
   total = 0
-  try:
-    chunk_size = 10
-    max_futures = 200
-    futures = []
-    items = []
-    for packet in yield_people_issue_to_update(
-        day_to_process, issues, messages_looked_up):
-      user, day, issue_id, latency, lgtms, review_type = packet
-      account_key = ndb.Key('Account', models.Account.get_id_for_email(user))
-      found = False
-      for item in items:
-        # A user could touch multiple issues in a single day.
-        if item.key.id() == day and item.key.parent() == account_key:
-          found = True
-          break
-      else:
-        # Find the object and grab it. Do not use get_or_insert() to save a
-        # transaction and double-write.
-        item = models.AccountStatsDay.get_by_id(
-            day, parent=account_key, use_cache=False)
-        if not item:
-          # Create a new one.
-          item = models.AccountStatsDay(id=day, parent=account_key)
-
-      if issue_id in item.issues:
-        # It was already there, update.
-        i = item.issues.index(issue_id)
-
-        if (item.latencies[i] == latency and
-            item.lgtms[i] == lgtms and
-            item.review_types[i] == review_type):
-          # Was already calculated, skip.
-          continue
-
-        # Make sure to not "downgrade" the object.
-        if item.lgtms[i] > lgtms:
-          # Never lower the number of lgtms.
-          continue
-
-        if item.latencies[i] >= 0 and latency == -1:
-          # Unchanged or "lower priority", no need to store again.
-          continue
-
-        if (item.latencies[i] >= 0 and latency >= 0 and
-            item.latencies[i] != latency):
-          # That's rare, the new calculated latency doesn't match the previously
-          # calculated latency. File an error but let it go.
-          logging.error(
-              'New calculated latency doesn\'t match previously calculated '
-              'value.\n%s != %s\nItem %d in:\n%s',
-              item.latencies[i], latency, i, item)
-
-        item.latencies[i] = latency
-        item.lgtms[i] = lgtms
-        item.review_types[i] = review_type
+  with profile:
+    try:
+      chunk_size = 10
+      max_futures = 200
+      futures = []
+      # dict(AccountStatsDay key -> dict) of every entity touched in the run.
+      # The values hold the 'item', its 'index' mapping issue_id -> position in
+      # item.issues and the 'future' of its last put, if any.
+      entries = {}
+      # Keys of the entries modified since they were last saved.
+      dirty = []
+      packets = yield_people_issue_to_update(
+          day_to_process, issues, messages_looked_up)
+      if transactional and not dry_run:
+        total = merge_day_stats(packets)
       else:
-        # TODO(maruel): Sort?
-        item.issues.append(issue_id)
-        item.latencies.append(latency)
-        item.lgtms.append(lgtms)
-        item.review_types.append(review_type)
-
-      if not found:
-        items.append(item)
-        if len(items) == chunk_size:
-          futures.extend(ndb.put_multi_async(items, use_cache=False))
-          total += chunk_size
-          items = []
-          futures = [f for f in futures if not f.done()]
-          while len(futures) > max_futures:
-            # Slow down to limit memory usage.
-            ndb.Future.wait_any(futures)
-            futures = [f for f in futures if not f.done()]
-
-    if items:
-      futures.extend(ndb.put_multi_async(items, use_cache=False))
-      total += len(items)
-    ndb.Future.wait_all(futures)
-    result = 200
-  except (db.Timeout, DeadlineExceededError):
-    result = 500
+        window = list(itertools.islice(packets, chunk_size))
+        while window:
+          keys = [
+            ndb.Key(
+                'Account', models.Account.get_id_for_email(packet[0]),
+                'AccountStatsDay', packet[1])
+            for packet in window
+          ]
+          # Do not use get_or_insert() to save a transaction and double-write.
+          missing = list(set(k for k in keys if k not in entries))
+          with stats_phase('puts'):
+            get_futures = ndb.get_multi_async(missing, use_cache=False)
+          # Look for the next packets while the entities are being fetched.
+          next_window = list(itertools.islice(packets, chunk_size))
+          with stats_phase('puts'):
+            for key, future in zip(missing, get_futures):
+              # Create a new one if it wasn't found.
+              item = future.get_result() or models.AccountStatsDay(key=key)
+              entries[key] = {
+                'item': item,
+                'index': dict(
+                    (issue_id, i) for i, issue_id in enumerate(item.issues)),
+                'future': None,
+              }
+
+          with stats_phase('stats merge'):
+            for key, packet in zip(keys, window):
+              entry = entries[key]
+              if (update_day_stats_item(
+                      entry['item'], entry['index'], *packet[2:])
+                  and key not in dirty):
+                dirty.append(key)
+
+          with stats_phase('puts'):
+            if len(dirty) >= chunk_size:
+              if dry_run:
+                total += len(dirty)
+              else:
+                total += put_day_stats_entries(entries, dirty, futures)
+              dirty = []
+              futures = [f for f in futures if not f.done()]
+              while len(futures) > max_futures:
+                # Slow down to limit memory usage.
+                ndb.Future.wait_any(futures)
+                futures = [f for f in futures if not f.done()]
+          window = next_window
+
+        with stats_phase('puts'):
+          if dry_run:
+            total += len(dirty)
+          elif dirty:
+            total += put_day_stats_entries(entries, dirty, futures)
+          ndb.Future.wait_all(futures)
+      result = 200
+    except (db.Timeout, DeadlineExceededError):
+      result = 500
 
   out = (
       '%s\n'
@@ -4426,16 +5294,60 @@ def update_daily_stats(cursor, day_to_process):
       'In %.1fs\n') % (
         day_to_process.date(), messages_looked_up[0], len(issues),
         total, time.time() - start)
+  if dry_run:
+    out += 'Dry run, nothing saved\n'
+  out += profile.to_text()
   if result == 200:
     logging.info(out)
   else:
     logging.error(out)
+  logging.info(
+      'Stats profile: %s',
+      json.dumps(
+          {'day': str(day_to_process.date()), 'dry_run': dry_run,
+           'phases': profile.to_dict()},
+          sort_keys=True))
   return HttpTextResponse(out, status=result), ''
 
 
+def get_rolling_stats_accounts(duration, reference_day):
+  """Returns the sorted keys of the Account whose rolling summary may change.
+
+  These are:
+  - the accounts with an AccountStatsDay updated since reference_day, which
+    covers the day just computed and older days updated along with it.
+  - the accounts whose rolling summary holds days older than the window, so
+    days that fell out of the window are removed even if a run was skipped.
+  - the accounts with an AccountStatsDay for the day that just fell out of the
+    window, for the rolling summaries saved before first_day existed.
+  """
+  options = ndb.QueryOptions(keys_only=True)
+  since = datetime.datetime.combine(reference_day, datetime.time())
+  dropped_day = str(reference_day - datetime.timedelta(days=int(duration)))
+  queries = [
+    models.AccountStatsDay.query(
+        models.AccountStatsDay.modified >= since, default_options=options),
+    models.AccountStatsMulti.query(
+        models.AccountStatsMulti.name == duration,
+        models.AccountStatsMulti.first_day <= dropped_day,
+        default_options=options),
+    models.AccountStatsDay.query(
+        models.AccountStatsDay.name == dropped_day, default_options=options),
+  ]
+  account_keys = set()
+  for query in queries:
+    account_keys.update(k.parent() for k in query.iter(batch_size=1000))
+  return sorted(account_keys, key=lambda k: k.id())
+
+
 def update_rolling_stats(cursor, reference_day):
-  """Looks at all accounts and recreates all the rolling 30 days
-  AccountStatsMulti summaries.
+  """Updates the rolling 30 days AccountStatsMulti summaries of the accounts
+  that had activity.
+
+  Only the accounts returned by get_rolling_stats_accounts() are looked at,
+  so the work scales with the activity of the day instead of with the total
+  number of accounts. The cursor is the id of the last Account processed, the
+  accounts are processed in id order.
 
   Note that during the update, the leaderboard will be inconsistent.
 
@@ -4446,69 +5358,64 @@ def update_rolling_stats(cursor, reference_day):
   start = time.time()
   total = 0
   total_deleted = 0
+  accounts = 0
   try:
-    # Process *all* the accounts.
     duration = '30'
     chunk_size = 10
     futures = []
     items = []
     to_delete = []
-    accounts = 0
-    while True:
-      query = models.Account.all(keys_only=True)
-      if cursor:
-        query.with_cursor(start_cursor=cursor)
-      account_keys = query.fetch(100)
-      if not account_keys:
-        # We're done, no more cursor.
-        cursor = ''
-        break
-
-      a_key = ''
-      for a_key in account_keys:
-        accounts += 1
-        a_key = ndb.Key.from_old_key(a_key)
-        # TODO(maruel): If date of each issue was saved in the entity, this
-        # would not be necessary, assuming the entity doesn't become itself
-        # corrupted.
-        rolling_future = models.AccountStatsMulti.get_by_id_async(
-            duration, parent=a_key)
-        days = [
-          str(reference_day - datetime.timedelta(days=i))
-          for i in xrange(int(duration))
-        ]
-        days_keys = [
-          ndb.Key(flat=[models.AccountStatsDay, d], parent=a_key) for d in days
-        ]
-        valid_days = filter(None, ndb.get_multi(days_keys))
-        if not valid_days:
-          rolling = rolling_future.get_result()
-          if rolling:
-            to_delete.append(rolling.key)
-            if len(to_delete) == chunk_size:
-              futures.extend(ndb.delete_multi_async(to_delete))
-              total_deleted += chunk_size
-              to_delete = []
-              futures = [f for f in futures if not f.done()]
-          continue
-
-        # Always override the content.
-        rolling = models.AccountStatsMulti(id=duration, parent=a_key)
-        # Sum all the daily instances into the rolling summary. Always start
-        # over because it's not just adding data, it's also removing data from
-        # the day that got excluded from the rolling summary.
-        if models.sum_account_statistics(rolling, valid_days):
-          items.append(rolling)
-          if len(items) == chunk_size:
-            futures.extend(ndb.put_multi_async(items))
-            total += chunk_size
-            items = []
-            futures = [f for f in futures if not f.done()]
-      cursor = query.cursor()
+    account_keys = get_rolling_stats_accounts(duration, reference_day)
+    if cursor:
+      account_keys = [k for k in account_keys if k.id() > cursor]
+    days = [
+      str(reference_day - datetime.timedelta(days=i))
+      for i in xrange(int(duration))
+    ]
+    for a_key in account_keys:
       if accounts == 1000 or (time.time() - start) > 300:
         # Limit memory usage.
-        logging.info('%d accounts, last was %s', accounts, a_key.id()[1:-1])
+        logging.info('%d accounts, last was %s', accounts, cursor[1:-1])
         break
+      accounts += 1
+      cursor = a_key.id()
+      # TODO(maruel): If date of each issue was saved in the entity, this
+      # would not be necessary, assuming the entity doesn't become itself
+      # corrupted.
+      rolling_future = models.AccountStatsMulti.get_by_id_async(
+          duration, parent=a_key)
+      days_keys = [
+        ndb.Key(flat=[models.AccountStatsDay, d], parent=a_key) for d in days
+      ]
+      valid_days = filter(None, ndb.get_multi(days_keys))
+      if not valid_days:
+        rolling = rolling_future.get_result()
+        if rolling:
+          to_delete.append(rolling.key)
+          if len(to_delete) == chunk_size:
+            futures.extend(ndb.delete_multi_async(to_delete))
+            total_deleted += chunk_size
+            to_delete = []
+            futures = [f for f in futures if not f.done()]
+        continue
+
+      # Always override the content.
+      rolling = models.AccountStatsMulti(
+          id=duration, parent=a_key,
+          first_day=min(d.key.id() for d in valid_days))
+      # Sum all the daily instances into the rolling summary. Always start
+      # over because it's not just adding data, it's also removing data from
+      # the day that got excluded from the rolling summary.
+      if models.sum_account_statistics(rolling, valid_days):
+        items.append(rolling)
+        if len(items) == chunk_size:
+          futures.extend(ndb.put_multi_async(items))
+          total += chunk_size
+          items = []
+          futures = [f for f in futures if not f.done()]
+    else:
+      # Done with all the accounts.
+      cursor = ''
 
     if items:
       futures.extend(ndb.put_multi_async(items))
@@ -4530,6 +5437,97 @@ def update_rolling_stats(cursor, reference_day):
   return HttpTextResponse(out, status=result), cursor
 
 
+def update_stats_rollups(account_key, months):
+  """Recalculates the quarter and year rollups covering months.
+
+  The rollups are AccountStatsMulti named 'YYYY-qX' and 'YYYY', the sum of the
+  monthly AccountStatsMulti of the account. They make the leaderboard of a
+  quarter or a year a single indexed query.
+
+  Arguments:
+  - account_key: ndb.Key of the Account.
+  - months: iterable of 'YYYY-MM' names of the monthly summaries that changed.
+
+  Returns the number of rollups stored or deleted.
+  """
+  names = set()
+  for month in months:
+    year, month = month.split('-')
+    names.add(year)
+    names.add('%s-q%d' % (year, (int(month) - 1) / 3 + 1))
+  names = sorted(names)
+  months_for = dict((name, quarter_to_months(name)) for name in names)
+  all_months = sorted(set(itertools.chain.from_iterable(months_for.values())))
+  keys = [
+    ndb.Key(models.AccountStatsMulti, name, parent=account_key)
+    for name in names + all_months
+  ]
+  entities = dict(
+      (k.id(), e) for k, e in zip(keys, ndb.get_multi(keys, use_cache=False)))
+
+  to_put = []
+  to_delete = []
+  for name in names:
+    rollup = entities[name]
+    values = filter(None, (entities[m] for m in months_for[name]))
+    if not values:
+      if rollup:
+        to_delete.append(rollup.key)
+      continue
+    if not rollup:
+      rollup = models.AccountStatsMulti(id=name, parent=account_key)
+    if models.sum_account_statistics(rollup, values):
+      to_put.append(rollup)
+  ndb.put_multi(to_put, use_cache=False)
+  ndb.delete_multi(to_delete)
+  return len(to_put) + len(to_delete)
+
+
+def update_all_stats_rollups(cursor):
+  """Recalculates the quarter and year rollups from every monthly summary.
+
+  update_monthly_stats() only updates the rollups of the months it changes,
+  this task creates the rollups of the monthly summaries stored before the
+  rollups existed. cron_update_yesterday_stats() queues it until it records
+  its completion in models.StatsRollups.
+  """
+  start = time.time()
+  looked_up = 0
+  rollups = 0
+  try:
+    q = models.AccountStatsMulti.query(
+        default_options=ndb.QueryOptions(keys_only=True))
+    while True:
+      curs = datastore_query.Cursor(urlsafe=cursor or '')
+      keys, next_curs, more = q.fetch_page(500, start_cursor=curs)
+      looked_up += len(keys)
+      # The keys are in key order so they are grouped by account.
+      months = {}
+      for key in keys:
+        if re.match(r'^\d\d\d\d-\d\d$', key.id()):
+          months.setdefault(key.parent(), []).append(key.id())
+      for account_key, account_months in sorted(months.iteritems()):
+        rollups += update_stats_rollups(account_key, account_months)
+      if not more:
+        cursor = ''
+        models.StatsRollups(id='complete').put()
+        break
+      cursor = next_curs.urlsafe()
+      if (time.time() - start) > 300:
+        break
+    result = 200
+  except (db.Timeout, DeadlineExceededError):
+    result = 500
+
+  out = 'Looked up %d summaries\nUpdated %d rollups\nIn %.1fs\n' % (
+      looked_up, rollups, time.time() - start)
+  if result == 200:
+    logging.info(out)
+  else:
+    logging.error(out)
+  return HttpTextResponse(out, status=result), cursor
+
+
 def update_monthly_stats(cursor, day_to_process):
   """Looks at all AccountStatsDay instance updated on that day and updates the
   corresponding AccountStatsMulti instance.
@@ -4541,6 +5539,7 @@ def update_monthly_stats(cursor, day_to_process):
   start = time.time()
   total = 0
   skipped = 0
+  rollups = 0
   try:
     # The biggest problem here is not time but memory usage so limit the number
     # of ongoing futures.
@@ -4552,6 +5551,9 @@ def update_monthly_stats(cursor, day_to_process):
     q = models.AccountStatsDay.query(default_options=options)
     q.filter(models.AccountStatsDay.modified >= day_to_process)
     months_to_regenerate = set()
+    # dict(account_id -> set(month_name)) of the monthly summaries stored in
+    # the current batch, for which the rollups need to be updated.
+    changed_months = {}
     while True:
       curs = datastore_query.Cursor(urlsafe=cursor or '')
       day_stats_keys, next_curs, more = q.fetch_page(100, start_cursor=curs)
@@ -4604,6 +5606,7 @@ def update_monthly_stats(cursor, day_to_process):
         if models.sum_account_statistics(monthly, days):
           futures.extend(ndb.put_multi_async([monthly], use_cache=False))
           total += 1
+          changed_months.setdefault(account_id, set()).add(month_name)
           while len(futures) > max_futures:
             # Slow down to limit memory usage.
             ndb.Future.wait_any(futures)
@@ -4611,6 +5614,15 @@ def update_monthly_stats(cursor, day_to_process):
         else:
           skipped += 1
 
+      if changed_months:
+        # The rollups are calculated from the saved monthly summaries.
+        ndb.Future.wait_all(futures)
+        futures = []
+        for account_id, months in changed_months.iteritems():
+          rollups += update_stats_rollups(
+              ndb.Key('Account', account_id), months)
+        changed_months = {}
+
       if (time.time() - start) > 400:
         break
 
@@ -4620,8 +5632,8 @@ def update_monthly_stats(cursor, day_to_process):
     logging.error(str(e))
     result = 500
 
-  out = '%s\nStored %d items\nSkipped %d\nIn %.1fs\n' % (
-      day_to_process.date(), total, skipped, time.time() - start)
+  out = '%s\nStored %d items\nSkipped %d\nUpdated %d rollups\nIn %.1fs\n' % (
+      day_to_process.date(), total, skipped, rollups, time.time() - start)
   if result == 200:
     logging.info(out)
   else:
@@ -4629,23 +5641,39 @@ def update_monthly_stats(cursor, day_to_process):
   return HttpTextResponse(out, status=result), cursor
 
 
-@deco.task_queue_required('refresh-all-stats-score')
+@deco.task_queue_required('refresh-all-stats-score', 'update-stats-backfill')
 def task_refresh_all_stats_score(request):
   """Updates all the scores or destroy them all.
 
   - Updating score is necessary when models.compute_score() is changed.
   - Destroying the instances is necessary if
     search_relevant_first_email_for_user() or process_issue() are modified.
+
+  When run from the update-stats-backfill queue, the task only handles the
+  entities of the accounts in the key name range ['start', 'end'), see
+  start_stats_score_refresh().
   """
   start = time.time()
   cls_name = request.POST.get('cls') or 'Day'
   destroy = int(request.POST.get('destroy', '0'))
   cursor = datastore_query.Cursor(urlsafe=request.POST.get('cursor'))
   task_count = int(request.POST.get('task_count', '0'))
+  range_start = request.POST.get('start')
+  range_end = request.POST.get('end')
+  queue_name = request.META.get(format_header('X-AppEngine-QueueName'))
   assert cls_name in ('Day', 'Multi'), cls_name
   cls = (
       models.AccountStatsDay
       if cls_name == 'Day' else models.AccountStatsMulti)
+  if destroy:
+    options = ndb.QueryOptions(keys_only=True)
+  else:
+    options = ndb.QueryOptions()
+  query = cls.query(default_options=options)
+  if range_start:
+    query = query.filter(cls.key >= ndb.Key('Account', range_start))
+  if range_end:
+    query = query.filter(cls.key < ndb.Key('Account', range_end))
 
   # Task queues are given 10 minutes. Do it in 9 minutes chunks to protect
   # against most timeout conditions.
@@ -4657,13 +5685,8 @@ def task_refresh_all_stats_score(request):
     chunk_size = 10
     items = []
     more = True
-    if destroy:
-      options = ndb.QueryOptions(keys_only=True)
-    else:
-      options = ndb.QueryOptions()
     while more:
-      batch, cursor, more = cls.query(default_options=options).fetch_page(
-          20, start_cursor=cursor)
+      batch, cursor, more = query.fetch_page(20, start_cursor=cursor)
       if destroy:
         futures.extend(ndb.delete_multi_async(batch))
         updated += len(batch)
@@ -4685,21 +5708,27 @@ def task_refresh_all_stats_score(request):
       futures.extend(ndb.put_multi_async(items))
       updated += chunk_size
     ndb.Future.wait_all(futures)
+    invalidate_leaderboard_cache()
     if not more and cls_name == 'Day':
       # Move to the Multi instances.
       more = True
       cls_name = 'Multi'
       cursor = datastore_query.Cursor()
     if more:
+      params = {
+        'cls': cls_name,
+        'cursor': cursor.urlsafe(),
+        'destroy': str(destroy),
+        'task_count': str(task_count+1),
+      }
+      if range_start:
+        params['start'] = range_start
+      if range_end:
+        params['end'] = range_end
       taskqueue.add(
           url=reverse(task_refresh_all_stats_score),
-          params={
-            'cls': cls_name,
-            'cursor': cursor.urlsafe(),
-            'destroy': str(destroy),
-            'task_count': str(task_count+1),
-          },
-          queue_name='refresh-all-stats-score')
+          params=params,
+          queue_name=queue_name)
     result = 200
   except (db.Timeout, DeadlineExceededError):
     result = 500
@@ -4750,11 +5779,14 @@ def show_user_impl(user, when):
   if months:
     # Normalize to 'q'.
     when = when.lower()
-    # Loads the stats for the 3 months and merge them.
-    keys = [ndb.Key(cls, i, parent=account_key) for i in months]
-    values = filter(None, ndb.get_multi(keys))
-    stats = cls(id=when, parent=account_key)
-    models.sum_account_statistics(stats, values)
+    stats = cls.get_by_id(when, parent=account_key)
+    if not stats:
+      # The rollup wasn't calculated yet, load the stats for the months and
+      # merge them.
+      keys = [ndb.Key(cls, i, parent=account_key) for i in months]
+      values = filter(None, ndb.get_multi(keys))
+      stats = cls(id=when, parent=account_key)
+      models.sum_account_statistics(stats, values)
   else:
     stats = cls.get_by_id(when, parent=account_key)
     if not stats:
@@ -4807,11 +5839,34 @@ def show_user_stats_json(request, when):
   return stats.to_dict()
 
 
+def get_leaderboard_cache_key(when, limit):
+  """Returns the memcache key of a leaderboard.
+
+  The key includes a generation number bumped by
+  invalidate_leaderboard_cache(), so a stats run hides all the cached
+  leaderboards at once.
+  """
+  generation = memcache.get('leaderboard_generation') or 0
+  return 'leaderboard:%d:%s:%d' % (generation, when, limit)
+
+
+def invalidate_leaderboard_cache():
+  """Discards the cached leaderboards, called once new stats are stored."""
+  memcache.incr('leaderboard_generation', initial_value=0)
+
+
 def leaderboard_impl(when, limit):
   """Returns the leaderboard for this Rietveld instance on |when|.
 
   It returns the list of the reviewers sorted by their score for
-  the past weeks, a specific day or month or a quarter.
+  the past weeks, a specific day, month, quarter or year.
+
+  The quarters and years use the rollups stored by update_monthly_stats().
+  Until the 'rollups' task created the rollups of all the monthly summaries,
+  see models.StatsRollups, they are merged from their months instead.
+
+  The keys of the stored entities are cached in memcache until the next stats
+  update.
   """
   when = when.lower()
   months = None
@@ -4823,28 +5878,42 @@ def leaderboard_impl(when, limit):
   cls = (
       models.AccountStatsDay
       if when.count('-') == 2 else models.AccountStatsMulti)
-  if months:
-    # Use the IN operator to simultaneously select the 3 months.
-    results = cls.query().filter(
-        cls.name.IN(months)).order(cls.score).fetch(limit)
-    # Then merge all the results accordingly.
-    tops = {}
-    for i in results:
-      tops.setdefault(i.user, []).append(i)
-    for key, values in tops.iteritems():
-      values.sort(key=lambda x: x.name)
-      out = models.AccountStatsMulti(id=when, parent=values[0].key.parent())
-      models.sum_account_statistics(out, values)
-      tops[key] = out
-    tops = sorted(tops.itervalues(), key=lambda x: x.score)
+  cache_key = get_leaderboard_cache_key(when, limit)
+  keys = memcache.get(cache_key)
+  if keys is not None:
+    tops = filter(None, ndb.get_multi(keys))
   else:
+    if months and not models.StatsRollups.is_complete():
+      return _merge_leaderboard_months(when, months, limit)
     # Grabs the pre-calculated entities or daily entity.
     tops = cls.query().filter(cls.name == when).order(cls.score).fetch(limit)
-
+    try:
+      memcache.set(cache_key, [t.key for t in tops], 24 * 60 * 60)
+    except ValueError, e:
+      logging.warning('Failed to cache the leaderboard %s: %s', when, e)
   # Remove anyone with a None score.
   return [t for t in tops if t.score is not None]
 
 
+def _merge_leaderboard_months(when, months, limit):
+  """Returns the leaderboard of a quarter or a year summed from its months."""
+  cls = models.AccountStatsMulti
+  # Use the IN operator to simultaneously select the months.
+  results = cls.query().filter(
+      cls.name.IN(months)).order(cls.score).fetch(limit)
+  # Then merge all the results accordingly.
+  tops = {}
+  for i in results:
+    tops.setdefault(i.user, []).append(i)
+  for key, values in tops.iteritems():
+    values.sort(key=lambda x: x.name)
+    out = cls(id=when, parent=values[0].key.parent())
+    models.sum_account_statistics(out, values)
+    tops[key] = out
+  tops = sorted(tops.itervalues(), key=lambda x: x.score)
+  return [t for t in tops if t.score is not None]
+
+
 def stats_to_dict(t):
   """Adds value 'user'.
 
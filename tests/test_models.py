@@ -21,7 +21,15 @@ import setup
 setup.process_args()
 
 
-from codereview.models import Issue
+from google.appengine.api import memcache
+from google.appengine.api.users import User
+from google.appengine.ext import db
+
+from codereview.models import Account, Comment, Issue, Message
+from codereview.models import AccountStatsBase, AccountStatsDay
+from codereview.models import AccountStatsMulti
+from codereview.models import sum_account_statistics
+from codereview import models
 
 from utils import TestCase
 
@@ -61,5 +69,320 @@ class TestCollaboratorEmailsFromDescription(TestCase):
     self.assertEqual(['one@one.com', 'two@two.com'], collaborators)
 
 
+class TestNicknamesForEmails(TestCase):
+  """Test the Account.get_nicknames_for_emails function."""
+
+  def setUp(self):
+    super(TestNicknamesForEmails, self).setUp()
+    Account(key_name='<foo@example.com>', user=User('foo@example.com'),
+            email='foo@example.com', nickname='foonick').put()
+
+  def test_empty(self):
+    self.assertEqual({}, Account.get_nicknames_for_emails([]))
+
+  def test_mixed(self):
+    self.assertEqual(
+        {'foo@example.com': 'foonick', 'bar@example.com': 'bar_example.com'},
+        Account.get_nicknames_for_emails(
+            ['foo@example.com', 'bar@example.com', 'foo@example.com']))
+    self.assertEqual(
+        ('foonick', True), memcache.get('user_nickname:foo@example.com'))
+
+  def test_empty_emails(self):
+    self.assertEqual(
+        {'': '', None: ''}, Account.get_nicknames_for_emails(['', None]))
+
+  def test_details(self):
+    self.assertEqual(
+        {'foo@example.com': ('foonick', True),
+         'bar@example.com': ('bar_example.com', False)},
+        Account.get_nickname_details_for_emails(
+            ['foo@example.com', 'bar@example.com']))
+
+  def test_batch_put_invalidate_cache(self):
+    Account.get_nicknames_for_emails(['foo@example.com'])
+    account = Account.get_by_key_name('<foo@example.com>')
+    account.nickname = 'newnick'
+    db.put([account])
+    Account.invalidate_cache([account.email])
+    self.assertEqual(
+        {'foo@example.com': 'newnick'},
+        Account.get_nicknames_for_emails(['foo@example.com']))
+
+  def test_put_invalidates_cache(self):
+    Account.get_nicknames_for_emails(['foo@example.com'])
+    account = Account.get_by_key_name('<foo@example.com>')
+    account.nickname = 'newnick'
+    account.put()
+    self.assertEqual(
+        {'foo@example.com': 'newnick'},
+        Account.get_nicknames_for_emails(['foo@example.com']))
+
+
+class TestAccountCache(TestCase):
+  """Test the memcache backed Account read path."""
+
+  def setUp(self):
+    super(TestAccountCache, self).setUp()
+    self.user = User('foo@example.com')
+    Account.set_current_user(None)
+
+  def test_put_writes_through(self):
+    account = Account.get_account_for_user(self.user)
+    account.nickname = 'cached'
+    account.put()
+    self.assertTrue(memcache.get('account:foo@example.com'))
+    self.assertEqual(
+        'cached', Account.get_account_for_user(self.user).nickname)
+
+  def test_delete_clears_cache(self):
+    Account.get_account_for_user(self.user).delete()
+    self.assertEqual(None, memcache.get('account:foo@example.com'))
+
+  def test_batch_put_invalidate_cache(self):
+    account = Account.get_account_for_user(self.user)
+    account.nickname = 'batched'
+    db.put([account])
+    Account.invalidate_cache([account.email])
+    self.assertEqual(None, memcache.get('account:foo@example.com'))
+    self.assertEqual(
+        'batched', Account.get_account_for_user(self.user).nickname)
+
+  def test_current_user_account_is_lazy(self):
+    Account.set_current_user(self.user)
+    self.assertEqual(None, Account._loaded_current_user_account())
+    self.assertEqual('foo@example.com', Account.current_user_account.email)
+    Account.set_current_user(None)
+    self.assertEqual(None, Account.current_user_account)
+
+
+class TestCreateNickname(TestCase):
+  """Test the Account.create_nickname_for_user function."""
+
+  def test_free_name(self):
+    self.assertEqual(
+        'joe', Account.create_nickname_for_user(User('joe@example.com')))
+
+  def test_suffixes(self):
+    Account.get_account_for_user(User('joe@example.com'))
+    self.assertEqual(
+        'joe1', Account.get_account_for_user(User('joe@other.com')).nickname)
+    self.assertEqual(
+        'Joe2', Account.get_account_for_user(User('Joe@third.com')).nickname)
+
+  def test_suffixes_survive_memcache_flush(self):
+    Account.get_account_for_user(User('joe@example.com'))
+    Account.get_account_for_user(User('joe@other.com'))
+    memcache.flush_all()
+    self.assertEqual(
+        'joe2', Account.get_account_for_user(User('joe@third.com')).nickname)
+
+  def test_suffixes_skip_existing(self):
+    # Accounts created before the counter existed already use suffixes.
+    Account.get_account_for_user(User('joe@example.com'))
+    Account(user=User('joe1@example.com'), email='joe1@example.com',
+            nickname='joe1').put()
+    self.assertEqual(
+        'joe2', Account.get_account_for_user(User('joe@other.com')).nickname)
+
+  def test_probes_are_capped(self):
+    Account.get_account_for_user(User('joe@example.com'))
+    for i in (1, 2):
+      Account(user=User('joe%d@example.com' % i),
+              email='joe%d@example.com' % i, nickname='joe%d' % i).put()
+    old_max_probes = models.MAX_NICKNAME_PROBES
+    models.MAX_NICKNAME_PROBES = 2
+    try:
+      self.assertEqual(
+          'joe_other.com',
+          Account.get_account_for_user(User('joe@other.com')).nickname)
+      # The counter moved past the old suffixes.
+      self.assertEqual(
+          'joe3',
+          Account.get_account_for_user(User('joe@third.com')).nickname)
+    finally:
+      models.MAX_NICKNAME_PROBES = old_max_probes
+
+
+class TestAccountDrafts(TestCase):
+  """Test the durable draft issue index of Account."""
+
+  def test_survives_memcache_flush(self):
+    user = User('foo@example.com')
+    self.login('foo@example.com')
+    issue = Issue(subject='test')
+    issue.put()
+    Account.get_account_for_user(user).update_drafts(issue, True)
+    memcache.flush_all()
+    account = Account.get_by_key_name('<foo@example.com>')
+    # There is no draft Comment, a rescan would have returned nothing.
+    self.assertEqual([issue.key().id()], account.drafts)
+    account.update_drafts(issue, False)
+    memcache.flush_all()
+    account = Account.get_by_key_name('<foo@example.com>')
+    self.assertEqual([], account.drafts)
+
+
+class TestCalculateUpdatesFor(TestCase):
+  """Test the Issue.calculate_updates_for function."""
+
+  def setUp(self):
+    super(TestCalculateUpdatesFor, self).setUp()
+    self.login('owner@example.com')
+    self.issue = Issue(subject='test', reviewers=['rev@example.com'])
+    self.issue.put()
+
+  def _message(self, sender, text):
+    return Message(parent=self.issue, issue=self.issue, sender=sender,
+                   text=text)
+
+  def test_incremental(self):
+    self._message('rev@example.com', 'lgtm').put()
+    self.issue.calculate_updates_for()
+    self.assertEqual(1, self.issue.n_messages_sent)
+    self.issue.calculate_updates_for(
+        self._message('owner@example.com', 'thanks'))
+    self.assertEqual(2, self.issue.n_messages_sent)
+    self.assertEqual(['rev@example.com'], self.issue.updates_for)
+    self.assertEqual({'rev@example.com': True},
+                     self.issue.formatted_reviewers)
+
+  def test_recalculate(self):
+    self._message('rev@example.com', 'not lgtm').put()
+    self.issue.n_messages_sent = 7
+    self.issue.recalculate_updates_for()
+    self.assertEqual(1, self.issue.n_messages_sent)
+    self.assertEqual(['owner@example.com'], self.issue.updates_for)
+    self.assertEqual({'rev@example.com': False},
+                     self.issue.formatted_reviewers)
+
+
+class TestMessageApprovalFlags(TestCase):
+  """Test the precomputed approval flags of Message."""
+
+  def setUp(self):
+    super(TestMessageApprovalFlags, self).setUp()
+    self.login('owner@example.com')
+    self.issue = Issue(subject='test')
+    self.issue.put()
+
+  def test_flags(self):
+    msg = Message(parent=self.issue, issue=self.issue, sender='r@example.com',
+                  text='> not lgtm\nLGTM')
+    msg.calculate_approval_flags(self.issue)
+    self.assertEqual(False, msg.sender_is_owner)
+    self.assertEqual(True, msg.says_lgtm)
+    self.assertEqual(False, msg.says_not_lgtm)
+    self.assertTrue(msg.approval)
+    self.assertFalse(msg.disapproval)
+
+  def test_owner(self):
+    msg = Message(parent=self.issue, issue=self.issue,
+                  sender='owner@example.com', text='lgtm')
+    msg.calculate_approval_flags(self.issue)
+    self.assertFalse(msg.approval)
+    self.assertTrue(msg.find('lgtm', owner_allowed=True))
+
+
+class TestUpdateDraftCount(TestCase):
+  """Test the Issue.update_draft_count function."""
+
+  def test_increment_decrement(self):
+    self.login('foo@example.com')
+    user = User('foo@example.com')
+    issue = Issue(subject='test', draft_count_by_user='{}')
+    issue.put()
+    self.assertEqual(1, issue.update_draft_count(user, 1))
+    self.assertEqual(2, issue.update_draft_count(user, 1))
+    self.assertEqual(1, issue.update_draft_count(user, -1))
+    self.assertEqual(1, Issue.get(issue.key()).get_num_drafts(user))
+
+
+class TestCommentBuckets(TestCase):
+  """Test the Comment.complete function."""
+
+  def check(self, comment):
+    comment.complete()
+    self.assertEqual(
+        [('On Monday, bar wrote:\n> hi\n> there', True), ('Hello', False)],
+        [(b.text, b.quoted) for b in comment.buckets])
+    self.assertEqual('Hello', comment.shorttext)
+
+  def test_stored(self):
+    comment = Comment(text='On Monday, bar wrote:\n> hi\n> there\nHello')
+    comment.calculate_buckets()
+    self.assertEqual([7, 8], comment.bucket_ends)
+    self.check(comment)
+
+  def test_legacy(self):
+    self.check(Comment(text='On Monday, bar wrote:\n> hi\n> there\nHello'))
+
+
+class TestAccountStatsAggregates(TestCase):
+  """Test the values derived from the AccountStats lists."""
+
+  def test_aggregates(self):
+    day1 = AccountStatsMulti(
+        id='30', issues=[1, 2, 3], latencies=[10, -1, -1], lgtms=[1, 0, 1],
+        review_types=[AccountStatsBase.NORMAL, AccountStatsBase.IGNORED,
+                      AccountStatsBase.OUTGOING])
+    day2 = AccountStatsMulti(
+        id='30', issues=[4], latencies=[30], lgtms=[0],
+        review_types=[AccountStatsBase.DRIVE_BY])
+    out = AccountStatsMulti(id='30')
+    self.assertTrue(sum_account_statistics(out, [day1, day2]))
+    self.assertEqual([1, 2, 3, 4], out.issues)
+    self.assertEqual(2, out.nb_reviewed)
+    self.assertEqual(1, out.nb_ignored)
+    self.assertEqual(3, out.nb_issues)
+    self.assertEqual(1, out.nb_lgtmed)
+    self.assertEqual(1, out.nb_drive_by)
+    self.assertEqual(1, out.nb_outgoing)
+    self.assertEqual(1, out.self_love)
+    self.assertEqual(20., out.median_latency)
+    # The cached values follow the lists once reset.
+    out.latencies[1] = 50
+    out.review_types[1] = AccountStatsBase.NORMAL
+    out.reset_aggregates()
+    self.assertEqual(3, out.nb_reviewed)
+    self.assertEqual(30, out.median_latency)
+
+
+class TestLatencyHistogram(TestCase):
+  """Test the mergeable latency histograms of the stats entities."""
+
+  def test_percentiles(self):
+    latencies = range(1, 1001)
+    day = AccountStatsDay(
+        id='2011-03-01', issues=range(len(latencies)), latencies=latencies,
+        lgtms=[0] * len(latencies),
+        review_types=[AccountStatsBase.NORMAL] * len(latencies))
+    self.assertEqual([], day.latency_buckets)
+    # Within 5% of the exact values.
+    self.assertTrue(abs(day.latency_percentile(50) - 500) <= 25)
+    self.assertTrue(abs(day.p90_latency - 900) <= 45)
+    self.assertEqual(None, AccountStatsDay(id='2011-03-02').p90_latency)
+
+  def test_merge(self):
+    items = [
+      AccountStatsDay(
+          id='2011-03-01', issues=[1, 2], latencies=[10, 2000], lgtms=[0, 0],
+          review_types=[AccountStatsBase.NORMAL] * 2),
+      AccountStatsDay(
+          id='2011-03-02', issues=[3, 4], latencies=[-1, 10], lgtms=[0, 0],
+          review_types=[AccountStatsBase.IGNORED, AccountStatsBase.NORMAL]),
+    ]
+    items[0].set_latency_histogram(items[0].get_latency_histogram())
+    out = AccountStatsMulti(id='2011-03')
+    sum_account_statistics(out, items)
+    bucket = models.latency_to_bucket(10)
+    self.assertEqual(
+        {bucket: 2, models.latency_to_bucket(2000): 1},
+        out.get_latency_histogram())
+    self.assertEqual(
+        models.bucket_to_latency(bucket), out.latency_percentile(50))
+    self.assertNotIn('latency_buckets', out.to_dict())
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -17,6 +17,7 @@
 
 import datetime
 import json
+import os
 import unittest
 
 import setup
@@ -25,12 +26,13 @@ setup.process_args()
 
 from django.http import HttpRequest
 
+from google.appengine.api import mail
 from google.appengine.api.users import User
 from google.appengine.ext import db
 
 from utils import TestCase, load_file
 
-from codereview import models, views
+from codereview import library, models, views
 from codereview import engine  # engine must be imported after models :(
 
 
@@ -100,6 +102,66 @@ class TestPublish(TestCase):
         views._get_draft_details(request, [cmt1, cmt2])
 
 
+    def test_draft_comments_across_patchsets(self):
+        ps2 = models.PatchSet(parent=self.issue, issue=self.issue)
+        ps2.data = load_file('ps1.diff')
+        ps2.save()
+        patches2 = engine.ParsePatchSet(ps2)
+        db.put(patches2)
+        drafts = [
+            (patches2[0], 3, self.user),
+            (self.patches[0], 2, self.user),
+            (self.patches[0], 1, self.user),
+            (self.patches[0], 4, User('bar@example.com')),
+        ]
+        for patch, lineno, author in drafts:
+            models.Comment(patch=patch, parent=patch, text='x', lineno=lineno,
+                           left=False, draft=True, author=author).put()
+        request = MockRequest(self.user, issue=self.issue)
+        tbd, comments = views._get_draft_comments(request, self.issue)
+        self.assertEqual([1, 2, 3], [c.lineno for c in comments])
+        self.assertEqual(
+            [self.patches[0].key(), self.patches[0].key(), patches2[0].key()],
+            [c.patch.key() for c in comments])
+        self.assertEqual([self.ps.key(), self.ps.key(), ps2.key()],
+                         [c.patch.patchset.key() for c in comments])
+        self.assertFalse(any(c.draft for c in comments))
+        self.assertEqual([2, 1], [ps.n_comments for ps in tbd[1::2]])
+
+        tbd, comments = views._get_draft_comments(
+            request, self.issue, preview=True)
+        self.assertEqual([], tbd)
+        self.assertEqual(3, len(comments))
+
+
+class TestUpdatesFor(TestCase):
+    """Test updates_for when the recipients of an issue change."""
+
+    def setUp(self):
+        super(TestUpdatesFor, self).setUp()
+        self.login('foo@example.com')
+        self.issue = models.Issue(subject='test',
+                                  reviewers=['rev@example.com'])
+        self.issue.put()
+        msg = models.Message(parent=self.issue, issue=self.issue,
+                             sender='foo@example.com', text='PTAL')
+        msg.put()
+        self.issue.calculate_updates_for()
+        self.issue.put()
+
+    def test_reviewer_added_after_owner_mail(self):
+        response = self.client.post(
+            '/%d/fields' % self.issue.key().id(),
+            {'fields': json.dumps(
+                {'reviewers': ['rev@example.com', 'new@example.com']})})
+        self.assertEqual(200, response.status_code)
+        issue = models.Issue.get(self.issue.key())
+        self.assertEqual(['new@example.com', 'rev@example.com'],
+                         sorted(issue.updates_for))
+        self.assertEqual({'new@example.com': None, 'rev@example.com': None},
+                         issue.formatted_reviewers)
+
+
 class TestSearch(TestCase):
 
     def setUp(self):
@@ -224,5 +286,334 @@ class TestModifierCount(TestCase):
         self.assertEqual(7, removed)
 
 
+class TestAccountMatches(TestCase):
+    """Test the account autocomplete lookup."""
+
+    def setUp(self):
+        super(TestAccountMatches, self).setUp()
+        for email in ('john@example.com', 'joe@example.com',
+                      'jack@other.com'):
+            models.Account.get_account_for_user(User(email))
+
+    def test_prefix(self):
+        self.assertEqual(
+            [('joe@example.com', 'joe'), ('john@example.com', 'john')],
+            views._get_account_matches('jo', ''))
+
+    def test_domain_first(self):
+        self.assertEqual(
+            [('joe@example.com', 'joe'), ('john@example.com', 'john'),
+             ('jack@other.com', 'jack')],
+            views._get_account_matches('j', 'example.com'))
+
+    def test_longer_prefix_uses_cache(self):
+        views._get_account_matches('j', '')
+        models.Account.get_account_for_user(User('joan@example.com'))
+        # 'j' matched every account, so 'jo' is answered from its result.
+        self.assertEqual(
+            [('joe@example.com', 'joe'), ('john@example.com', 'john')],
+            views._get_account_matches('jo', ''))
+
+
+class TestPatchLines(TestCase):
+    """Test the line lookup used to quote comments in emails."""
+
+    def setUp(self):
+        super(TestPatchLines, self).setUp()
+        self.login('foo@example.com')
+        issue = models.Issue(subject='test')
+        issue.local_base = False
+        issue.put()
+        ps = models.PatchSet(parent=issue, issue=issue)
+        ps.put()
+        content = models.Content(text='a\nb\nc\nd\n', checksum='abc')
+        content.put()
+        self.patch = models.Patch(
+            parent=ps, patchset=ps, filename='foo.txt', content=content,
+            text=('Index: foo.txt\n'
+                  '--- foo.txt\n'
+                  '+++ foo.txt\n'
+                  '@@ -2,1 +2,2 @@\n'
+                  '-b\n'
+                  '+B\n'
+                  '+B2\n'))
+        self.patch.put()
+
+    def test_left(self):
+        self.assertEqual(
+            {2: 'b\n', 4: 'd\n'},
+            views._get_patch_lines(self.patch, True, set([2, 4])))
+
+    def test_right(self):
+        self.assertEqual(
+            {1: 'a\n', 3: 'B2\n', 5: 'd\n'},
+            views._get_patch_lines(self.patch, False, set([1, 3, 5])))
+        self.assertEqual(None, self.patch.patched_content)
+
+
+class TestUserLinks(TestCase):
+    """Test the user links rendered by the show_user filters."""
+
+    def test_links_use_request_cache(self):
+        models.Account.get_account_for_user(User('foo@example.com'))
+        request = MockRequest()
+        links = library.get_links_for_users(
+            ['foo@example.com', 'bar@example.com'], request)
+        self.assertEqual('bar', links['bar@example.com'])
+        self.assertTrue('>foo</a>' in links['foo@example.com'])
+        # get_nickname() is served from the same cache.
+        self.assertEqual(
+            ('foo', True), request._nicknames['foo@example.com'])
+        self.assertEqual(
+            'foo', library.get_nickname('foo@example.com', True, request))
+
+
+class TestSendMail(TestCase):
+    """Test the delivery of queued mails."""
+
+    def setUp(self):
+        super(TestSendMail, self).setUp()
+        self.testbed.init_mail_stub()
+        self.mail_stub = self.testbed.get_stub('mail')
+        self.testbed.init_taskqueue_stub(
+            root_path=os.path.join(os.path.dirname(__file__), '..'))
+        self.taskqueue_stub = self.testbed.get_stub('taskqueue')
+        self.login('foo@example.com')
+        self.user = User('foo@example.com')
+        self.issue = models.Issue(subject='test',
+                                  reviewers=['bar@example.com'])
+        self.issue.put()
+
+    def make_message(self, text):
+        """Calls _make_message() and returns the queued mail payload."""
+        request = MockRequest(self.user, issue=self.issue)
+        views._make_message(request, self.issue, text, send_mail=True)
+        tasks = self.taskqueue_stub.get_filtered_tasks(
+            queue_names=['send-mail'])
+        self.assertEqual(1, len(tasks))
+        self.taskqueue_stub.FlushQueue('send-mail')
+        return json.loads(tasks[0].payload)
+
+    def test_make_message_queues_mail(self):
+        payload = self.make_message('Hello')
+        self.assertEqual('foo@example.com', payload['sender'])
+        self.assertEqual(['bar@example.com'], payload['to'])
+        self.assertEqual('test (issue %d)' % self.issue.key().id(),
+                         payload['subject'])
+        self.assertTrue('Hello' in payload['body'])
+        self.assertEqual([], self.mail_stub.get_sent_messages())
+
+    def test_task_send_mail(self):
+        request = MockRequest()
+        request.method = 'POST'
+        request.META['HTTP_X_APPENGINE_QUEUENAME'] = 'send-mail'
+        request._raw_post_data = json.dumps({
+            'sender': 'foo@example.com',
+            'to': ['bar@example.com'],
+            'subject': 'test (issue 1)',
+            'body': 'Hello',
+            'attachments': [('issue_1_patch.diff', 'ZGlmZg==')],
+        })
+        response = views.task_send_mail(request)
+        self.assertEqual(200, response.status_code)
+        messages = self.mail_stub.get_sent_messages(to='bar@example.com')
+        self.assertEqual(1, len(messages))
+        self.assertEqual('test (issue 1)', messages[0].subject)
+
+    def add_patchset(self):
+        ps = models.PatchSet(parent=self.issue, issue=self.issue)
+        ps.data = load_file('ps1.diff')
+        ps.put()
+        patches = engine.ParsePatchSet(ps)
+        db.put(patches)
+        return ps, patches
+
+    def test_upload_complete_stores_summary(self):
+        ps, patches = self.add_patchset()
+        response = self.client.post(
+            '/%d/upload_complete/%d' % (self.issue.key().id(), ps.key().id()),
+            {'send_mail': 'yes'})
+        self.assertEqual(200, response.status_code)
+        ps = models.PatchSet.get(ps.key())
+        self.assertEqual(sorted(p.filename for p in patches),
+                         [f.split(' ')[-1] for f in ps.files])
+        added = sum(p.num_added for p in patches)
+        removed = sum(p.num_removed for p in patches)
+        self.assertEqual(added, ps.total_added)
+        self.assertEqual(removed, ps.total_removed)
+        self.assertTrue(models.Issue.get(self.issue.key()).owner_mailed)
+
+        # The first mail of the owner summarizes the patch set.
+        tasks = self.taskqueue_stub.get_filtered_tasks(
+            queue_names=['send-mail'])
+        self.assertEqual(1, len(tasks))
+        body = json.loads(tasks[0].payload)['body']
+        self.assertTrue(
+            'Affected files (+%d, -%d lines):' % (added, removed) in body,
+            body)
+        for filename in ps.files:
+            self.assertTrue(filename in body, body)
+
+        # The following ones don't.
+        self.issue = models.Issue.get(self.issue.key())
+        self.taskqueue_stub.FlushQueue('send-mail')
+        payload = self.make_message('Ping')
+        self.assertFalse('Affected files' in payload['body'])
+
+    def test_summary_of_older_patchset(self):
+        # Patch sets and issues created before the summary fields existed.
+        ps, patches = self.add_patchset()
+        self.assertEqual(None, ps.total_added)
+        self.issue.owner_mailed = None
+        self.issue.put()
+        payload = self.make_message('Hello')
+        self.assertTrue('Affected files' in payload['body'])
+        ps = models.PatchSet.get(ps.key())
+        self.assertEqual(sorted(p.filename for p in patches),
+                         [f.split(' ')[-1] for f in ps.files])
+        self.assertEqual(sum(p.num_added for p in patches), ps.total_added)
+        self.assertTrue(self.issue.owner_mailed)
+
+    def test_task_send_mail_permanent_error(self):
+        # A mail without body can't ever be sent, the task must not be
+        # retried.
+        request = MockRequest()
+        request.method = 'POST'
+        request.META['HTTP_X_APPENGINE_QUEUENAME'] = 'send-mail'
+        request._raw_post_data = json.dumps({
+            'sender': 'foo@example.com',
+            'to': ['bar@example.com'],
+            'subject': 'test (issue 1)',
+        })
+        response = views.task_send_mail(request)
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([], self.mail_stub.get_sent_messages())
+
+    def test_task_send_mail_transient_error(self):
+        # The mail service being down must not drop the mail.
+        request = MockRequest()
+        request.method = 'POST'
+        request.META['HTTP_X_APPENGINE_QUEUENAME'] = 'send-mail'
+        request._raw_post_data = json.dumps({
+            'sender': 'foo@example.com',
+            'to': ['bar@example.com'],
+            'subject': 'test (issue 1)',
+            'body': 'Hello',
+        })
+        def fail(_send_args):
+            raise mail.InternalTransientError()
+        old_send_mail = views._send_mail
+        views._send_mail = fail
+        try:
+            self.assertRaises(
+                mail.InternalTransientError, views.task_send_mail, request)
+        finally:
+            views._send_mail = old_send_mail
+
+
+class TestApiDraftComments(TestCase):
+    """Test the bulk draft comments API."""
+
+    def setUp(self):
+        super(TestApiDraftComments, self).setUp()
+        self.login('foo@example.com')
+        self.user = User('foo@example.com')
+        self.issue = models.Issue(subject='test')
+        self.issue.local_base = False
+        self.issue.put()
+        self.ps = models.PatchSet(parent=self.issue, issue=self.issue)
+        self.ps.data = load_file('ps1.diff')
+        self.ps.save()
+        self.patches = engine.ParsePatchSet(self.ps)
+        db.put(self.patches)
+        self.url = '/api/%d/%d/draft_comments' % (
+            self.issue.key().id(), self.ps.key().id())
+
+    def post(self, drafts):
+        return self.client.post(self.url, json.dumps(drafts),
+                                content_type='application/json')
+
+    def test_create_update_delete(self):
+        patch_id = self.patches[0].key().id()
+        response = self.post([
+            {'patch_id': patch_id, 'lineno': 1, 'text': 'one'},
+            {'patch_id': patch_id, 'lineno': 2, 'text': 'two', 'left': True},
+        ])
+        self.assertEqual(200, response.status_code)
+        ids = [r['message_id'] for r in json.loads(response.content)]
+        self.assertEqual(2, models.Issue.get(self.issue.key()).get_num_drafts(
+            self.user))
+        response = self.post([
+            {'patch_id': patch_id, 'lineno': 1, 'text': 'uno',
+             'message_id': ids[0]},
+            {'patch_id': patch_id, 'lineno': 2, 'text': '',
+             'message_id': ids[1]},
+        ])
+        self.assertEqual([{'message_id': ids[0]}, {'message_id': None}],
+                         json.loads(response.content))
+        comments = list(models.Comment.all().ancestor(self.issue))
+        self.assertEqual(['uno'], [c.text for c in comments])
+        self.assertEqual(1, models.Issue.get(self.issue.key()).get_num_drafts(
+            self.user))
+
+    def test_unknown_patch(self):
+        response = self.post([{'patch_id': 12345, 'lineno': 1, 'text': 'x'}])
+        self.assertEqual(400, response.status_code)
+
+    def test_duplicate_message_id(self):
+        patch_id = self.patches[0].key().id()
+        response = self.post([{'patch_id': patch_id, 'lineno': 1, 'text': 'x'}])
+        message_id = json.loads(response.content)[0]['message_id']
+        response = self.post([
+            {'patch_id': patch_id, 'lineno': 1, 'text': '',
+             'message_id': message_id},
+            {'patch_id': patch_id, 'lineno': 1, 'text': '',
+             'message_id': message_id},
+        ])
+        self.assertEqual(400, response.status_code)
+        # Nothing was changed.
+        self.assertEqual(1, models.Issue.get(self.issue.key()).get_num_drafts(
+            self.user))
+        self.assertEqual(
+            1, models.Comment.all().ancestor(self.issue).count())
+
+
+class TestFetchComments(TestCase):
+    """Test the comment queries started before rendering a diff."""
+
+    def setUp(self):
+        super(TestFetchComments, self).setUp()
+        self.login('foo@example.com')
+        self.user = User('foo@example.com')
+        issue = models.Issue(subject='test')
+        issue.put()
+        ps = models.PatchSet(parent=issue, issue=issue)
+        ps.put()
+        self.patch = models.Patch(parent=ps, patchset=ps, filename='foo.txt',
+                                  text='')
+        self.patch.put()
+        for lineno, left, draft, author in [
+                (1, False, False, User('bar@example.com')),
+                (2, True, True, self.user),
+                (3, False, True, User('bar@example.com'))]:
+            models.Comment(parent=self.patch, patch=self.patch, lineno=lineno,
+                           left=left, draft=draft, author=author,
+                           text='x').put()
+        self.request = MockRequest(self.user)
+        self.request.patch = self.patch
+
+    def test_get_comments(self):
+        comments = engine.FetchComments([self.patch, None])
+        self.assertEqual([self.patch.key()], comments.keys())
+        old_dict, new_dict = engine._GetComments(self.request, self.patch,
+                                                 comments)
+        self.assertEqual([2], old_dict.keys())
+        self.assertEqual([1], new_dict.keys())
+        # The results were consumed, a second lookup queries again.
+        old_dict, new_dict = engine._GetComments(self.request, self.patch,
+                                                 comments)
+        self.assertEqual([1], new_dict.keys())
+
+
 if __name__ == '__main__':
   unittest.main()
@@ -17,6 +17,8 @@
 
 import datetime
 import json
+import logging
+import os
 import re
 import sys
 import unittest
@@ -44,6 +46,16 @@ DRIVE_BY = models.AccountStatsBase.DRIVE_BY
 NOT_REQUESTED = models.AccountStatsBase.NOT_REQUESTED
 OUTGOING = models.AccountStatsBase.OUTGOING
 
+# Matches the StatsProfile report at the end of the daily stats response.
+PROFILE_RE = ''.join(
+    re.escape(phase) + ': \\d+\\.\\d{3}s, \\d+ RPCs\n'
+    for phase in views.STATS_PHASES)
+
+# Number of issues of the synthetic fixture used by test_dry_run(). Set the
+# environment variable to benchmark the daily stats on a larger fixture. The
+# task response, with the profile of each phase, is logged.
+STATS_FIXTURE_ISSUES = int(os.environ.get('STATS_FIXTURE_ISSUES', 0)) or 10
+
 
 class MockRequestTask(HttpRequest):
   """Mock request class for testing."""
@@ -156,7 +168,10 @@ class TestDailyStats(TestCase):
     # Check the HTTP request reply at the end, because it's more cosmetic than
     # the actual entities.
     self.assertTrue(
-        re.match('^' + re.escape(date + '\n' + text) + 'In \\d+\\.\\ds\n$', actual[0]),
+        re.match(
+            '^' + re.escape(date + '\n' + text) + 'In \\d+\\.\\ds\n' +
+            PROFILE_RE + '$',
+            actual[0]),
         actual[0])
 
   def test_normal_lgtm(self):
@@ -776,6 +791,189 @@ class TestDailyStats(TestCase):
     ]
     self.trigger_request('2011-03-01', text, expected)
 
+  def test_update_day_stats_item(self):
+    item = models.AccountStatsDay(id='2011-03-01')
+    index = {}
+    self.assertTrue(
+        views.update_day_stats_item(item, index, 1, -1, 0, IGNORED))
+    self.assertTrue(views.update_day_stats_item(item, index, 2, 10, 1, NORMAL))
+    self.assertEqual({1: 0, 2: 1}, index)
+    # Unchanged, or would lower the number of lgtms or drop the latency.
+    self.assertFalse(
+        views.update_day_stats_item(item, index, 2, 10, 1, NORMAL))
+    self.assertFalse(
+        views.update_day_stats_item(item, index, 2, 10, 0, NORMAL))
+    self.assertFalse(
+        views.update_day_stats_item(item, index, 2, -1, 1, IGNORED))
+    self.assertTrue(views.update_day_stats_item(item, index, 1, 5, 0, NORMAL))
+    self.assertEqual([1, 2], item.issues)
+    self.assertEqual([5, 10], item.latencies)
+    self.assertEqual([0, 1], item.lgtms)
+    self.assertEqual([NORMAL, NORMAL], item.review_types)
+
+  def test_yield_issues_for_day(self):
+    # Issues are yielded in order even when fewer are kept in flight than
+    # there are issues, and the walk stops on the first issue of the next day.
+    issues = [self.create_issue('01 01:00') for _ in xrange(3)]
+    self.add_message(issues[0], self.author, [self.reviewer1], '01 01:01', '')
+    self.add_message(issues[1], self.author, [self.reviewer1], '01 01:02', '')
+    self.add_message(issues[0], self.reviewer1, [self.author], '01 01:03', '')
+    self.add_message(issues[2], self.author, [self.reviewer1], '02 01:04', '')
+    old_in_flight = views.STATS_ISSUES_IN_FLIGHT
+    views.STATS_ISSUES_IN_FLIGHT = 2
+    try:
+      touched = set()
+      messages_looked_up = [0]
+      actual = [
+        (issue.key().id(), len(messages))
+        for issue, messages in views.yield_issues_for_day(
+            datetime.datetime(2011, 3, 1), touched, messages_looked_up)
+      ]
+    finally:
+      views.STATS_ISSUES_IN_FLIGHT = old_in_flight
+    self.assertEqual(
+        [(issues[0].key().id(), 2), (issues[1].key().id(), 1)], actual)
+    self.assertEqual(set(i.key().id() for i in issues[:2]), touched)
+    self.assertEqual([3], messages_looked_up)
+
+  def create_fixture(self, nb_issues):
+    """Creates nb_issues reviewed issues on 2011-03-01, as sent from the UI.
+
+    Returns the number of messages.
+    """
+    models.DayActivityStart(id='start', day='2011-02-28').put()
+    messages = [
+      (self.author, [self.reviewer1, self.reviewer2], '01 02:00', ''),
+      (self.reviewer1, [self.author], '01 03:00', 'lgtm'),
+      (self.reviewer2, [self.author], '01 04:00', 'Please fix'),
+      (self.author, [self.reviewer1, self.reviewer2], '01 05:00', 'Done'),
+    ]
+    for _ in xrange(nb_issues):
+      issue = self.create_issue(
+          '01 01:00', reviewers=[self.reviewer1, self.reviewer2])
+      for sender, recipients, date, text in messages:
+        self.add_message(issue, sender, recipients, date, text)
+      models.DayActivity.record(
+          issue.key().id(), datetime.datetime(2011, 3, 1))
+    return nb_issues * len(messages)
+
+  def test_dry_run(self):
+    nb_messages = self.create_fixture(STATS_FIXTURE_ISSUES)
+    request = MockRequestTask('update-stats', ['2011-03-01'], '2011-03-01')
+    request.POST['dry_run'] = '1'
+    out = views.task_update_stats(request)
+    self.assertEqual(200, out.status_code)
+    actual = list(out)[0]
+    logging.info('Dry run of %d issues:\n%s', STATS_FIXTURE_ISSUES, actual)
+    match = re.match(
+        '^2011-03-01\n%d messages\n%d issues\nUpdated (\\d+) items\n'
+        'In \\d+\\.\\ds\nDry run, nothing saved\n%s$' % (
+            nb_messages, STATS_FIXTURE_ISSUES, PROFILE_RE),
+        actual)
+    self.assertTrue(match, actual)
+    self.assertEqual([], models.AccountStatsDay.query().fetch())
+    rpcs = dict(
+        (phase, int(count))
+        for phase, count in re.findall(r'^(.+): .+, (\d+) RPCs$', actual, re.M))
+    self.assertTrue(rpcs['message scan'], actual)
+    self.assertTrue(rpcs['issue fetch'], actual)
+    # Merging the results in the AccountStatsDay entities is in memory only.
+    self.assertEqual(0, rpcs['stats merge'], actual)
+
+    # The same run without dry_run reports the same work and saves it.
+    request = MockRequestTask('update-stats', ['2011-03-01'], '2011-03-01')
+    actual = list(views.task_update_stats(request))[0]
+    self.assertTrue(
+        re.match('^.+\nUpdated %s items\n' % match.group(1), actual, re.S),
+        actual)
+    self.assertEqual(3, len(models.AccountStatsDay.query().fetch()))
+
+  def test_transactional(self):
+    # The transactional merge keeps the results already stored by another
+    # task and stores the same entities as the buffered puts.
+    issue = self.create_issue('01 01:00')
+    self.add_message(issue, self.author, [self.reviewer1], '01 01:01', '')
+    self.add_message(issue, self.reviewer1, [self.author], '01 01:03', 'lgtm')
+    key = ndb.Key(
+        'Account', models.Account.get_id_for_email('reviewer1@example.com'),
+        'AccountStatsDay', '2011-03-01')
+    models.AccountStatsDay(
+        key=key, issues=[1000], latencies=[10], lgtms=[0],
+        review_types=[NORMAL]).put()
+    out, _ = views.update_daily_stats(
+        None, datetime.datetime(2011, 3, 1), transactional=True)
+    self.assertEqual(200, out.status_code)
+    self.assertTrue('\nUpdated 2 items\n' in list(out)[0])
+    item = key.get()
+    self.assertEqual([1000, issue.key().id()], item.issues)
+    self.assertEqual([10, 120], item.latencies)
+    self.assertEqual([0, 1], item.lgtms)
+    # Running it again doesn't modify anything.
+    out, _ = views.update_daily_stats(
+        None, datetime.datetime(2011, 3, 1), transactional=True)
+    self.assertTrue('\nUpdated 0 items\n' in list(out)[0])
+
+  def test_yield_issues_for_day_indexed(self):
+    # When the day has a DayActivity index, only the issues listed are loaded
+    # and their messages after the day are not fetched.
+    issues = [self.create_issue('01 01:00') for _ in xrange(3)]
+    self.add_message(issues[0], self.author, [self.reviewer1], '01 01:01', '')
+    self.add_message(issues[0], self.reviewer1, [self.author], '02 01:03', '')
+    self.add_message(issues[0], self.author, [self.reviewer1], '03 01:00', '')
+    self.add_message(issues[1], self.author, [self.reviewer1], '01 01:02', '')
+    self.add_message(issues[2], self.author, [self.reviewer1], '02 01:04', '')
+    day = datetime.datetime(2011, 3, 2)
+    models.DayActivityStart(id='start', day='2011-03-01').put()
+    # issues[1] has no message on the day and 1000 doesn't exist, both are
+    # skipped.
+    for issue_id in [i.key().id() for i in issues] + [1000]:
+      models.DayActivity.record(issue_id, day)
+    touched = set()
+    messages_looked_up = [0]
+    actual = sorted(
+      (issue.key().id(), len(messages))
+      for issue, messages in views.yield_issues_for_day(
+          day, touched, messages_looked_up))
+    self.assertEqual(
+        [(issues[0].key().id(), 2), (issues[2].key().id(), 1)], actual)
+    self.assertEqual(
+        set([issues[0].key().id(), issues[2].key().id()]), touched)
+    self.assertEqual([2], messages_looked_up)
+
+  def test_yield_issues_for_day_partially_indexed(self):
+    # The first day recorded in the index is still scanned, since the messages
+    # sent before the deploy are missing from the index.
+    issues = [self.create_issue('01 01:00') for _ in xrange(2)]
+    self.add_message(issues[0], self.author, [self.reviewer1], '01 01:01', '')
+    self.add_message(issues[1], self.author, [self.reviewer1], '01 01:02', '')
+    day = datetime.datetime(2011, 3, 1)
+    models.DayActivity.record(issues[1].key().id(), day)
+    self.assertEqual(
+        '2011-03-01', models.DayActivityStart.get_by_id('start').day)
+    self.assertFalse(models.DayActivity.is_complete('2011-03-01'))
+    self.assertTrue(models.DayActivity.is_complete('2011-03-02'))
+    actual = [
+      issue.key().id()
+      for issue, _ in views.yield_issues_for_day(day, set(), [0])
+    ]
+    self.assertEqual([i.key().id() for i in issues], actual)
+
+  def test_record_activity_failure(self):
+    # Failing to index the message doesn't fail the message.
+    issue = self.create_issue('01 01:00')
+    msg = models.Message(
+        parent=issue, issue=issue, subject='Hi', sender=self.author.email,
+        date=datetime.datetime(2011, 3, 1))
+    def fail(*_):
+      raise db.Timeout()
+    old_add_day_activity = models._add_day_activity
+    models._add_day_activity = fail
+    try:
+      msg.record_activity()
+    finally:
+      models._add_day_activity = old_add_day_activity
+    self.assertEqual([], models.DayActivity.query().fetch())
+
 
 class TestMultiStats(TestCase):
   def setUp(self):
@@ -890,6 +1088,59 @@ class TestMultiStats(TestCase):
     text = 'Looked up 2 accounts\nStored 2 items\nDeleted 0\n'
     self.trigger_request(self.yesterday, '30', text, expected)
 
+  def test_rolling_accounts(self):
+    # Only the accounts with a day just updated or a day that fell out of the
+    # window are looked at. Use a reference day in the future so no
+    # AccountStatsDay is considered modified since.
+    reference_day = datetime.datetime.utcnow().date() + datetime.timedelta(2)
+    dropped_day = reference_day - datetime.timedelta(days=30)
+    for key, day in (
+        (self.userA_key, dropped_day),
+        (self.userB_key, dropped_day + datetime.timedelta(days=1))):
+      models.AccountStatsDay(
+          id=str(day), parent=key, issues=[1], latencies=[-1], lgtms=[0],
+          review_types=[IGNORED]).put()
+    self.assertEqual(
+        [self.userA_key],
+        views.get_rolling_stats_accounts('30', reference_day))
+    self.assertEqual(
+        [self.userA_key, self.userB_key],
+        views.get_rolling_stats_accounts('30', dropped_day))
+
+  def test_rolling_accounts_stale_window(self):
+    # A rolling summary computed before a skipped run still holds a day that
+    # left the window. It is selected and recomputed without that day.
+    reference_day = datetime.datetime.utcnow().date() + datetime.timedelta(2)
+    old_day = reference_day - datetime.timedelta(days=31)
+    in_window = reference_day - datetime.timedelta(days=3)
+    for day in (old_day, in_window):
+      models.AccountStatsDay(
+          id=str(day), parent=self.userB_key, issues=[day.day],
+          latencies=[-1], lgtms=[0], review_types=[IGNORED]).put()
+    models.AccountStatsMulti(
+        id='30', parent=self.userB_key, first_day=str(old_day),
+        issues=[old_day.day, in_window.day], latencies=[-1, -1],
+        lgtms=[0, 0], review_types=[IGNORED, IGNORED]).put()
+    self.assertEqual(
+        [self.userB_key],
+        views.get_rolling_stats_accounts('30', reference_day))
+
+    # The cursor skips the accounts already processed.
+    out, cursor = views.update_rolling_stats(
+        self.userB_key.id(), reference_day)
+    self.assertEqual(200, out.status_code)
+    self.assertEqual('', cursor)
+    self.assertEqual(
+        [old_day.day, in_window.day],
+        models.AccountStatsMulti.get_by_id('30', parent=self.userB_key).issues)
+
+    out, cursor = views.update_rolling_stats(None, reference_day)
+    self.assertEqual(200, out.status_code)
+    self.assertEqual('', cursor)
+    rolling = models.AccountStatsMulti.get_by_id('30', parent=self.userB_key)
+    self.assertEqual([in_window.day], rolling.issues)
+    self.assertEqual(str(in_window), rolling.first_day)
+
   def test_month(self):
     models.AccountStatsDay(
         id='2012-04-08',
@@ -937,6 +1188,15 @@ class TestMultiStats(TestCase):
         modified=self.yesterday).put()
 
     expected = [
+      {
+        'issues': [1, 13],
+        'latencies': [1, 3],
+        'lgtms': [10, 0],
+        'name': '2012',
+        'score': 0.01,
+        'review_types': [NORMAL, NORMAL],
+        'user': self.userA,
+      },
       {
         'issues': [1, 13],
         'latencies': [1, 3],
@@ -946,6 +1206,15 @@ class TestMultiStats(TestCase):
         'review_types': [NORMAL, NORMAL],
         'user': self.userA,
       },
+      {
+        'issues': [1, 13],
+        'latencies': [1, 3],
+        'lgtms': [10, 0],
+        'name': '2012-q2',
+        'score': 0.01,
+        'review_types': [NORMAL, NORMAL],
+        'user': self.userA,
+      },
       {
         # Old instance.
         'issues': [1, 2, 3],
@@ -956,6 +1225,15 @@ class TestMultiStats(TestCase):
         'score': 0.006666666666666666,
         'user': self.userB,
       },
+      {
+        'issues': [3, 30, 13],
+        'latencies': [30, -1, 1],
+        'lgtms': [1, 0, 1],
+        'name': '2012',
+        'review_types': [DRIVE_BY, IGNORED, NORMAL],
+        'score': 0.11624999999999999,
+        'user': self.userB,
+      },
       {
         'issues': [3],
         'latencies': [30],
@@ -974,8 +1252,17 @@ class TestMultiStats(TestCase):
         'score': 0.02,
         'user': self.userB,
       },
+      {
+        'issues': [3, 30, 13],
+        'latencies': [30, -1, 1],
+        'lgtms': [1, 0, 1],
+        'name': '2012-q2',
+        'review_types': [DRIVE_BY, IGNORED, NORMAL],
+        'score': 0.11624999999999999,
+        'user': self.userB,
+      },
     ]
-    text = 'Stored 3 items\nSkipped 0\n'
+    text = 'Stored 3 items\nSkipped 0\nUpdated 4 rollups\n'
     self.trigger_request(self.today, 'monthly', text, expected)
 
   def test_month_skip(self):
@@ -1007,10 +1294,67 @@ class TestMultiStats(TestCase):
         'user': self.userA,
       },
     ]
-    text = 'Stored 0 items\nSkipped 1\n'
+    text = 'Stored 0 items\nSkipped 1\nUpdated 0 rollups\n'
     self.trigger_request(self.today, 'monthly', text, expected)
 
 
+class TestStatsBackfill(TestCase):
+  def setUp(self):
+    super(TestStatsBackfill, self).setUp()
+    self.testbed.init_taskqueue_stub(
+        root_path=os.path.join(os.path.dirname(__file__), '..'))
+    self.taskqueue_stub = self.testbed.get_stub('taskqueue')
+    self.old_shards = views.STATS_BACKFILL_SHARDS
+    views.STATS_BACKFILL_SHARDS = 2
+
+  def tearDown(self):
+    views.STATS_BACKFILL_SHARDS = self.old_shards
+    super(TestStatsBackfill, self).tearDown()
+
+  def get_tasks(self, queue_name):
+    return self.taskqueue_stub.get_filtered_tasks(queue_names=[queue_name])
+
+  def test_backfill(self):
+    days = ['2011-03-03', '2011-03-01', '2011-03-02']
+    backfill = views.start_stats_backfill(days, ['monthly'], '2011-04-01')
+    self.assertEqual(2, backfill.shards)
+    self.assertEqual(['monthly'], backfill.followup)
+    shard_keys = [
+      models.StatsBackfillShard.get_key(backfill.key.id(), i) for i in (0, 1)
+    ]
+    self.assertEqual(
+        [['2011-03-01', '2011-03-02'], ['2011-03-03']],
+        [s.pending for s in ndb.get_multi(shard_keys)])
+    tasks = self.get_tasks('update-stats-backfill')
+    self.assertEqual(
+        [('0', ['2011-03-01', '2011-03-02']), ('1', ['2011-03-03'])],
+        sorted(
+            (t.extract_params()['shard'],
+             json.loads(t.extract_params()['days']))
+            for t in tasks))
+
+    self.assertFalse(
+        views.complete_stats_backfill_day(shard_keys[0], '2011-03-01'))
+    # Completing a day twice is a no-op.
+    self.assertFalse(
+        views.complete_stats_backfill_day(shard_keys[0], '2011-03-01'))
+    self.assertTrue(
+        views.complete_stats_backfill_day(shard_keys[0], '2011-03-02'))
+    self.assertEqual(['2011-03-03'], shard_keys[1].get().pending)
+    self.assertFalse(views.finish_stats_backfill(backfill.key, '2011-04-01'))
+    self.assertEqual([], self.get_tasks('update-stats'))
+
+    self.assertTrue(
+        views.complete_stats_backfill_day(shard_keys[1], '2011-03-03'))
+    self.assertTrue(views.finish_stats_backfill(backfill.key, '2011-04-01'))
+    tasks = self.get_tasks('update-stats')
+    self.assertEqual(1, len(tasks))
+    self.assertEqual(
+        ['monthly'], json.loads(tasks[0].extract_params()['tasks']))
+    # The followup tasks are triggered only once.
+    self.assertFalse(views.finish_stats_backfill(backfill.key, '2011-04-01'))
+
+
 class TestFetchStats(TestCase):
   def setUp(self):
     super(TestFetchStats, self).setUp()
@@ -1086,6 +1430,15 @@ class TestFetchStats(TestCase):
         lgtms=[1, 2, 0, 0, 0, 0],
         review_types=[NORMAL, NORMAL, NORMAL, NORMAL, NORMAL, NORMAL]).put()
 
+    # Quarter and year rollups, normally stored by the monthly stats task.
+    for email, months in (
+        ('user@example.com', ['2011-01', '2011-03']),
+        ('joe@example.com', ['2011-02']),
+        ('john@example.com', ['2011-02'])):
+      views.update_stats_rollups(
+          ndb.Key('Account', models.Account.get_id_for_email(email)), months)
+    models.StatsRollups(id='complete').put()
+
   def assert_json(self, out, expected):
     self.assertEqual(200, out.status_code)
     actual = list(out)
@@ -1250,6 +1603,83 @@ class TestFetchStats(TestCase):
     ]
     self.trigger_request_leaderboard('2011-Q1', expected)
 
+  def test_leaderboard_json_year(self):
+    out = views.leaderboard_json(MockRequestGet(), '2011')
+    self.assertEqual(200, out.status_code)
+    actual = json.loads(list(out)[0])
+    self.assertEqual(
+        [u'user@example.com', u'joe@example.com', u'john@example.com'],
+        [i['user'] for i in actual])
+    self.assertEqual([u'2011'] * 3, [i['name'] for i in actual])
+
+  def test_leaderboard_cached(self):
+    self.assertEqual(3, len(views.leaderboard_impl('30', 10)))
+    user = models.Account.get_account_for_user(User('jane@example.com'))
+    models.AccountStatsMulti(
+        id='30',
+        parent=ndb.Key.from_old_key(user.key()),
+        issues=[12],
+        latencies=[10],
+        lgtms=[1],
+        review_types=[NORMAL]).put()
+    # The same entities are served until the next stats update.
+    self.assertEqual(3, len(views.leaderboard_impl('30', 10)))
+    views.invalidate_leaderboard_cache()
+    self.assertEqual(4, len(views.leaderboard_impl('30', 10)))
+
+  def test_leaderboard_cached_deleted(self):
+    self.assertEqual(3, len(views.leaderboard_impl('30', 10)))
+    ndb.delete_multi(
+        models.AccountStatsMulti.query(
+            models.AccountStatsMulti.name == '30').fetch(keys_only=True))
+    self.assertEqual([], views.leaderboard_impl('30', 10))
+
+  def delete_rollups(self):
+    keys = [
+      k for k in models.AccountStatsMulti.query().fetch(keys_only=True)
+      if k.id() in ('2011', '2011-q1')
+    ]
+    self.assertEqual(6, len(keys))
+    ndb.delete_multi(keys)
+    ndb.Key(models.StatsRollups, 'complete').delete()
+    views.invalidate_leaderboard_cache()
+
+  def test_leaderboard_quarter_incomplete_rollups(self):
+    expected = [
+      ('user@example.com', [5, 6, 30, 10]),
+      ('joe@example.com', [4, 5]),
+      ('john@example.com', [8]),
+    ]
+    for when in ('2011-q1', '2011'):
+      self.assertEqual(
+          expected,
+          [(t.user, t.issues) for t in views.leaderboard_impl(when, 10)])
+    # Only the accounts updated since the rollups exist have one.
+    self.delete_rollups()
+    views.update_stats_rollups(
+        ndb.Key('Account', models.Account.get_id_for_email('joe@example.com')),
+        ['2011-02'])
+    for when in ('2011-q1', '2011'):
+      self.assertEqual(
+          expected,
+          [(t.user, t.issues) for t in views.leaderboard_impl(when, 10)])
+
+  def test_update_all_stats_rollups(self):
+    self.delete_rollups()
+    out, cursor = views.update_all_stats_rollups(None)
+    self.assertEqual(200, out.status_code)
+    self.assertEqual('', cursor)
+    self.assertTrue(
+        list(out)[0].startswith('Looked up 7 summaries\nUpdated 6 rollups\n'))
+    self.assertTrue(models.StatsRollups.is_complete())
+    user_key = ndb.Key(
+        'Account', models.Account.get_id_for_email('user@example.com'))
+    quarter = models.AccountStatsMulti.get_by_id('2011-q1', parent=user_key)
+    self.assertEqual([5, 6, 30, 10], quarter.issues)
+    self.assertEqual(
+        [u'user@example.com', u'joe@example.com', u'john@example.com'],
+        [t.user for t in views.leaderboard_impl('2011', 10)])
+
   def test_leaderboard_quarter(self):
     # Test that there's some html generated.
     out = views.leaderboard(MockRequestGet(), '2011-q1')
@@ -1356,6 +1786,23 @@ class TestProcessIssue(TestCase):
         text='LGTM')
     self.process(self.reviewer, 0, True, 140, 1, DRIVE_BY)
 
+  def test_real_accounts_cached(self):
+    people = [self.reviewer, self.ml]
+    people_caches = {'fake': set(), 'real': set()}
+    self.assertEqual(
+        set([self.reviewer]),
+        views.figure_out_real_accounts(people, people_caches))
+    # The next run doesn't hit the datastore, even if the classification
+    # changed in the meantime.
+    db.delete(models.Issue.all(keys_only=True).filter(
+        'owner =', self.reviewer_user))
+    models.Issue(owner=self.ml_user, subject='Hi').put()
+    people_caches = {'fake': set(), 'real': set()}
+    self.assertEqual(
+        set([self.reviewer]),
+        views.figure_out_real_accounts(people, people_caches))
+    self.assertEqual(set([self.ml]), people_caches['fake'])
+
   def test_drive_by_and_mailing_list(self):
     # Combines both; Issue first sent to a mailing list, then someone starts
     # reviewing, then someone else drives-by.
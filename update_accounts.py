@@ -56,6 +56,7 @@ def run():
     print 'Updating %d accounts' % len(tbd)
 
     db.put(tbd)
+    models.Account.invalidate_cache(account.email for account in tbd)
 
     print 'Updated accounts:'
     for account in tbd:
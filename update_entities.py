@@ -48,6 +48,8 @@ def run(model_class, batch_size=100, last_key=None):
           keys = db.put(batch)
         except db.Timeout:
           logging.warn("Put timed out, retrying")
+      if model_class is models.Account:
+        models.Account.invalidate_cache(account.email for account in batch)
 
       last_key = keys[-1]
       print "Updated %d records" % (len(keys),)